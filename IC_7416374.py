@@ -3,7 +3,7 @@
 # pylint: disable=C0103
 # Disable protected access warnings
 # pylint: disable=W0212
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 from nmigen import Signal, Module, Elaboratable, Array, ClockSignal, ResetSignal, ClockDomain
 from nmigen.build import Platform
@@ -108,17 +108,22 @@ class IC_reg32_with_mux(Elaboratable):
     There is no output enable input.
     """
 
-    def __init__(self, clk: str, N: int, ext_init: bool = False, faster: bool = False):
+    def __init__(self, clk: str, N: int, ext_init: bool = False, faster: bool = False,
+                 q: Optional[Signal] = None):
         """Constructs a 32-bit register with multiplexed inputs.
 
         Setting faster will make formal verification somewhat faster, since there aren't
         so many nested submodules and extra logic.
+
+        q is the signal to use as the output, if given. With faster set, it is then the
+        register itself, so simulators can read and write the register through it.
         """
         self.N = N
         self.clk = clk
         self.d = Array([Signal(32, name=f"d{i}") for i in range(N)])
         self.n_sel = Signal(N)
-        self.q = Signal(32)
+        self.q = Signal(32) if q is None else q
+        self._own_q = q is None
         self._ext_init = ext_init
         self._faster = faster
 
@@ -127,9 +132,14 @@ class IC_reg32_with_mux(Elaboratable):
         m = Module()
 
         if self._faster:
-            attrs = [] if not self._ext_init else [("uninitialized", "")]
-            _q = Signal(32, attrs=attrs)
-            m.d.comb += self.q.eq(_q)
+            if self._own_q:
+                attrs = [] if not self._ext_init else [("uninitialized", "")]
+                _q = Signal(32, attrs=attrs)
+                m.d.comb += self.q.eq(_q)
+            else:
+                _q = self.q
+                if self._ext_init:
+                    _q.attrs["uninitialized"] = ""
             c = m.d[self.clk]
             for i in range(self.N):
                 with m.If(~self.n_sel[i]):
@@ -31,11 +31,11 @@ class IC_GAL_imm_format_decoder(Elaboratable):
         """Implements the logic of the buffer."""
         m = Module()
 
-        # OE_I = 0000011 | 0001111 | 0010011
+        # OE_I = 0000011 | 0001111 | 0010011 | 1100111
         # OE_S = 0100011
         # OE_U = 0010111 | 0110111
         # OE_B = 1100011
-        # OE_J = 1100111 | 1101111
+        # OE_J = 1101111
         # OE_SYS = 1110011
 
         m.d.comb += [
@@ -47,7 +47,7 @@ class IC_GAL_imm_format_decoder(Elaboratable):
             self.sys_n_oe.eq(1),
         ]
         with m.Switch(self.opcode):
-            with m.Case(0b0000011, 0b0001111, 0b0010011):  # I
+            with m.Case(0b0000011, 0b0001111, 0b0010011, 0b1100111):  # I
                 m.d.comb += self.i_n_oe.eq(0)
             with m.Case(0b0100011):  # S
                 m.d.comb += self.s_n_oe.eq(0)
@@ -55,7 +55,7 @@ class IC_GAL_imm_format_decoder(Elaboratable):
                 m.d.comb += self.u_n_oe.eq(0)
             with m.Case(0b1100011):
                 m.d.comb += self.b_n_oe.eq(0)
-            with m.Case(0b1100111, 0b1101111):
+            with m.Case(0b1101111):
                 m.d.comb += self.j_n_oe.eq(0)
             with m.Default():
                 m.d.comb += self.sys_n_oe.eq(0)
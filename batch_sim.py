@@ -0,0 +1,642 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+# Disable "too many branches/statements/locals": the machine cycle is
+# deliberately one flat function, as in MicrocodeSim.
+# pylint: disable=R0912,R0914,R0915
+"""
+This module runs many CPUs in lockstep, one NumPy array lane per CPU.
+
+BatchMicrocodeSim is MicrocodeSim with its state in struct-of-arrays form:
+every field of CPUState is an array with one element per lane, and each
+machine cycle is computed for all the running lanes at once. The lanes run
+independent programs in their own memories, and stop independently; a lane
+that halts is dropped from the arrays that are stepped. Run it with:
+
+    python batch_sim.py <image.bin> ... [--base ADDR] [--tohost ADDR]
+        [--max-instrs N] [--max-cycles N] [--coverage FILE]
+
+Each step has a fixed cost of a few hundred microseconds of NumPy calls, so
+the batch pays off with hundreds of lanes or more. With a few thousand lanes
+it runs around ten times as many machine cycles per second as MicrocodeSim.
+"""
+import argparse
+import sys
+import time
+from array import array
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from checkpoint import Checkpoint
+from consts import AluOp, CSRAddr, Instr, MInterrupt, MStatus
+from consts import Opcode, OpcodeSelect, SeqMuxSelect, SystemFunc
+from cpu_state import CPUState, Halt, SimStats
+from microcode_sim import MASK32, _CONSTS, _OPCODES, rom_tables
+from rom_coverage import RomCoverage
+from rom_table import RomTable
+from sim_memory import MainMemory
+
+_MIE = 1 << MStatus.MIE
+_MPIE = 1 << MStatus.MPIE
+_MTI = 1 << MInterrupt.MTI
+_MEI = 1 << MInterrupt.MEI
+_MSI = 1 << MInterrupt.MSI
+_MPIE_SHIFT = int(MStatus.MPIE) - int(MStatus.MIE)
+_MTI_BIT, _MEI_BIT = int(MInterrupt.MTI), int(MInterrupt.MEI)
+_NOT_MIE_MPIE = MASK32 ^ (_MIE | _MPIE)
+_NOT_MIE = MASK32 ^ _MIE
+_NOT_IRQS = MASK32 ^ (_MTI | _MEI)
+_NOT_IRQS_MSI = MASK32 ^ (_MTI | _MEI | _MSI)
+_WORD_MASK = MASK32 ^ 3
+
+_SEL_X, _SEL_Y, _SEL_Z = int(SeqMuxSelect.X), int(SeqMuxSelect.Y), int(SeqMuxSelect.Z)
+_SEL_Z_LSL2, _SEL_MTVEC = int(SeqMuxSelect.Z_LSL2), int(SeqMuxSelect.MTVEC)
+_SEL_TMP, _SEL_CONST = int(SeqMuxSelect.TMP), int(SeqMuxSelect.CONST)
+_MSTATUS, _MIE_CSR, _MIP = int(CSRAddr.MSTATUS), int(CSRAddr.MIE), int(CSRAddr.MIP)
+_MTVEC, _MEPC, _MCAUSE, _MTVAL = (int(CSRAddr.MTVEC), int(CSRAddr.MEPC),
+                                  int(CSRAddr.MCAUSE), int(CSRAddr.MTVAL))
+_KNOWN_CSRS = np.array([_MSTATUS, _MIE_CSR, _MIP, _MTVEC, _MEPC, _MCAUSE, _MTVAL],
+                       dtype=np.uint64)
+
+_CONST_VALUES = np.array(_CONSTS, dtype=np.uint64)
+_OPCODE_SELECTS = np.full(128, int(OpcodeSelect.NONE), dtype=np.uint64)
+_IMM_FORMATS = np.zeros(128, dtype=np.intp)
+for _opcode, (_select, _fmt) in _OPCODES.items():
+    _OPCODE_SELECTS[_opcode] = int(_select)
+    _IMM_FORMATS[_opcode] = _fmt
+
+_IS_SHIFT = np.zeros(16, dtype=bool)
+_IS_SHIFT[[AluOp.SLL, AluOp.SRL, AluOp.SRA]] = True
+
+_OP, _SYSTEM, _PRIV = int(Opcode.OP), int(Opcode.SYSTEM), int(SystemFunc.PRIV)
+_MRET, _ECALL, _EBREAK = int(Instr.MRET), int(Instr.ECALL), int(Instr.EBREAK)
+_OPSEL_CSRS, _OPSEL_MRET = int(OpcodeSelect.CSRS), int(OpcodeSelect.MRET)
+_OPSEL_ECALL, _OPSEL_EBREAK = int(OpcodeSelect.ECALL), int(OpcodeSelect.EBREAK)
+
+# The 32-bit lane mask for each 4-bit byte mask.
+_BYTE_MASKS = np.array([sum(0xFF << (8 * i) for i in range(4) if m & (1 << i))
+                        for m in range(16)], dtype=np.uint64)
+
+
+def _sext(value: np.ndarray, bits: int) -> np.ndarray:
+    """Sign-extends values to 32 bits, returning them as unsigned."""
+    sign = 1 << (bits - 1)
+    return (((value & (2 * sign - 1)) ^ sign) - sign) & MASK32
+
+
+def decode_instrs(instr: np.ndarray):
+    """Decodes an array of instructions, like microcode_sim.decode_instr.
+
+    Returns (rs1, rs2, rd, funct12, imm, bad_instr, seq_addr) arrays, where
+    seq_addr holds the SequencerROM address bits that only depend on the
+    instruction.
+    """
+    opcode = instr & 0x7F
+    rd = (instr >> 7) & 0x1F
+    funct3 = (instr >> 12) & 0x7
+    rs1 = (instr >> 15) & 0x1F
+    rs2 = (instr >> 20) & 0x1F
+    funct12 = instr >> 20
+    alt = ((instr >> 30) & 1) & ((opcode == _OP) | ((funct3 & 0b11) == 0b01))
+    alu_func = funct3 | alt << 3
+
+    opcode_select = _OPCODE_SELECTS[opcode]
+    system = opcode == _SYSTEM
+    if system.any():
+        for select, match in ((_OPSEL_EBREAK, instr == _EBREAK), (_OPSEL_ECALL, instr == _ECALL),
+                              (_OPSEL_MRET, instr == _MRET),
+                              (_OPSEL_CSRS, funct3 != _PRIV)):
+            opcode_select = np.where(system & match, select, opcode_select)
+
+    imm = np.choose(_IMM_FORMATS[opcode], [
+        rs1,
+        _sext(instr >> 20, 12),
+        instr & 0xFFFFF000,
+        _sext(((instr >> 25) << 5) | rd, 12),
+        _sext(((instr >> 31) << 12) | (((instr >> 7) & 1) << 11) |
+              (((instr >> 25) & 0x3F) << 5) | (((instr >> 8) & 0xF) << 1), 13),
+        _sext(((instr >> 31) << 20) | (((instr >> 12) & 0xFF) << 12) |
+              (((instr >> 20) & 1) << 11) | (((instr >> 21) & 0x3FF) << 1), 21)])
+
+    bad_instr = ((instr & 0xFFFF) == 0) | (instr == MASK32)
+    seq_addr = (opcode_select | funct3 << 4 | alu_func << 7 |
+                (imm == 0).astype(np.uint64) << 16 | (rd == 0).astype(np.uint64) << 17 |
+                (rs1 == 0).astype(np.uint64) << 18 | 1 << 20)
+    return rs1, rs2, rd, funct12, imm, bad_instr, seq_addr
+
+
+class _PackedRom:
+    """A ROM table as 128-bit words, for looking up arrays of addresses."""
+
+    def __init__(self, table: RomTable):
+        padded = np.zeros((len(table.data), 16), dtype=np.uint8)
+        padded[:, :table.data.shape[1]] = table.data
+        words = padded.view("<u8")
+        self.lo = np.ascontiguousarray(words[:, 0], dtype=np.uint64)
+        self.hi = np.ascontiguousarray(words[:, 1], dtype=np.uint64)
+        self.fields = {}
+        offset = 0
+        for name, width in table.outputs:
+            self.fields[name.lstrip("_")] = (offset, width)
+            offset += width
+
+    def lookup(self, addr: np.ndarray) -> "_Rows":
+        """Returns the outputs at an array of addresses."""
+        return _Rows(self, self.lo[addr], self.hi[addr])
+
+
+class _Rows:
+    """The outputs of a _PackedRom at an array of addresses.
+
+    Each output is an attribute, extracted from the words on first use.
+    """
+
+    def __init__(self, rom: _PackedRom, lo: np.ndarray, hi: np.ndarray):
+        self._rom = rom
+        self._lo = lo
+        self._hi = hi
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        offset, width = self._rom.fields[name]
+        mask = (1 << width) - 1
+        if offset >= 64:
+            value = (self._hi >> (offset - 64)) & mask
+        elif offset + width <= 64:
+            value = (self._lo >> offset) & mask
+        else:
+            value = ((self._lo >> offset) | (self._hi << (64 - offset))) & mask
+        setattr(self, name, value)
+        return value
+
+
+class BatchState:
+    """The state of a batch of CPUs, with one array element per lane.
+
+    The CPUState fields are uint64 arrays, and regs is an (N, 64) array
+    holding both register pages of each lane. The rest of the per-lane
+    simulation state rides along, so that taking and putting lanes keeps it
+    together.
+    """
+
+    ARRAYS = CPUState.FIELDS + ("regs", "z_2_lsb0", "instr_pc", "time_irq", "ext_irq",
+                                "instrs", "cycles", "traps", "halt", "exit_code", "lane")
+
+    __slots__ = ARRAYS
+
+    def __init__(self, n: int = 0):
+        for name in CPUState.FIELDS:
+            setattr(self, name, np.zeros(n, dtype=np.uint64))
+        self.regs = np.zeros((n, 64), dtype=np.uint64)
+        # The data_z_in_2_lsb0 register.
+        self.z_2_lsb0 = np.zeros(n, dtype=np.uint64)
+        self.instr_pc = np.zeros(n, dtype=np.uint64)
+        self.time_irq = np.zeros(n, dtype=bool)
+        self.ext_irq = np.zeros(n, dtype=bool)
+        self.instrs = np.zeros(n, dtype=np.int64)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.traps = np.zeros(n, dtype=np.int64)
+        self.halt = np.zeros(n, dtype=np.int64)
+        # -1 for lanes that haven't written tohost.
+        self.exit_code = np.full(n, -1, dtype=np.int64)
+        # The index of each lane in the full batch.
+        self.lane = np.arange(n)
+
+    def take(self, idx: np.ndarray) -> "BatchState":
+        """Returns a copy of the given lanes."""
+        other = BatchState()
+        for name in self.ARRAYS:
+            setattr(other, name, getattr(self, name)[idx])
+        return other
+
+    def put(self, idx: np.ndarray, other: "BatchState", other_idx: np.ndarray):
+        """Copies lanes other_idx of other into lanes idx."""
+        for name in self.ARRAYS:
+            getattr(self, name)[idx] = getattr(other, name)[other_idx]
+
+
+class BatchMicrocodeSim:
+    """Runs a batch of programs by stepping the sequencer ROMs for all of them at once.
+
+    Each lane has the memory it was given. The first window bytes of it are
+    held in an array for speed, and accesses outside the window go to the
+    MainMemory itself; call memory to get a lane's MainMemory with the
+    window copied back.
+
+    Attributes:
+        batch: The state of every lane, updated when run returns.
+        tohost: If not None, a write to this address halts a lane.
+        halt_on_self_loop: Halt a lane when an instruction jumps to itself while
+            no interrupt can be taken.
+        csr_rd_data: The value read from CSRs that the CPU doesn't implement.
+        seconds: The wall-clock time spent running the batch.
+        coverage: The RomCoverage to count the ROM addresses of every lane's
+            machine cycles in, if any.
+    """
+
+    def __init__(self, memories: Sequence[MainMemory], tohost: Optional[int] = None,
+                 halt_on_self_loop: bool = True, window: int = 1 << 16):
+        self.batch = BatchState(len(memories))
+        self.tohost = tohost
+        self.halt_on_self_loop = halt_on_self_loop
+        self.csr_rd_data = 0
+        self.seconds = 0.0
+        self.coverage: Optional[RomCoverage] = None
+
+        seq_rom, trap_rom, irq_load_rom = rom_tables()
+        self._seq_rom = _PackedRom(seq_rom)
+        self._trap_rom = _PackedRom(trap_rom)
+        self._irq_load_rom = _PackedRom(irq_load_rom)
+
+        self._memories = list(memories)
+        self._window_words = window // 4
+        self._mem = np.zeros((len(memories), self._window_words), dtype=np.uint32)
+        for lane in range(len(memories)):
+            self._load_window(lane)
+        self._started = np.zeros(len(memories), dtype=bool)
+
+    def _load_window(self, lane: int):
+        """Copies the window of a lane's memory into the window array."""
+        self._mem[lane] = np.frombuffer(
+            self._memories[lane].read_bytes(0, 4 * self._window_words), dtype="<u4")
+
+    def __len__(self) -> int:
+        return len(self._memories)
+
+    def state(self, lane: int) -> CPUState:
+        """Returns a copy of a lane's CPU state."""
+        st = CPUState()
+        for name in CPUState.FIELDS:
+            setattr(st, name, int(getattr(self.batch, name)[lane]))
+        st.regs = array("I", self.batch.regs[lane].astype(np.uint32).tobytes())
+        return st
+
+    def set_state(self, lane: int, st: CPUState):
+        """Replaces a lane's CPU state."""
+        for name in CPUState.FIELDS:
+            getattr(self.batch, name)[lane] = getattr(st, name)
+        self.batch.regs[lane] = st.regs
+        self._started[lane] = False
+
+    def stats(self, lane: int) -> SimStats:
+        """Returns the statistics for a lane. The wall time is the batch's."""
+        stats = SimStats()
+        b = self.batch
+        stats.instrs = int(b.instrs[lane])
+        stats.cycles = int(b.cycles[lane])
+        stats.traps = int(b.traps[lane])
+        stats.seconds = self.seconds
+        stats.halt = Halt(int(b.halt[lane]))
+        if b.exit_code[lane] >= 0:
+            stats.exit_code = int(b.exit_code[lane])
+        return stats
+
+    def memory(self, lane: int) -> MainMemory:
+        """Returns a lane's memory, with the window copied back into it."""
+        memory = self._memories[lane]
+        memory.write_bytes(0, self._mem[lane].astype("<u4").tobytes())
+        return memory
+
+    def checkpoint(self, lane: int) -> Checkpoint:
+        """Returns a checkpoint of a lane, sharing the lane's memory."""
+        b = self.batch
+        ckpt = Checkpoint(self.state(lane), self.memory(lane))
+        ckpt.stats = self.stats(lane)
+        ckpt.stats.seconds = 0.0
+        ckpt.z_2_lsb0 = int(b.z_2_lsb0[lane])
+        ckpt.instr_pc = int(b.instr_pc[lane]) if self._started[lane] else None
+        ckpt.time_irq = int(b.time_irq[lane])
+        ckpt.ext_irq = int(b.ext_irq[lane])
+        ckpt.csr_rd_data = self.csr_rd_data
+        return ckpt
+
+    def restore(self, lane: int, ckpt: Checkpoint):
+        """Makes a lane carry on from a checkpoint, sharing its memory.
+
+        csr_rd_data is shared by the whole batch, so it isn't restored.
+        """
+        b = self.batch
+        self.set_state(lane, ckpt.state)
+        stats = ckpt.stats
+        b.instrs[lane] = stats.instrs
+        b.cycles[lane] = stats.cycles
+        b.traps[lane] = stats.traps
+        b.halt[lane] = stats.halt
+        b.exit_code[lane] = -1 if stats.exit_code is None else stats.exit_code
+        b.z_2_lsb0[lane] = ckpt.z_2_lsb0
+        b.time_irq[lane] = ckpt.time_irq
+        b.ext_irq[lane] = ckpt.ext_irq
+        if ckpt.instr_pc is not None:
+            b.instr_pc[lane] = ckpt.instr_pc
+            self._started[lane] = True
+        self._memories[lane] = ckpt.memory
+        self._load_window(lane)
+
+    def run(self, max_instrs: Optional[int] = None,
+            max_cycles: Optional[int] = None) -> List[SimStats]:
+        """Runs every lane until it halts or reaches a limit.
+
+        Lanes that halted can be resumed by calling run again with higher
+        limits, unless they halted because of a fatal exception.
+
+        Args:
+            max_instrs: Stop each lane after it has retired this many instructions in total.
+            max_cycles: Stop each lane after it has run this many machine cycles in total.
+        """
+        b = self.batch
+        b.halt[b.halt != Halt.FATAL] = Halt.NONE
+        b.instr_pc[~self._started] = b.pc[~self._started]
+        self._started[:] = True
+
+        start = time.perf_counter()
+        w = b.take(np.flatnonzero(b.halt == Halt.NONE))
+        while len(w.lane):
+            if max_instrs is not None:
+                w.halt[(w.halt == Halt.NONE) & (w.instrs >= max_instrs)] = Halt.MAX_INSTRS
+            if max_cycles is not None:
+                w.halt[(w.halt == Halt.NONE) & (w.cycles >= max_cycles)] = Halt.MAX_CYCLES
+            done = w.halt != Halt.NONE
+            if done.any():
+                # Retire the halted lanes, and keep stepping the rest.
+                b.put(w.lane[done], w, done)
+                w = w.take(~done)
+                if not len(w.lane):
+                    break
+            self._step(w)
+        self.seconds += time.perf_counter() - start
+        return [self.stats(lane) for lane in range(len(self))]
+
+    def _read(self, w: BatchState, addr: np.ndarray) -> np.ndarray:
+        idx = addr >> 2
+        inside = idx < self._window_words
+        data = self._mem[w.lane, np.where(inside, idx, 0)].astype(np.uint64)
+        if not inside.all():
+            for k in np.flatnonzero(~inside):
+                data[k] = self._memories[w.lane[k]].read_word(int(addr[k]))
+        return data
+
+    def _write(self, w: BatchState, which: np.ndarray, addr: np.ndarray,
+               data: np.ndarray, mask: np.ndarray):
+        lanes = w.lane[which]
+        addr = addr[which]
+        data = data[which]
+        mask = mask[which]
+        idx = addr >> 2
+        inside = idx < self._window_words
+        byte_mask = _BYTE_MASKS[mask]
+        old = self._mem[lanes[inside], idx[inside]]
+        self._mem[lanes[inside], idx[inside]] = (
+            (old & ~byte_mask[inside]) | (data[inside] & byte_mask[inside]))
+        for k in np.flatnonzero(~inside):
+            self._memories[lanes[k]].write_word(int(addr[k]), int(data[k]), int(mask[k]))
+
+    def _step(self, w: BatchState):
+        """Runs one machine cycle on every lane of w."""
+        n = len(w.lane)
+        ar = np.arange(n)
+        zeros = np.zeros(n, dtype=np.uint64)
+        regs = w.regs
+        base = w.reg_page * 32
+        pc = w.pc
+        memaddr = w.memaddr
+        trap = w.trap != 0
+        instr_phase = w.instr_phase
+        mtvec = w.mtvec
+
+        memdata_rd = self._read(w, memaddr)
+        instr_misalign = ((pc & 3) != 0) & ~trap
+        latch = (instr_phase == 0) & ~trap & ~instr_misalign
+        w.instr = np.where(latch, memdata_rd, w.instr)
+        instr = w.instr
+        rs1, rs2, rd, funct12, imm, bad_instr, seq_addr = decode_instrs(instr)
+        reg_nums = np.stack([zeros, rs1, rs2, rd])
+
+        mip = w.mip
+        mei_pend = (mip >> _MEI_BIT) & 1
+        mti_pend = (mip >> _MTI_BIT) & 1
+        enable = ~(trap | instr_misalign | bad_instr)
+        all_enabled = enable.all()
+
+        # The branch condition, by funct3.
+        funct3 = (instr >> 12) & 0x7
+        eq, lt, ltu = w.stored_alu_eq, w.stored_alu_lt, w.stored_alu_ltu
+        branch_cond = np.choose(funct3.astype(np.intp),
+                                [eq, 1 - eq, zeros, zeros, lt, 1 - lt, ltu, 1 - ltu])
+        seq_addr |= instr_phase << 11 | branch_cond << 13 | (memaddr & 3) << 14
+        if all_enabled:
+            t = None
+        else:
+            seq_addr = np.where(enable, seq_addr, 0)
+            trap_addr = (w.exception << 1 | w.fatal << 2 | instr_misalign.astype(np.uint64) << 3 |
+                         bad_instr.astype(np.uint64) << 4 | trap.astype(np.uint64) << 5 |
+                         mei_pend << 6 | mti_pend << 7 | (mtvec & 3) << 8 | instr_phase << 10)
+            t = self._trap_rom.lookup(trap_addr)
+
+        def pick(name: str) -> np.ndarray:
+            # The output from the ROM in control: SequencerROM when enabled,
+            # TrapROM otherwise.
+            if t is None:
+                return getattr(c, name)
+            return np.where(enable, getattr(c, name), getattr(t, name))
+
+        # The sequencer card's multiplexer inputs, by SeqMuxSelect. The buses
+        # and the constant are filled in as they settle.
+        src = np.stack([w.memdata_wr, memdata_rd, memaddr, memaddr & (MASK32 ^ 1), pc,
+                        (pc + 4) & MASK32, mtvec, mtvec >> 2, w.tmp, imm, instr,
+                        zeros, zeros, zeros, zeros, zeros])
+
+        # The buses settle. This runs again only if this cycle's Z changes the
+        # data_z_in_2_lsb0 register, and so the ROM address, of some lane.
+        while True:
+            c = self._seq_rom.lookup(seq_addr | w.z_2_lsb0 << 19)
+            csr_to_x = pick("csr_to_x") != 0
+            save_trap_csrs = pick("save_trap_csrs") != 0
+            x_mux_select = pick("x_mux_select")
+            y_mux_select = pick("y_mux_select")
+            z_mux_select = pick("z_mux_select")
+            alu_op = pick("alu_op_to_z")
+
+            csr_num = np.where(c.funct12_to_csr_num != 0, funct12,
+                               np.where(c.mepc_num_to_csr_num != 0, _MEPC,
+                                        np.where(pick("mcause_to_csr_num") != 0, _MCAUSE,
+                                                 zeros)))
+            x_mux_select = np.where(csr_to_x & (csr_num == _MTVEC), _SEL_MTVEC, x_mux_select)
+            src[_SEL_X:_SEL_Z_LSL2 + 1] = 0
+            src[_SEL_CONST] = _CONST_VALUES[pick("const")]
+
+            x = np.where(x_mux_select != _SEL_X, src[x_mux_select, ar], 0)
+            x |= np.where(c.reg_to_x != 0, regs[ar, base + reg_nums[c.x_reg_select, ar]], 0)
+            if csr_to_x.any():
+                # Check the CSRs in the reverse of the order ExcCard and IrqCard
+                # give them priority, so that the first match wins.
+                csr_value = np.where(np.isin(csr_num, _KNOWN_CSRS), zeros,
+                                     np.uint64(self.csr_rd_data))
+                not_saving = ~save_trap_csrs
+                for num, value, when in ((_MIP, mip, True), (_MIE_CSR, w.mie, True),
+                                         (_MSTATUS, w.mstatus, True),
+                                         (_MTVAL, w.mtval, not_saving),
+                                         (_MEPC, w.mepc, not_saving),
+                                         (_MCAUSE, w.mcause, not_saving)):
+                    csr_value = np.where((csr_num == num) & when, value, csr_value)
+                x |= np.where(csr_to_x, csr_value, 0)
+            src[_SEL_X] = x
+
+            y = np.where(y_mux_select != _SEL_Y, src[y_mux_select, ar], 0)
+            y |= np.where(c.reg_to_y != 0, regs[ar, base + reg_nums[c.y_reg_select, ar]], 0)
+            src[_SEL_Y] = y
+
+            alu_lt = ((x ^ 0x80000000) < (y ^ 0x80000000)).astype(np.uint64)
+            alu_ltu = (x < y).astype(np.uint64)
+            shamt = y & 31
+            signed_x = (x ^ 0x80000000).astype(np.int64) - 0x80000000
+            # The ALU and shifter results, by AluOp.
+            z = np.choose(alu_op.astype(np.intp), [
+                zeros, (x + y) & MASK32, (x - y) & MASK32, (x << shamt) & MASK32,
+                alu_lt, alu_ltu, x ^ y, x >> shamt,
+                (signed_x >> shamt.astype(np.int64)).astype(np.uint64) & MASK32,
+                x | y, x & y, x, y, x & (y ^ MASK32), zeros, zeros])
+            # The ALU's result is zero when it isn't driving Z, as for shifts.
+            alu_eq = ((z == 0) | _IS_SHIFT[alu_op]).astype(np.uint64)
+            z |= np.where(z_mux_select != _SEL_Z, src[z_mux_select, ar], 0)
+            src[_SEL_Z] = z
+            src[_SEL_Z_LSL2] = (z << 2) & MASK32
+
+            z_2_lsb0 = ((z & 3) == 0).astype(np.uint64)
+            redo = (z_2_lsb0 != w.z_2_lsb0) & enable
+            w.z_2_lsb0 = z_2_lsb0
+            if not redo.any():
+                break
+
+        # ph2w: the register file, tmp, mtvec and the CSRs.
+        rd_num = reg_nums[c.z_reg_select, ar]
+        write_reg = rd_num != 0
+        regs[ar[write_reg], (base + rd_num)[write_reg]] = z[write_reg]
+        tmp_mux_select = c.tmp_mux_select
+        w.tmp = np.where(tmp_mux_select != _SEL_TMP, src[tmp_mux_select, ar], w.tmp)
+
+        z_to_csr = c.z_to_csr != 0
+        mstatus = w.mstatus
+        mie = w.mie
+        mie_on = (mstatus & _MIE) != 0
+        if z_to_csr.any() or save_trap_csrs.any():
+            w.mtvec = np.where(z_to_csr & (csr_num == _MTVEC), z, mtvec)
+            w.mcause = np.where(z_to_csr & (csr_num == _MCAUSE), z,
+                                np.where(save_trap_csrs, x, w.mcause))
+            w.mepc = np.where(z_to_csr & (csr_num == _MEPC), z,
+                              np.where(save_trap_csrs, y, w.mepc))
+            w.mtval = np.where((z_to_csr & (csr_num == _MTVAL)) | save_trap_csrs, z, w.mtval)
+            w.mie = np.where(z_to_csr & (csr_num == _MIE_CSR), z, mie)
+        enter_trap = pick("enter_trap") != 0
+        exit_trap = pick("exit_trap") != 0
+        w.mstatus = np.where(
+            z_to_csr & (csr_num == _MSTATUS), z,
+            np.where(enter_trap, (mstatus & _NOT_MIE_MPIE) | (mstatus & _MIE) << _MPIE_SHIFT,
+                     np.where(exit_trap,
+                              (mstatus & _NOT_MIE) | _MPIE | (mstatus & _MPIE) >> _MPIE_SHIFT,
+                              mstatus)))
+
+        # IrqCard's pending logic, with the CSRs from before the write.
+        mip = np.where(z_to_csr & (csr_num == _MIP), (z & _NOT_IRQS_MSI) | (mip & _MSI),
+                       mip & _NOT_IRQS)
+        if w.time_irq.any() or w.ext_irq.any() or (mti_pend | mei_pend).any():
+            can_pend = ~trap & mie_on
+            mti_on = (mie & _MTI) != 0
+            mei_on = (mie & _MEI) != 0
+            pend_mti = can_pend & mti_on & w.time_irq & (mti_pend == 0)
+            pend_mei = can_pend & mei_on & w.ext_irq & (mei_pend == 0)
+            clear_pend_mti = ~trap & ~(mie_on & mti_on)
+            clear_pend_mei = ~trap & ~(mie_on & mei_on)
+            if t is not None:
+                clear_pend_mti |= ~enable & (t.clear_pend_mti != 0)
+                clear_pend_mei |= ~enable & (t.clear_pend_mei != 0)
+            mtip = pend_mti | (~clear_pend_mti & (mti_pend != 0))
+            meip = pend_mei | (~clear_pend_mei & (mei_pend != 0))
+            mip |= mtip.astype(np.uint64) << _MTI_BIT | meip.astype(np.uint64) << _MEI_BIT
+        w.mip = mip
+
+        # ph2: the exception flags.
+        load_exception = pick("load_exception") != 0
+        if load_exception.any():
+            w.exception = np.where(load_exception, pick("next_exception"), w.exception)
+            w.fatal = np.where(load_exception, pick("next_fatal"), w.fatal)
+
+        # End of the machine cycle.
+        w.cycles += 1
+        mem_wr = c.mem_wr != 0
+        if mem_wr.any():
+            self._write(w, mem_wr, memaddr, w.memdata_wr, c.mem_wr_mask)
+            if self.tohost is not None:
+                hit = mem_wr & ((memaddr & _WORD_MASK) == (self.tohost & _WORD_MASK))
+                w.exit_code = np.where(hit, (w.memdata_wr >> 1).astype(np.int64), w.exit_code)
+                w.halt[hit] = Halt.TOHOST
+        instr_complete = pick("set_instr_complete") != 0
+
+        # ph1: is_interrupted sees the mip that was just written.
+        is_interrupted = instr_complete & ((mip & (_MTI | _MEI)) != 0)
+        irq_load_addr = is_interrupted.astype(np.uint64) | instr_phase << 1 | 1 << 3
+        i = self._irq_load_rom.lookup(irq_load_addr)
+        coverage = self.coverage
+        if coverage is not None:
+            coverage.add("sequencer_rom", (seq_addr | w.z_2_lsb0 << 19)[enable])
+            coverage.add("irq_load_rom", irq_load_addr[enable])
+            if t is not None:
+                coverage.add("trap_rom", (trap_addr | is_interrupted)[~enable])
+        load_trap = (pick("load_trap") | (i.load_trap & enable)) != 0
+        next_trap = pick("next_trap") | (i.next_trap & enable)
+        w.instr_phase = pick("next_instr_phase")
+        w.stored_alu_eq = alu_eq
+        w.stored_alu_lt = alu_lt
+        w.stored_alu_ltu = alu_ltu
+        w.trap = np.where(load_trap, next_trap, w.trap)
+        w.pc = src[pick("pc_mux_select"), ar]
+        w.memaddr = src[pick("memaddr_mux_select"), ar]
+        w.memdata_wr = src[c.memdata_wr_mux_select, ar]
+
+        w.halt[w.fatal != 0] = Halt.FATAL
+        w.traps += instr_complete & trap
+        retired = instr_complete & ~trap
+        w.instrs += retired
+        if self.halt_on_self_loop:
+            can_wake = ((w.mstatus & _MIE) != 0) & ((w.mie & (_MTI | _MEI)) != 0)
+            self_loop = retired & (w.halt == Halt.NONE) & (w.pc == w.instr_pc) & ~can_wake
+            w.halt[self_loop] = Halt.SELF_LOOP
+        w.instr_pc = np.where(instr_complete, w.pc, w.instr_pc)
+
+
+def batch_main(argv: List[str]):
+    """Loads program images, runs them as one batch, and prints the statistics.
+
+    Args:
+        argv: The command line arguments.
+    """
+    parser = argparse.ArgumentParser(prog="batch_sim.py",
+                                     description="Runs RV32I programs in lockstep.")
+    parser.add_argument("images", nargs="+", help="flat binary images to load, one per lane")
+    parser.add_argument("--base", type=lambda s: int(s, 0), default=0,
+                        help="load address of the images (default 0, the reset PC)")
+    parser.add_argument("--tohost", type=lambda s: int(s, 0), default=None,
+                        help="halt a lane when its program writes to this address")
+    parser.add_argument("--max-instrs", type=int, default=None,
+                        help="halt each lane after this many retired instructions")
+    parser.add_argument("--max-cycles", type=int, default=None,
+                        help="halt each lane after this many machine cycles")
+    parser.add_argument("--coverage", metavar="FILE", default=None,
+                        help="write the microcode coverage of all lanes to this .npz file")
+    args = parser.parse_args(argv)
+
+    memories = []
+    for image in args.images:
+        memory = MainMemory()
+        memory.load_file(image, args.base)
+        memories.append(memory)
+    sim = BatchMicrocodeSim(memories, tohost=args.tohost)
+    if args.coverage is not None:
+        sim.coverage = RomCoverage()
+    for image, stats in zip(args.images, sim.run(args.max_instrs, args.max_cycles)):
+        print(f"{image}:")
+        print("  " + stats.report().replace("\n", "\n  "))
+    if args.coverage is not None:
+        sim.coverage.save(args.coverage)
+
+
+if __name__ == "__main__":
+    batch_main(sys.argv[1:])
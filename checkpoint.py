@@ -0,0 +1,180 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module saves and restores checkpoints of a simulated machine.
+
+A checkpoint holds everything a simulator needs to carry on with a run:
+the CPUState (SequencerState, the register file and the ExcCard and IrqCard
+CSRs), the registers only some simulators model (data_z_in_2_lsb0 and the
+RegCard latches), the statistics so far, the interrupt lines and main
+memory. Every simulator takes checkpoints between machine cycles with
+checkpoint() and carries on from one with restore(), so a run can also be
+moved from one engine to another.
+
+The file is little-endian, laid out as:
+
+    header      _HEADER
+    words       CPUState.FIELDS, the 64 registers and LATCHES, as uint32
+    page table  the base address of each memory page, as uint32
+    padding     zeros up to a PAGE_SIZE boundary
+    pages       PAGE_SIZE bytes for each entry in the page table
+
+Memory is saved as the PAGE_SIZE pages MainMemory has allocated, which are
+the ones written or mapped from a file. Each page is written straight from
+its memory, without copying it. The pages are aligned in the file, so
+loading a checkpoint maps them into the new MainMemory rather than reading
+them.
+"""
+import os
+import struct
+from array import array
+from typing import Optional
+
+import numpy as np
+
+from cpu_state import LATCHES, CPUState, Halt, SimStats
+from sim_memory import PAGE_SIZE, MainMemory
+
+MAGIC = b"RVCKPT\0\0"
+VERSION = 1
+
+# magic, version, instrs, cycles, traps, halt, exit_code (-1 for None),
+# instr_pc (-1 for None), z_2_lsb0, time_irq, ext_irq, csr_rd_data, page count.
+_HEADER = struct.Struct("<8sIQQQIqqIIIII")
+_WORDS = len(CPUState.FIELDS) + 64 + len(LATCHES)
+
+
+class Checkpoint:
+    """The complete state of a simulated machine between machine cycles.
+
+    Attributes:
+        state: The CPU state.
+        memory: The main memory. A checkpoint taken from a simulator shares the
+            simulator's memory rather than copying it, so save it before running on.
+        stats: The statistics of the run so far. The wall time isn't saved.
+        z_2_lsb0: The sequencer's data_z_in_2_lsb0 register.
+        latches: The contents of the RegCard latches, in LATCHES order. They
+            are zero in checkpoints from the simulators that don't model them.
+        instr_pc: The address of the instruction being run, which the simulators
+            use to spot self-loops, or None if it isn't known.
+        time_irq: The level of the timer interrupt line.
+        ext_irq: The level of the external interrupt line.
+        csr_rd_data: The value read from CSRs that the CPU doesn't implement.
+    """
+
+    def __init__(self, state: CPUState, memory: MainMemory):
+        self.state = state
+        self.memory = memory
+        self.stats = SimStats()
+        self.z_2_lsb0 = 0
+        self.latches = array("I", [0] * len(LATCHES))
+        self.instr_pc: Optional[int] = None
+        self.time_irq = 0
+        self.ext_irq = 0
+        self.csr_rd_data = 0
+
+    @classmethod
+    def take(cls, sim, state: CPUState) -> "Checkpoint":
+        """Starts a checkpoint of a simulator.
+
+        The statistics, interrupt lines and memory are taken from the simulator;
+        the simulator fills in the rest.
+
+        Args:
+            sim: The simulator.
+            state: A copy of the simulator's CPU state.
+        """
+        ckpt = cls(state, sim.memory)
+        for name in ("instrs", "cycles", "traps", "halt", "exit_code"):
+            setattr(ckpt.stats, name, getattr(sim.stats, name))
+        ckpt.time_irq = sim.time_irq
+        ckpt.ext_irq = sim.ext_irq
+        ckpt.csr_rd_data = sim.csr_rd_data
+        return ckpt
+
+    def restore_run(self, sim):
+        """Restores the statistics, interrupt lines and memory of a simulator.
+
+        The simulator restores the rest.
+        """
+        sim.stats = SimStats()
+        for name in ("instrs", "cycles", "traps", "halt", "exit_code"):
+            setattr(sim.stats, name, getattr(self.stats, name))
+        sim.time_irq = self.time_irq
+        sim.ext_irq = self.ext_irq
+        sim.csr_rd_data = self.csr_rd_data
+        sim.memory = self.memory
+
+
+def save_checkpoint(ckpt: Checkpoint, path: str):
+    """Writes a checkpoint to a file.
+
+    The file is written under a temporary name and renamed into place, so an
+    interrupted save never leaves a partial checkpoint behind.
+    """
+    st = ckpt.state
+    stats = ckpt.stats
+    pages = list(ckpt.memory.pages())
+    bases = np.array([base for base, _ in pages], dtype="<u4")
+    header = _HEADER.pack(
+        MAGIC, VERSION, stats.instrs, stats.cycles, stats.traps, int(stats.halt),
+        -1 if stats.exit_code is None else stats.exit_code,
+        -1 if ckpt.instr_pc is None else ckpt.instr_pc,
+        ckpt.z_2_lsb0, ckpt.time_irq, ckpt.ext_irq, ckpt.csr_rd_data, len(bases))
+    words = array("I", [getattr(st, name) for name in CPUState.FIELDS])
+    words.extend(st.regs)
+    words.extend(ckpt.latches)
+    table_end = _HEADER.size + 4 * (_WORDS + len(bases))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(np.asarray(words, dtype="<u4"))
+        f.write(bases)
+        f.write(bytes(-table_end % PAGE_SIZE))
+        for _, page in pages:
+            f.write(page)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str) -> Checkpoint:
+    """Reads a checkpoint saved with save_checkpoint, mapping its pages into a new MainMemory."""
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a checkpoint")
+        (_, version, instrs, cycles, traps, halt, exit_code, instr_pc, z_2_lsb0,
+         time_irq, ext_irq, csr_rd_data, num_pages) = _HEADER.unpack(header)
+        if version != VERSION:
+            raise ValueError(f"{path} is a version {version} checkpoint, "
+                             f"but only version {VERSION} is supported")
+        words = np.fromfile(f, dtype="<u4", count=_WORDS).tolist()
+        bases = np.fromfile(f, dtype="<u4", count=num_pages).tolist()
+        pages_offset = f.tell() + -f.tell() % PAGE_SIZE
+        size = f.seek(0, os.SEEK_END)
+    if size < pages_offset + num_pages * PAGE_SIZE:
+        raise ValueError(f"{path} is truncated")
+
+    st = CPUState()
+    for i, name in enumerate(CPUState.FIELDS):
+        setattr(st, name, words[i])
+    fields = len(CPUState.FIELDS)
+    st.regs = array("I", words[fields:fields + 64])
+
+    memory = MainMemory()
+    if num_pages:
+        memory.map_pages(path, pages_offset, bases)
+
+    ckpt = Checkpoint(st, memory)
+    ckpt.stats.instrs = instrs
+    ckpt.stats.cycles = cycles
+    ckpt.stats.traps = traps
+    ckpt.stats.halt = Halt(halt)
+    ckpt.stats.exit_code = None if exit_code < 0 else exit_code
+    ckpt.z_2_lsb0 = z_2_lsb0
+    ckpt.latches = array("I", words[fields + 64:])
+    ckpt.instr_pc = None if instr_pc < 0 else instr_pc
+    ckpt.time_irq = time_irq
+    ckpt.ext_irq = ext_irq
+    ckpt.csr_rd_data = csr_rd_data
+    return ckpt
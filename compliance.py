@@ -0,0 +1,335 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module runs riscv-tests and riscv-arch-test style test binaries on the
+CPU simulators, in parallel.
+
+Tests are ELF files, or flat .bin images loaded at --base. A test ends by
+writing to tohost: the tohost symbol of an ELF file, or --tohost. Writing 1
+passes, and writing (n << 1) | 1 fails test case n, as in riscv-tests. If
+the ELF file has begin_signature and end_signature symbols and a
+<test>.reference_output file sits next to it, as in riscv-arch-test, the
+signature words must also match the reference.
+
+The CPU starts at address 0, so for an ELF file whose entry point is
+elsewhere, a lui/jalr trampoline to the entry point is put at address 0.
+
+Only the tests of what the CPU implements are run: OP, OP_IMM, LUI, AUIPC,
+JAL, JALR, BRANCH, LOAD, STORE, the CSR instructions, ECALL, EBREAK and
+MRET. The others are reported as skipped, unless --all is given. The test
+is named after the file, with the riscv-tests prefix (like rv32ui-p-) and
+the riscv-arch-test suffix (like -01) taken off to get the instruction.
+
+Tests are spread over a process pool. The simulator is built once, before
+the workers are forked, so they share the already-elaborated design; each
+test restores the simulator's reset checkpoint with a new memory.
+
+    python compliance.py <dir or file>... [--engine microcode|iss|pysim|cxxrtl]
+        [-j N] [--max-cycles N] [--base ADDR] [--tohost ADDR] [--all]
+        [--json FILE] [--junit FILE] [--coverage FILE]
+
+--coverage collects the microcode coverage of every test (see
+rom_coverage.py), merges it, and writes it to FILE.
+"""
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Optional
+
+from cpu_sim import ENGINES
+from cpu_state import Halt
+from elf_symbols import load_elf, symbol_addresses
+from rom_coverage import RomCoverage
+from sim_memory import MainMemory
+
+# The instructions of the tests to run.
+SUPPORTED = frozenset([
+    "simple",
+    "add", "addi", "and", "andi", "auipc", "beq", "bge", "bgeu", "blt", "bltu", "bne",
+    "jal", "jalr", "lb", "lbu", "lh", "lhu", "lui", "lw", "or", "ori", "sb", "sh",
+    "sll", "slli", "slt", "slti", "sltiu", "sltu", "sra", "srai", "srl", "srli",
+    "sub", "sw", "xor", "xori",
+    "csr", "mcsr", "csrrw", "csrrs", "csrrc", "csrrwi", "csrrsi", "csrrci",
+    "scall", "sbreak", "ecall", "ebreak", "mret", "illegal", "ma_addr", "ma_fetch",
+])
+
+_ELF_MAGIC = b"\x7fELF"
+
+
+def test_instr(path: str) -> str:
+    """Returns the instruction a test file is named after."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    name = re.sub(r"^rv32[a-z]+-[a-z]+-", "", name)
+    return re.sub(r"-\d+$", "", name)
+
+
+def find_tests(paths: List[str]) -> List[str]:
+    """Returns the test files given, and those in the directories given, sorted."""
+    tests = []
+    for path in paths:
+        if not os.path.isdir(path):
+            tests.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            for name in files:
+                file = os.path.join(root, name)
+                if name.endswith(".bin"):
+                    tests.append(file)
+                    continue
+                with open(file, "rb") as f:
+                    if f.read(4) == _ELF_MAGIC:
+                        tests.append(file)
+    return sorted(tests)
+
+
+def _trampoline(entry: int) -> List[int]:
+    """Returns lui t0, %hi(entry); jalr zero, %lo(entry)(t0)."""
+    hi = ((entry + 0x800) >> 12) & 0xFFFFF
+    lo = (entry - (hi << 12)) & 0xFFF
+    return [0x37 | 5 << 7 | hi << 12, 0x67 | 5 << 15 | lo << 20]
+
+
+class _Worker:
+    """A simulator and its reset checkpoint, reused for every test a process runs.
+
+    Attributes:
+        sim: The simulator.
+        reset: The simulator's checkpoint at reset.
+        coverage: The RomCoverage the simulator counts in, if collecting coverage.
+    """
+
+    def __init__(self, engine: str, coverage: bool = False):
+        self.sim = ENGINES[engine](MainMemory())
+        self.reset = self.sim.checkpoint()
+        self.coverage = RomCoverage() if coverage else None
+        if self.coverage is not None:
+            self.sim.coverage = self.coverage
+
+    def run(self, path: str, base: int, tohost: Optional[int], max_cycles: int) -> Dict[str, Any]:
+        """Runs a test, and returns its result.
+
+        With coverage, the result also has the test's coverage under
+        "coverage", as RomCoverage.sparse returns it.
+        """
+        result: Dict[str, Any] = {"name": os.path.basename(path), "path": path}
+        start = time.perf_counter()
+        try:
+            memory = MainMemory()
+            signature = None
+            with open(path, "rb") as f:
+                is_elf = f.read(4) == _ELF_MAGIC
+            if is_elf:
+                entry = load_elf(path, memory)
+                symbols = symbol_addresses(path)
+                tohost = symbols.get("tohost", tohost)
+                if "begin_signature" in symbols and "end_signature" in symbols:
+                    signature = (symbols["begin_signature"], symbols["end_signature"])
+                if entry != 0:
+                    if memory.read_word(0) or memory.read_word(4):
+                        raise ValueError(f"no room at address 0 to jump to {entry:#x}")
+                    for i, word in enumerate(_trampoline(entry)):
+                        memory.write_word(4 * i, word)
+            else:
+                memory.load_file(path, base)
+            if tohost is None:
+                raise ValueError("no tohost symbol or --tohost address")
+
+            ckpt = copy.copy(self.reset)
+            ckpt.memory = memory
+            sim = self.sim
+            sim.restore(ckpt)
+            sim.tohost = tohost
+            if self.coverage is not None:
+                self.coverage.clear()
+            stats = sim.run(max_cycles=max_cycles)
+            if self.coverage is not None:
+                result["coverage"] = self.coverage.sparse()
+            result.update(instrs=stats.instrs, cycles=stats.cycles)
+            if stats.halt == Halt.TOHOST and stats.exit_code == 0:
+                result["status"] = "pass"
+                if signature is not None:
+                    mismatch = _check_signature(path, memory, *signature)
+                    if mismatch is not None:
+                        result.update(status="fail", message=mismatch)
+            elif stats.halt == Halt.TOHOST:
+                result.update(status="fail", message=f"failed test case {stats.exit_code}")
+            elif stats.halt == Halt.MAX_CYCLES:
+                result.update(status="fail", message=f"timed out after {max_cycles} cycles")
+            else:
+                result.update(status="fail", message=f"halted with {stats.halt.name}")
+        except Exception as e:  # pylint: disable=W0703
+            result.update(status="error", message=f"{type(e).__name__}: {e}")
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+
+def _check_signature(path: str, memory: MainMemory, begin: int, end: int) -> Optional[str]:
+    """Compares a test's signature with its reference, returning what differs, if anything."""
+    reference = os.path.splitext(path)[0] + ".reference_output"
+    if not os.path.exists(reference):
+        return None
+    with open(reference, encoding="utf-8") as f:
+        expected = [int(line, 16) for line in f.read().split()]
+    actual = [memory.read_word(addr) for addr in range(begin, end, 4)]
+    for i, (want, got) in enumerate(zip(expected, actual)):
+        if want != got:
+            return f"signature word {i} is {got:#010x}, expected {want:#010x}"
+    if len(expected) != len(actual):
+        return f"signature has {len(actual)} words, expected {len(expected)}"
+    return None
+
+
+# The worker of this process. It is made before the pool forks, so that the
+# workers share the elaborated design.
+_worker: Optional[_Worker] = None
+
+
+def _init_worker(engine: str, coverage: bool = False):
+    global _worker  # pylint: disable=W0603
+    if _worker is None:
+        _worker = _Worker(engine, coverage)
+
+
+def _run_test(job) -> Dict[str, Any]:
+    return _worker.run(*job)
+
+
+def run_tests(tests: List[str], engine: str = "microcode", jobs: Optional[int] = None,
+              base: int = 0, tohost: Optional[int] = None, max_cycles: int = 1_000_000,
+              run_all: bool = False, progress=None,
+              coverage: Optional[RomCoverage] = None) -> List[Dict[str, Any]]:
+    """Runs tests in parallel.
+
+    Args:
+        tests: The test files.
+        engine: The simulator to run them on.
+        jobs: The number of worker processes. Defaults to the number of CPUs.
+        base: The load address of flat images.
+        tohost: The tohost address of tests that don't have a tohost symbol.
+        max_cycles: The machine cycles after which a test times out.
+        run_all: Run tests of instructions the CPU doesn't implement too.
+        progress: Called with each result as it comes in.
+        coverage: If given, the microcode coverage of every test is added to it.
+
+    Returns:
+        The results in the order of tests. Each is a dict with name, path,
+        status ("pass", "fail", "error" or "skipped"), and if it ran,
+        instrs, cycles, seconds, and a message unless it passed.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    jobs_to_run = []
+    for path in tests:
+        if run_all or test_instr(path) in SUPPORTED:
+            jobs_to_run.append((path, base, tohost, max_cycles))
+        else:
+            results[path] = {"name": os.path.basename(path), "path": path, "status": "skipped",
+                             "message": f"{test_instr(path)} isn't implemented"}
+    if jobs_to_run:
+        _init_worker(engine, coverage is not None)
+        jobs = min(jobs or os.cpu_count() or 1, len(jobs_to_run))
+        if jobs == 1:
+            outcomes = map(_run_test, jobs_to_run)
+        else:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork" if "fork" in methods else None)
+            pool = context.Pool(jobs, initializer=_init_worker,
+                                initargs=(engine, coverage is not None))
+            outcomes = pool.imap_unordered(_run_test, jobs_to_run)
+        for result in outcomes:
+            if "coverage" in result:
+                coverage.merge_sparse(result.pop("coverage"))
+            results[result["path"]] = result
+            if progress is not None:
+                progress(result)
+        if jobs > 1:
+            pool.close()
+            pool.join()
+    return [results[path] for path in tests]
+
+
+def write_junit(results: List[Dict[str, Any]], path: str):
+    """Writes results as a JUnit XML report."""
+    suite = ET.Element("testsuite", name="compliance", tests=str(len(results)))
+    counts = {"fail": 0, "error": 0, "skipped": 0}
+    total = 0.0
+    for result in results:
+        case = ET.SubElement(suite, "testcase", name=result["name"], classname="compliance",
+                             time=f"{result.get('seconds', 0):.3f}")
+        total += result.get("seconds", 0)
+        status = result["status"]
+        if status in counts:
+            counts[status] += 1
+            tag = {"fail": "failure", "error": "error", "skipped": "skipped"}[status]
+            ET.SubElement(case, tag, message=result.get("message", ""))
+        if "cycles" in result:
+            ET.SubElement(case, "system-out").text = (
+                f"instrs={result['instrs']} cycles={result['cycles']}")
+    suite.set("failures", str(counts["fail"]))
+    suite.set("errors", str(counts["error"]))
+    suite.set("skipped", str(counts["skipped"]))
+    suite.set("time", f"{total:.3f}")
+    ET.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def main(argv: List[str]):
+    """Runs the tests given on the command line, and reports the results."""
+    parser = argparse.ArgumentParser(prog="compliance.py",
+                                     description="Runs RV32I compliance and self-tests.")
+    parser.add_argument("tests", nargs="+", help="test files, or directories to search for them")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="microcode",
+                        help="simulator to run the tests on (default microcode)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default the number of CPUs)")
+    parser.add_argument("--max-cycles", type=int, default=1_000_000,
+                        help="machine cycles after which a test times out (default 1000000)")
+    parser.add_argument("--base", type=lambda s: int(s, 0), default=0,
+                        help="load address of flat .bin images (default 0)")
+    parser.add_argument("--tohost", type=lambda s: int(s, 0), default=None,
+                        help="tohost address of tests without a tohost symbol")
+    parser.add_argument("--all", action="store_true",
+                        help="also run tests of instructions the CPU doesn't implement")
+    parser.add_argument("--json", metavar="FILE", default=None, help="write a JSON report")
+    parser.add_argument("--junit", metavar="FILE", default=None,
+                        help="write a JUnit XML report")
+    parser.add_argument("--coverage", metavar="FILE", default=None,
+                        help="write the merged microcode coverage to this .npz file")
+    args = parser.parse_args(argv)
+    if args.coverage is not None and args.engine == "iss":
+        parser.error("--coverage needs an engine that runs the microcode")
+
+    tests = find_tests(args.tests)
+    if not tests:
+        parser.error("no tests found")
+
+    def progress(result: Dict[str, Any]):
+        message = f"  {result['message']}" if "message" in result else ""
+        print(f"{result['status'].upper():<5} {result['name']:<32} "
+              f"{result.get('cycles', 0):>9} cycles {result.get('seconds', 0):>7.3f} s{message}")
+
+    start = time.perf_counter()
+    coverage = RomCoverage() if args.coverage is not None else None
+    results = run_tests(tests, args.engine, args.jobs, args.base, args.tohost,
+                        args.max_cycles, args.all, progress, coverage)
+    counts = {status: sum(1 for r in results if r["status"] == status)
+              for status in ("pass", "fail", "error", "skipped")}
+    print(", ".join(f"{n} {status}" for status, n in counts.items()) +
+          f" in {time.perf_counter() - start:.1f} s")
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+    if args.junit is not None:
+        write_junit(results, args.junit)
+    if coverage is not None:
+        coverage.save(args.coverage)
+    if counts["fail"] or counts["error"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -130,7 +130,7 @@ class AluFunc(IntEnum):
     SUB = 0b1000
     SLL = 0b0001
     SLT = 0b0010
-    SLTU = 0b1011
+    SLTU = 0b0011
     XOR = 0b0100
     SRL = 0b0101
     SRA = 0b1101
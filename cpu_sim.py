@@ -0,0 +1,530 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+# Disable protected access warnings
+# pylint: disable=W0212
+"""
+This module runs real RV32I programs on the FormalCPU gateware.
+
+The CPU is clocked with the same 6-phase clock generator used for formal
+verification (FormalCPU.make_clock), and its memory bus is served from a
+MainMemory model. Run it with:
+
+    python formal_cpu.py sim <image.bin> [--base ADDR] [--tohost ADDR]
+        [--max-instrs N] [--max-cycles N] [--engine pysim|iss|microcode|cxxrtl]
+        [--restore FILE] [--save FILE]
+        [--timer ADDR] [--uart ADDR] [--uart-rx FILE] [--irq-source ADDR]
+        [--trace FILE] [--trace-compression none|zlib|zstd|lz4]
+        [--wave FILE] [--wave-signals LIST] [--wave-trigger SPEC]...
+        [--wave-depth N] [--wave-post N] [--wave-windows N] [--profile]
+        [--pc-sample N] [--symbols ELF] [--collapsed FILE] [--coverage FILE]
+
+With --restore, the run carries on from a checkpoint (see checkpoint.py)
+instead of starting from an image, and --save writes one when it halts.
+Checkpoints can be moved between engines.
+
+--timer, --uart and --irq-source put the devices of sim_devices.py on the
+memory bus at the given addresses. The UART sends to stdout.
+
+--trace writes a binary instruction trace (see sim_trace.py).
+
+--profile prints the machine cycles per instruction by opcode and funct3,
+and per trap entry by cause (see sim_profile.py).
+
+--pc-sample prints a flat profile of the PC, sampled every N machine cycles,
+or every retired instruction if N is 0, by function if --symbols gives the
+firmware's ELF file. --collapsed also writes the samples by call stack for
+flame graphs (see sim_hotspots.py).
+
+--coverage writes the number of machine cycles each SequencerROM, TrapROM
+and IrqLoadInstrROM address was in control (see rom_coverage.py). The iss
+engine doesn't run the microcode, so it can't collect it.
+
+--wave writes a VCD window of the signals in --wave-signals around a
+trigger, like --wave-trigger fatal or --wave-trigger pc=0x100 (see
+sim_wave.py). --wave-signals is a comma-separated list of the groups of
+FormalCPU.probe_signals and signal names, and defaults to bus,state,rom.
+It only works with the pysim engine, and the tick is one sync clock period.
+"""
+import argparse
+import sys
+import time
+from array import array
+from typing import Callable, Generator, List, Optional, Sequence
+
+from nmigen import ClockDomain, Module
+from nmigen.sim import Delay, Simulator, Settle
+
+from checkpoint import Checkpoint, load_checkpoint, save_checkpoint
+from cpu_state import LATCHES, CPUState, Halt, SimStats, irq_can_wake
+from cxxrtl_sim import CXXRTLSim
+from elf_symbols import SymbolTable
+from formal_cpu import FormalCPU
+from iss import ISS
+from microcode_sim import MicrocodeSim
+from rom_coverage import RomCoverage, rom_addresses
+from sim_devices import UART, Device, DeviceBus, IrqSource, Timer
+from sim_hotspots import PCSampler
+from sim_memory import MainMemory
+from sim_profile import Profiler
+from sim_trace import COMPRESSIONS, CSR_FIELDS, TraceWriter, instr_record, trap_record
+from sim_wave import Trigger, WaveCapture
+
+# Half the period of the sync clock, in seconds.
+_HALF_PERIOD = 0.5e-6
+
+
+class CPUSim:
+    """Runs programs on FormalCPU in the nMigen simulator.
+
+    Memory reads are served at the start of each machine cycle from memaddr,
+    which only changes on the ph1 edge. Memory writes, retirement and fatal
+    exceptions are sampled at the end of each machine cycle, when mcycle_end
+    is high.
+
+    The sync clock is driven by the harness process rather than add_clock, so
+    that between runs the simulation rests at the start of a machine cycle,
+    where checkpoints are taken and restored.
+
+    Attributes:
+        memory: The main memory.
+        stats: Statistics for the runs so far.
+        tohost: If not None, a write to this address halts the simulation.
+        halt_on_self_loop: Halt when an instruction jumps to itself while no
+            interrupt can be taken.
+        time_irq: The level of the timer interrupt line.
+        ext_irq: The level of the external interrupt line.
+        csr_rd_data: The value read from CSRs that the CPU doesn't implement.
+        devices: The DeviceBus driving the interrupt lines, if one is attached.
+        trace: The TraceWriter to add a record to for each retired instruction
+            and trap entry, if any.
+        wave: The WaveCapture to sample at the end of each sync clock
+            period, if any. Its ticks are sync clock periods.
+        coverage: The RomCoverage to count the ROM addresses of each machine
+            cycle in, if any.
+    """
+
+    def __init__(self, memory: MainMemory, tohost: Optional[int] = None,
+                 halt_on_self_loop: bool = True):
+        self.memory = memory
+        self.stats = SimStats()
+        self.tohost = tohost
+        self.halt_on_self_loop = halt_on_self_loop
+        self.time_irq = 0
+        self.ext_irq = 0
+        self.csr_rd_data = 0
+        self.devices: Optional[DeviceBus] = None
+        self.trace: Optional[TraceWriter] = None
+        self.wave: Optional[WaveCapture] = None
+        self.coverage: Optional[RomCoverage] = None
+
+        m = Module()
+        m.domains.sync = sync = ClockDomain("sync")
+        m.submodules.cpu = self.cpu = FormalCPU()
+        _, mcycle_end = FormalCPU.make_clock(m)
+        m.d.comb += self.cpu.mcycle_end.eq(mcycle_end)
+        self._clk = sync.clk
+        self._state_signals = self.cpu.state_signals()
+        self._rom_addresses = rom_addresses(self.cpu.seq)
+
+        self._sim = Simulator(m)
+        self._sim.add_process(self._process)
+
+        self._max_instrs: Optional[int] = None
+        self._max_cycles: Optional[int] = None
+        self._instr_pc = 0
+        self._retired_pc: Optional[int] = None
+        # The sync clock periods run so far, for the wave capture.
+        self._ticks = 0
+        # The PC, instruction, and values of rs1 and rs2 when the instruction
+        # started, for the trace.
+        self._trace_start = (0, 0, 0, 0)
+        # Whether run wants the simulation to go on, and whether the process is
+        # resting at the start of a machine cycle.
+        self._running = False
+        self._parked = False
+        # A process to run while parked, for checkpoint and restore.
+        self._request: Optional[Callable[[], Generator]] = None
+
+    def run(self, max_instrs: Optional[int] = None,
+            max_cycles: Optional[int] = None) -> SimStats:
+        """Runs until the program halts or a limit is reached.
+
+        A halted simulation can be resumed by calling run again with higher
+        limits, unless it halted because of a fatal exception.
+
+        Args:
+            max_instrs: Stop after this many instructions have been retired in total.
+            max_cycles: Stop after this many machine cycles have been run in total.
+        """
+        if self.stats.halt == Halt.FATAL:
+            return self.stats
+        self._max_instrs = max_instrs
+        self._max_cycles = max_cycles
+        self.stats.halt = Halt.NONE
+
+        start = time.perf_counter()
+        self._running = True
+        while self._running or not self._parked:
+            self._sim.advance()
+        self.stats.seconds += time.perf_counter() - start
+        return self.stats
+
+    def checkpoint(self) -> Checkpoint:
+        """Returns a checkpoint of the machine. The memory is shared, not copied."""
+        values = {}
+
+        def read():
+            for name, sig in self._state_signals.items():
+                values[name] = yield sig
+
+        self._while_parked(read)
+        st = CPUState()
+        for name in CPUState.FIELDS:
+            setattr(st, name, values[name])
+        st.regs = array("I", [values[f"x_bank[{i}]"] for i in range(64)])
+        # Register 0 of each page is written like any other, but reads as zero.
+        st.regs[0] = st.regs[32] = 0
+        ckpt = Checkpoint.take(self, st)
+        ckpt.z_2_lsb0 = values["z_2_lsb0"]
+        ckpt.latches = array("I", [values[name] for name in LATCHES])
+        ckpt.instr_pc = self._instr_pc if self._instr_pc >= 0 else None
+        return ckpt
+
+    def restore(self, ckpt: Checkpoint):
+        """Carries on from a checkpoint, sharing its memory.
+
+        Both register file banks get the checkpoint's registers.
+        """
+        values = {name: getattr(ckpt.state, name) for name in CPUState.FIELDS}
+        for i in range(64):
+            values[f"x_bank[{i}]"] = values[f"y_bank[{i}]"] = ckpt.state.regs[i]
+        values["z_2_lsb0"] = ckpt.z_2_lsb0
+        values.update(zip(LATCHES, ckpt.latches))
+
+        def write():
+            for name, sig in self._state_signals.items():
+                yield sig.eq(values[name])
+            yield Settle()
+
+        self._while_parked(write)
+        ckpt.restore_run(self)
+        self._instr_pc = ckpt.instr_pc if ckpt.instr_pc is not None else -1
+        self._retired_pc = None
+
+    def _while_parked(self, request: Callable[[], Generator]):
+        """Runs a process at the start of the current machine cycle."""
+        while not self._parked:
+            self._sim.advance()
+        self._request = request
+        while self._request is not None:
+            self._sim.advance()
+
+    def _process(self):
+        yield Settle()
+        phase = 0
+        while True:
+            if phase == 0:
+                yield from self._start_cycle()
+            elif phase == 5:
+                yield from self._end_cycle()
+            # One period of the sync clock, ending just after the rising edge.
+            yield self._clk.eq(0)
+            yield Delay(_HALF_PERIOD)
+            yield self._clk.eq(1)
+            yield Delay(_HALF_PERIOD)
+            if self.wave is not None:
+                yield from self.wave.sample(self._ticks)
+            self._ticks += 1
+            phase = 0 if phase == 5 else phase + 1
+
+    def _start_cycle(self):
+        """Stops if the simulation halted, and serves the memory read for the machine cycle."""
+        cpu = self.cpu
+        stats = self.stats
+        if self._retired_pc is not None:
+            self._instr_pc = yield cpu.seq.state._pc
+            # Like the other engines, a self-loop takes precedence over a limit
+            # reached by the same instruction.
+            if (self.halt_on_self_loop and self._instr_pc == self._retired_pc and
+                    stats.halt in (Halt.NONE, Halt.MAX_INSTRS, Halt.MAX_CYCLES)):
+                mstatus = yield cpu.irq._mstatus
+                mie = yield cpu.irq._mie
+                if not irq_can_wake(mstatus, mie):
+                    stats.halt = Halt.SELF_LOOP
+            self._retired_pc = None
+
+        if stats.halt != Halt.NONE:
+            self._running = False
+        while not self._running:
+            self._parked = True
+            if self._request is not None:
+                yield from self._request()
+                self._request = None
+            yield Delay(_HALF_PERIOD)
+        self._parked = False
+
+        devices = self.devices
+        if devices is not None and stats.cycles >= devices.next_event:
+            devices.update(stats.cycles)
+        addr = yield cpu.memaddr
+        data = self.memory.read_word(addr)
+        yield cpu.memdata_rd.eq(data)
+        if self.trace is not None:
+            yield from self._trace_cycle_start(data)
+        yield cpu.csr_rd_data.eq(self.csr_rd_data)
+        yield cpu.time_irq.eq(1 if self.time_irq else 0)
+        yield cpu.ext_irq.eq(1 if self.ext_irq else 0)
+
+    def _read_reg(self, page: int, num: int):
+        """Reads a register, which reads as zero if it is x0."""
+        if num == 0:
+            return 0
+        return (yield self._state_signals[f"x_bank[{page * 32 + num}]"])
+
+    def _trace_cycle_start(self, fetched: int):
+        """Notes what the trace needs if an instruction starts in this machine cycle."""
+        sigs = self._state_signals
+        if (yield sigs["instr_phase"]) or (yield sigs["trap"]):
+            return
+        page = yield sigs["reg_page"]
+        self._trace_start = ((yield sigs["pc"]), fetched,
+                             (yield from self._read_reg(page, (fetched >> 15) & 0x1F)),
+                             (yield from self._read_reg(page, (fetched >> 20) & 0x1F)))
+
+    def _trace_instr(self):
+        """Adds the trace record of the instruction or trap entry completing in this machine cycle."""
+        sigs = self._state_signals
+        cycles = self.stats.cycles
+        if (yield sigs["trap"]):
+            self.trace.add(trap_record(cycles, (yield sigs["mepc"]), (yield sigs["mcause"]),
+                                       (yield sigs["mtval"])))
+            return
+        pc, instr, rs1_data, rs2_data = self._trace_start
+        page = yield sigs["reg_page"]
+        rd_data = yield from self._read_reg(page, (instr >> 7) & 0x1F)
+        field = CSR_FIELDS.get(instr >> 20)
+        csr_data = (yield sigs[field]) if field is not None else self.csr_rd_data
+        self.trace.add(instr_record(cycles, pc, instr, rs1_data, rs2_data, rd_data,
+                                    lambda _: csr_data, self.memory.read_word))
+
+    def _count_coverage(self):
+        """Counts the addresses of the ROMs in control in this machine cycle."""
+        coverage = self.coverage
+        addrs = self._rom_addresses
+        if (yield self.cpu.seq.enable_sequencer_rom):
+            coverage.sequencer_rom[(yield addrs["sequencer_rom"])] += 1
+            coverage.irq_load_rom[(yield addrs["irq_load_rom"])] += 1
+        else:
+            coverage.trap_rom[(yield addrs["trap_rom"])] += 1
+
+    def _end_cycle(self):
+        """Commits memory writes and accounts for the machine cycle."""
+        cpu = self.cpu
+        stats = self.stats
+        stats.cycles += 1
+        if self.coverage is not None:
+            yield from self._count_coverage()
+
+        if (yield cpu.mem_wr):
+            addr = yield cpu.memaddr
+            data = yield cpu.memdata_wr
+            self.memory.write_word(addr, data, (yield cpu.mem_wr_mask))
+            if self.tohost is not None and (addr & ~3) == (self.tohost & ~3):
+                stats.exit_code = data >> 1
+                stats.halt = Halt.TOHOST
+
+        if (yield cpu.instr_complete):
+            if self.trace is not None:
+                yield from self._trace_instr()
+            if (yield cpu.trap):
+                stats.traps += 1
+                # The handler's first instruction is never a self-loop.
+                self._instr_pc = -1
+            else:
+                stats.instrs += 1
+            self._retired_pc = self._instr_pc
+
+        if (yield cpu.fatal):
+            stats.halt = Halt.FATAL
+        elif stats.halt == Halt.NONE:
+            if self._max_instrs is not None and stats.instrs >= self._max_instrs:
+                stats.halt = Halt.MAX_INSTRS
+            elif self._max_cycles is not None and stats.cycles >= self._max_cycles:
+                stats.halt = Halt.MAX_CYCLES
+
+
+def probe_capture(cpu: FormalCPU, path: str, names: Sequence[str],
+                  triggers: Sequence[str] = (), **kwargs) -> WaveCapture:
+    """Returns a WaveCapture of some of the CPU's probe signals.
+
+    The signals are put in VCD scopes named after their groups. Signals that
+    triggers are on are captured even if names doesn't select them.
+
+    Args:
+        cpu: The CPU.
+        path: The VCD file for the first window.
+        names: Groups of FormalCPU.probe_signals, and signal names.
+        triggers: The triggers, as name or name=value.
+        kwargs: Passed on to WaveCapture.
+    """
+    groups = cpu.probe_signals()
+    scoped = {name: f"{group}.{name}" for group, sigs in groups.items() for name in sigs}
+    selected = []
+    for name in names:
+        if name in groups:
+            selected.extend(groups[name])
+        elif name in scoped:
+            selected.append(name)
+        else:
+            raise ValueError(f"{name} is neither a probe group nor a probe signal")
+    parsed = [Trigger.parse(spec) for spec in triggers]
+    for trigger in parsed:
+        if trigger.name not in scoped:
+            raise ValueError(f"trigger {trigger} is on {trigger.name}, which isn't a probe signal")
+        selected.append(trigger.name)
+        trigger.name = scoped[trigger.name]
+    signals = {}
+    for name in selected:
+        group, _, _ = scoped[name].partition(".")
+        signals[scoped[name]] = groups[group][name]
+    return WaveCapture(signals, path, parsed, **kwargs)
+
+
+# The simulators selectable with --engine. Each takes the memory and tohost
+# address, has run(max_instrs, max_cycles) returning its SimStats, and has
+# checkpoint() and restore(checkpoint).
+ENGINES = {
+    "pysim": CPUSim,
+    "iss": ISS,
+    "microcode": MicrocodeSim,
+    "cxxrtl": CXXRTLSim,
+}
+
+
+def sim_main(argv: List[str]):
+    """Loads a program image, runs it, and prints the statistics.
+
+    Args:
+        argv: The command line arguments after "sim".
+    """
+    parser = argparse.ArgumentParser(prog="formal_cpu.py sim",
+                                     description="Runs an RV32I program on FormalCPU.")
+    parser.add_argument("image", nargs="?", help="flat binary image to load")
+    parser.add_argument("--base", type=lambda s: int(s, 0), default=0,
+                        help="load address of the image (default 0, the reset PC)")
+    parser.add_argument("--tohost", type=lambda s: int(s, 0), default=None,
+                        help="halt when the program writes to this address")
+    parser.add_argument("--max-instrs", type=int, default=None,
+                        help="halt after this many retired instructions")
+    parser.add_argument("--max-cycles", type=int, default=None,
+                        help="halt after this many machine cycles")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="pysim",
+                        help="simulator to run the program on (default pysim)")
+    parser.add_argument("--restore", metavar="FILE", default=None,
+                        help="carry on from a checkpoint instead of loading an image")
+    parser.add_argument("--save", metavar="FILE", default=None,
+                        help="save a checkpoint when the simulation halts")
+    parser.add_argument("--timer", metavar="ADDR", type=lambda s: int(s, 0), default=None,
+                        help="map an mtime/mtimecmp timer driving time_irq at this address")
+    parser.add_argument("--uart", metavar="ADDR", type=lambda s: int(s, 0), default=None,
+                        help="map a UART sending to stdout at this address")
+    parser.add_argument("--uart-rx", metavar="FILE", default=None,
+                        help="file or pipe the UART receives from")
+    parser.add_argument("--irq-source", metavar="ADDR", type=lambda s: int(s, 0), default=None,
+                        help="map a programmable ext_irq source at this address")
+    parser.add_argument("--trace", metavar="FILE", default=None,
+                        help="write a binary instruction trace to this file")
+    parser.add_argument("--trace-compression", choices=COMPRESSIONS, default="none",
+                        help="compression of the trace blocks (default none)")
+    parser.add_argument("--profile", action="store_true",
+                        help="print machine cycles per instruction by opcode and per trap entry")
+    parser.add_argument("--pc-sample", metavar="N", type=int, default=None,
+                        help="sample the PC every N machine cycles, or every retired "
+                        "instruction if N is 0, and print a flat profile")
+    parser.add_argument("--symbols", metavar="ELF", default=None,
+                        help="ELF file whose symbols map sampled PCs to functions")
+    parser.add_argument("--collapsed", metavar="FILE", default=None,
+                        help="write the PC samples by call stack for flame graphs")
+    parser.add_argument("--coverage", metavar="FILE", default=None,
+                        help="write the microcode coverage to this .npz file")
+    parser.add_argument("--wave", metavar="FILE", default=None,
+                        help="write a VCD window around a trigger to this file (pysim only)")
+    parser.add_argument("--wave-signals", metavar="LIST", default="bus,state,rom",
+                        help="probe groups and signals to capture (default bus,state,rom)")
+    parser.add_argument("--wave-trigger", metavar="SPEC", action="append", default=[],
+                        help="a signal rising (name) or taking a value (name=value); "
+                        "without one, the window is the end of the run")
+    parser.add_argument("--wave-depth", metavar="N", type=int, default=1024,
+                        help="sync clock periods kept before the trigger (default 1024)")
+    parser.add_argument("--wave-post", metavar="N", type=int, default=None,
+                        help="sync clock periods captured after the trigger "
+                        "(default a quarter of the depth)")
+    parser.add_argument("--wave-windows", metavar="N", type=int, default=1,
+                        help="number of windows to write (default 1)")
+    args = parser.parse_args(argv)
+    if (args.image is None) == (args.restore is None):
+        parser.error("give either an image or --restore")
+    if args.wave is not None and args.engine != "pysim":
+        parser.error("--wave needs the pysim engine")
+    if (args.symbols is not None or args.collapsed is not None) and args.pc_sample is None:
+        parser.error("--symbols and --collapsed need --pc-sample")
+    if args.coverage is not None and args.engine == "iss":
+        parser.error("--coverage needs an engine that runs the microcode")
+
+    memory = MainMemory()
+    if args.image is not None:
+        memory.load_file(args.image, args.base)
+    sim = ENGINES[args.engine](memory, tohost=args.tohost)
+    if args.restore is not None:
+        sim.restore(load_checkpoint(args.restore))
+
+    devices: List[Device] = []
+    if args.timer is not None:
+        devices.append(Timer(args.timer))
+    if args.uart is not None:
+        rx = open(args.uart_rx, "rb") if args.uart_rx is not None else None
+        devices.append(UART(args.uart, tx=sys.stdout.buffer, rx=rx))
+    if args.irq_source is not None:
+        devices.append(IrqSource(args.irq_source))
+    if devices:
+        DeviceBus(sim.memory, devices).attach(sim)
+
+    if args.trace is not None:
+        sim.trace = TraceWriter(args.trace, args.trace_compression)
+    profiler = None
+    if args.profile:
+        profiler = sim.trace = Profiler(sim.stats.cycles, then=sim.trace)
+    sampler = None
+    if args.pc_sample is not None:
+        symbols = SymbolTable.from_elf(args.symbols) if args.symbols is not None else None
+        sampler = sim.trace = PCSampler(args.pc_sample, symbols, sim.stats.cycles,
+                                        then=sim.trace)
+    if args.coverage is not None:
+        sim.coverage = RomCoverage()
+    if args.wave is not None:
+        try:
+            sim.wave = probe_capture(sim.cpu, args.wave, args.wave_signals.split(","),
+                                     args.wave_trigger, depth=args.wave_depth,
+                                     post=args.wave_post, max_windows=args.wave_windows)
+        except ValueError as e:
+            parser.error(str(e))
+    try:
+        stats = sim.run(max_instrs=args.max_instrs, max_cycles=args.max_cycles)
+    finally:
+        if sim.trace is not None:
+            sim.trace.close()
+        if args.wave is not None:
+            sim.wave.close()
+            for path in sim.wave.written:
+                print(f"Wrote {path}")
+    print(stats.report())
+    if profiler is not None:
+        print(profiler.report())
+    if sampler is not None:
+        print(sampler.report())
+        if args.collapsed is not None:
+            sampler.write_collapsed(args.collapsed)
+    if args.coverage is not None:
+        sim.coverage.save(args.coverage)
+    if args.save is not None:
+        save_checkpoint(sim.checkpoint(), args.save)
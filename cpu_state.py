@@ -0,0 +1,133 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module provides the state and statistics shared by the CPU simulators.
+"""
+from array import array
+from enum import IntEnum, unique
+from typing import List, Optional
+
+from consts import MInterrupt, MStatus
+
+
+@unique
+class Halt(IntEnum):
+    """Why a simulation stopped."""
+    NONE = 0
+    # The CPU took a fatal exception, and is now hung in the trap sequence.
+    FATAL = 1
+    # The program wrote to the tohost address.
+    TOHOST = 2
+    # The program jumped to itself with interrupts disabled, for example with "j .".
+    SELF_LOOP = 3
+    MAX_INSTRS = 4
+    MAX_CYCLES = 5
+
+
+class SimStats:
+    """Statistics for a simulation run.
+
+    Attributes:
+        instrs: The number of instructions retired. Trap entries are not counted,
+            and neither are instructions that raise exceptions (including ECALL
+            and EBREAK), since those never assert instr_complete.
+        cycles: The number of machine cycles run. A machine cycle is six phases.
+        traps: The number of trap entries.
+        seconds: The wall-clock time spent running.
+        halt: Why the simulation stopped.
+        exit_code: The value written to tohost, shifted right by one as in riscv-tests.
+    """
+
+    def __init__(self):
+        self.instrs = 0
+        self.cycles = 0
+        self.traps = 0
+        self.seconds = 0.0
+        self.halt = Halt.NONE
+        self.exit_code: Optional[int] = None
+
+    @property
+    def instrs_per_sec(self) -> float:
+        """Instructions retired per wall-clock second."""
+        return self.instrs / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def cycles_per_instr(self) -> float:
+        """Average machine cycles per retired instruction."""
+        return self.cycles / self.instrs if self.instrs > 0 else 0.0
+
+    def report(self) -> str:
+        """Returns a human-readable summary of the run."""
+        lines = [
+            f"halt: {self.halt.name}",
+            f"instructions retired: {self.instrs}",
+            f"machine cycles: {self.cycles} (CPI {self.cycles_per_instr:.2f})",
+            f"trap entries: {self.traps}",
+            f"wall time: {self.seconds:.3f} s ({self.instrs_per_sec:.1f} instr/s)",
+        ]
+        if self.exit_code is not None:
+            lines.insert(1, f"exit code: {self.exit_code}")
+        return "\n".join(lines)
+
+
+# The RegCard latches, in checkpoint order. Only the gateware simulators model them.
+LATCHES = ("x_latch", "y_latch", "x_bank_wr_latch", "y_bank_wr_latch")
+
+
+def irq_can_wake(mstatus: int, mie: int) -> bool:
+    """Returns whether an interrupt could still be taken with the given CSRs."""
+    return bool((mstatus >> MStatus.MIE) & 1 and
+                mie & ((1 << MInterrupt.MTI) | (1 << MInterrupt.MEI)))
+
+
+class CPUState:
+    """The register state of the whole CPU, as plain integers.
+
+    The fields follow SequencerState, followed by the ExcCard and IrqCard
+    CSRs and the register file, with the leading underscores dropped.
+    Every simulator can read and write its state in this form.
+
+    The register file holds both 32-register pages, like RegCard. Register 0
+    of each page always reads as zero.
+    """
+
+    # SequencerState, in order.
+    SEQUENCER_FIELDS = ("pc", "instr_phase", "instr", "stored_alu_eq", "stored_alu_lt",
+                        "stored_alu_ltu", "memaddr", "memdata_wr", "tmp", "reg_page",
+                        "trap", "exception", "fatal", "mtvec")
+    EXC_FIELDS = ("mcause", "mepc", "mtval")
+    IRQ_FIELDS = ("mstatus", "mie", "mip")
+    FIELDS = SEQUENCER_FIELDS + EXC_FIELDS + IRQ_FIELDS
+
+    __slots__ = FIELDS + ("regs",)
+
+    def __init__(self):
+        for name in self.FIELDS:
+            setattr(self, name, 0)
+        self.regs = array("I", [0] * 64)
+
+    def copy(self) -> "CPUState":
+        """Returns a deep copy of the state."""
+        other = CPUState()
+        for name in self.FIELDS:
+            setattr(other, name, getattr(self, name))
+        other.regs = array("I", self.regs)
+        return other
+
+    def diff(self, other: "CPUState", fields: Optional[List[str]] = None) -> List[str]:
+        """Returns descriptions of the differences between two states.
+
+        Args:
+            other: The state to compare against.
+            fields: The fields to compare. Defaults to all of them, plus the registers.
+        """
+        out = []
+        for name in fields if fields is not None else self.FIELDS:
+            a, b = getattr(self, name), getattr(other, name)
+            if a != b:
+                out.append(f"{name}: {a:#010x} != {b:#010x}")
+        for i in range(1, 64):
+            if i % 32 != 0 and self.regs[i] != other.regs[i]:
+                out.append(f"x{i % 32}{'' if i < 32 else ' (page 1)'}: "
+                           f"{self.regs[i]:#010x} != {other.regs[i]:#010x}")
+        return out
@@ -0,0 +1,489 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+# Disable protected access warnings
+# pylint: disable=W0212
+"""
+This module runs programs on FormalCPU compiled with Yosys' CXXRTL backend.
+
+The CPU, with the same clock generator CPUSim uses, is converted to RTLIL,
+translated to C++ with write_cxxrtl, and compiled together with a small C
+shim into a shared library that is driven through ctypes. It needs yosys
+and a C++ compiler on the PATH; set CXX and CXXFLAGS to override the
+compiler and its flags.
+
+Compiling takes a while, so the libraries are cached in .cxxrtl_cache,
+keyed by a hash of the source tree, the compiler settings and the chips
+flag of SequencerCard. Select it with --engine cxxrtl.
+"""
+import ctypes
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from array import array
+from typing import Dict, Optional
+
+from nmigen import Elaboratable, Module, Signal, Value
+from nmigen.back import rtlil
+from nmigen.build import Platform
+from nmigen.hdl.ir import Fragment
+
+from checkpoint import Checkpoint
+from cpu_state import LATCHES, CPUState, Halt, SimStats, irq_can_wake
+from formal_cpu import FormalCPU
+from rom_coverage import RomCoverage, rom_addresses
+from sim_devices import DeviceBus
+from sim_memory import MainMemory
+from sim_trace import CSR_FIELDS, TraceWriter, instr_record, trap_record
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cxxrtl_cache")
+
+# The C ABI around the generated design. Ports are looked up by name once,
+# then read and written by index. Inputs are wires, whose new value goes in
+# next and takes effect on the following step.
+_SHIM = r"""
+#include "top.cc"
+
+#include <cstdint>
+#include <vector>
+
+namespace {
+
+struct Sim {
+    cxxrtl_design::p_top top;
+    cxxrtl::debug_items items;
+    std::vector<cxxrtl::debug_item *> ports;
+};
+
+}  // namespace
+
+extern "C" {
+
+void *cpu_create() {
+    Sim *sim = new Sim;
+    static_cast<cxxrtl::module &>(sim->top).debug_info(sim->items, "");
+    return sim;
+}
+
+void cpu_destroy(void *handle) {
+    delete static_cast<Sim *>(handle);
+}
+
+int cpu_lookup(void *handle, const char *name) {
+    Sim *sim = static_cast<Sim *>(handle);
+    if (sim->items.table.count(name) == 0)
+        return -1;
+    sim->ports.push_back(&sim->items.at(name));
+    return (int)sim->ports.size() - 1;
+}
+
+void cpu_set(void *handle, int port, uint32_t value) {
+    cxxrtl::debug_item *item = static_cast<Sim *>(handle)->ports[port];
+    (item->next ? item->next : item->curr)[0] = value;
+}
+
+uint32_t cpu_get(void *handle, int port) {
+    return static_cast<Sim *>(handle)->ports[port]->curr[0];
+}
+
+void cpu_step(void *handle) {
+    static_cast<Sim *>(handle)->top.step();
+}
+
+}  // extern "C"
+"""
+
+
+class CXXRTLTop(Elaboratable):
+    """FormalCPU and its clock generator, with the signals the harness needs as ports.
+
+    Attributes:
+        cpu: The CPU.
+    """
+
+    INPUTS = ("memdata_rd", "csr_rd_data", "time_irq", "ext_irq")
+    OUTPUTS = ("memaddr", "mem_wr", "mem_wr_mask", "memdata_wr", "instr_complete", "trap",
+               "fatal", "pc", "mstatus", "mie", "enable_sequencer_rom", "sequencer_rom_addr",
+               "trap_rom_addr", "irq_load_rom_addr")
+
+    def __init__(self, chips: bool = True):
+        self.cpu = FormalCPU(chips=chips)
+        self._rom_addresses = rom_addresses(self.cpu.seq)
+        for name in self.INPUTS + self.OUTPUTS:
+            setattr(self, name, Signal(len(self._source(name)), name=name))
+        # The state signals get public names, so that CXXRTL makes debug items
+        # for them, through which checkpoints are taken and restored.
+        self.state = self.cpu.state_signals()
+        for name, sig in self.state.items():
+            sig.name = "state_" + name.replace("[", "_").rstrip("]")
+
+    def _source(self, name: str) -> Value:
+        cpu = self.cpu
+        if name.endswith("_rom_addr"):
+            return self._rom_addresses[name[:-len("_addr")]]
+        if name == "enable_sequencer_rom":
+            return cpu.seq.enable_sequencer_rom
+        if name == "pc":
+            return cpu.seq.state._pc
+        if name == "mstatus":
+            return cpu.irq._mstatus
+        if name == "mie":
+            return cpu.irq._mie
+        return getattr(cpu, name)
+
+    def ports(self):
+        """Returns the top-level ports."""
+        return [getattr(self, name) for name in self.INPUTS + self.OUTPUTS]
+
+    def elaborate(self, _: Platform) -> Module:
+        """Implements the top level."""
+        m = Module()
+        m.submodules.cpu = self.cpu
+        _, mcycle_end = FormalCPU.make_clock(m)
+        m.d.comb += self.cpu.mcycle_end.eq(mcycle_end)
+        m.d.comb += [self._source(name).eq(getattr(self, name)) for name in self.INPUTS]
+        m.d.comb += [getattr(self, name).eq(self._source(name)) for name in self.OUTPUTS]
+        return m
+
+
+def _compiler():
+    return os.environ.get("CXX", "c++"), os.environ.get("CXXFLAGS", "-O2").split()
+
+
+def build_key(chips: bool) -> str:
+    """Returns the cache key for the library built with the given chips flag."""
+    h = hashlib.sha256()
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(src_dir, "*.py"))):
+        with open(path, "rb") as f:
+            h.update(os.path.basename(path).encode() + b"\0" + f.read() + b"\0")
+    cxx, cxxflags = _compiler()
+    h.update(repr((chips, cxx, cxxflags)).encode())
+    return h.hexdigest()[:16]
+
+
+def state_items_path(library: str) -> str:
+    """Returns the path of the file naming the state debug items of a built library."""
+    return os.path.splitext(library)[0] + ".state.json"
+
+
+def build_library(chips: bool = True, cache_dir: str = DEFAULT_CACHE_DIR,
+                  verbose: bool = False) -> str:
+    """Builds the CXXRTL library for the CPU if it isn't cached, and returns its path.
+
+    Args:
+        chips: Passed on to SequencerCard.
+        cache_dir: The directory holding the built libraries.
+        verbose: Print the build steps.
+    """
+    path = os.path.join(cache_dir, f"formal_cpu-{'chips' if chips else 'nochips'}-"
+                        f"{build_key(chips)}.so")
+    if os.path.exists(path):
+        return path
+
+    yosys = shutil.which("yosys")
+    yosys_config = shutil.which("yosys-config")
+    if yosys is None or yosys_config is None:
+        raise RuntimeError("yosys and yosys-config were not found, but the cxxrtl engine "
+                           "needs them")
+    datdir = subprocess.run([yosys_config, "--datdir"], check=True,
+                            capture_output=True, text=True).stdout.strip()
+    cxx, cxxflags = _compiler()
+
+    top = CXXRTLTop(chips=chips)
+    fragment = Fragment.get(top, None).prepare(ports=top.ports())
+    il_text, name_map = rtlil.convert_fragment(fragment)
+    # The debug item names of the state signals: their hierarchical names,
+    # below the top module, separated by spaces.
+    state_items = {name: " ".join(name_map[sig][1:]) for name, sig in top.state.items()}
+    with tempfile.TemporaryDirectory() as build_dir:
+        with open(os.path.join(build_dir, "top.il"), "w") as f:
+            f.write(il_text)
+        with open(os.path.join(build_dir, "shim.cc"), "w") as f:
+            f.write(_SHIM)
+
+        commands = [
+            [yosys, "-q", "-p", "read_rtlil top.il; hierarchy -top top; write_cxxrtl top.cc"],
+            [cxx, "-std=c++14", *cxxflags, "-shared", "-fPIC",
+             "-I", os.path.join(datdir, "include"),
+             "-I", os.path.join(datdir, "include", "backends", "cxxrtl", "runtime"),
+             "-o", "cpu.so", "shim.cc"],
+        ]
+        for command in commands:
+            if verbose:
+                print(" ".join(command))
+            result = subprocess.run(command, cwd=build_dir, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(f"{command[0]} failed:\n{result.stdout}{result.stderr}")
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + ".state.tmp", "w", encoding="utf-8") as f:
+            json.dump(state_items, f, indent=1)
+        os.replace(path + ".state.tmp", state_items_path(path))
+        tmp_path = path + ".tmp"
+        shutil.copyfile(os.path.join(build_dir, "cpu.so"), tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+
+class CXXRTLSim:
+    """Runs programs on FormalCPU compiled with CXXRTL.
+
+    This works like CPUSim: memory reads are served at the start of each
+    machine cycle from memaddr, and memory writes, retirement and fatal
+    exceptions are sampled at the end of each machine cycle.
+
+    Attributes:
+        memory: The main memory.
+        stats: Statistics for the runs so far.
+        tohost: If not None, a write to this address halts the simulation.
+        halt_on_self_loop: Halt when an instruction jumps to itself while no
+            interrupt can be taken.
+        time_irq: The level of the timer interrupt line.
+        ext_irq: The level of the external interrupt line.
+        csr_rd_data: The value read from CSRs that the CPU doesn't implement.
+        devices: The DeviceBus driving the interrupt lines, if one is attached.
+        trace: The TraceWriter to add a record to for each retired instruction
+            and trap entry, if any.
+        coverage: The RomCoverage to count the ROM addresses of each machine
+            cycle in, if any.
+    """
+
+    def __init__(self, memory: MainMemory, tohost: Optional[int] = None,
+                 halt_on_self_loop: bool = True, chips: bool = True,
+                 cache_dir: str = DEFAULT_CACHE_DIR):
+        self.memory = memory
+        self.stats = SimStats()
+        self.tohost = tohost
+        self.halt_on_self_loop = halt_on_self_loop
+        self.time_irq = 0
+        self.ext_irq = 0
+        self.csr_rd_data = 0
+        self.devices: Optional[DeviceBus] = None
+        self.trace: Optional[TraceWriter] = None
+        self.coverage: Optional[RomCoverage] = None
+
+        library = build_library(chips, cache_dir)
+        with open(state_items_path(library), encoding="utf-8") as f:
+            self._state_items: Dict[str, str] = json.load(f)
+        lib = ctypes.CDLL(library)
+        lib.cpu_create.restype = ctypes.c_void_p
+        lib.cpu_destroy.argtypes = [ctypes.c_void_p]
+        lib.cpu_lookup.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        lib.cpu_lookup.restype = ctypes.c_int
+        lib.cpu_set.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_uint32]
+        lib.cpu_get.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.cpu_get.restype = ctypes.c_uint32
+        lib.cpu_step.argtypes = [ctypes.c_void_p]
+        self._lib = lib
+        self._handle = lib.cpu_create()
+
+        self._ports = {}
+        self._state_ports: Dict[str, int] = {}
+        for name in ("clk", "rst") + CXXRTLTop.INPUTS + CXXRTLTop.OUTPUTS:
+            port = lib.cpu_lookup(self._handle, name.encode())
+            if port < 0:
+                raise RuntimeError(f"The compiled design has no port {name}")
+            self._ports[name] = port
+        lib.cpu_step(self._handle)
+
+        self._phase = 0
+        self._instr_pc = 0
+        self._retired_pc: Optional[int] = None
+        # The PC, instruction, and values of rs1 and rs2 when the instruction
+        # started, for the trace.
+        self._trace_start = (0, 0, 0, 0)
+
+    def __del__(self):
+        if getattr(self, "_handle", None):
+            self._lib.cpu_destroy(self._handle)
+            self._handle = None
+
+    def _state_port(self, name: str) -> int:
+        """Returns the port of a state signal, looking it up the first time."""
+        port = self._state_ports.get(name)
+        if port is None:
+            port = self._lib.cpu_lookup(self._handle, self._state_items[name].encode())
+            if port < 0:
+                raise RuntimeError(f"The compiled design has no debug item for {name}")
+            self._state_ports[name] = port
+        return port
+
+    def checkpoint(self) -> Checkpoint:
+        """Returns a checkpoint of the machine. The memory is shared, not copied.
+
+        Between runs the design rests at the start of a machine cycle, so the
+        registers already hold the checkpoint state.
+        """
+        lib, handle = self._lib, self._handle
+        values = {name: lib.cpu_get(handle, self._state_port(name)) for name in self._state_items}
+        st = CPUState()
+        for name in CPUState.FIELDS:
+            setattr(st, name, values[name])
+        st.regs = array("I", [values[f"x_bank[{i}]"] for i in range(64)])
+        # Register 0 of each page is written like any other, but reads as zero.
+        st.regs[0] = st.regs[32] = 0
+        ckpt = Checkpoint.take(self, st)
+        ckpt.z_2_lsb0 = values["z_2_lsb0"]
+        ckpt.latches = array("I", [values[name] for name in LATCHES])
+        ckpt.instr_pc = self._instr_pc if self._instr_pc >= 0 else None
+        return ckpt
+
+    def restore(self, ckpt: Checkpoint):
+        """Carries on from a checkpoint, sharing its memory.
+
+        Both register file banks get the checkpoint's registers.
+        """
+        values = {name: getattr(ckpt.state, name) for name in CPUState.FIELDS}
+        for i in range(64):
+            values[f"x_bank[{i}]"] = values[f"y_bank[{i}]"] = ckpt.state.regs[i]
+        values["z_2_lsb0"] = ckpt.z_2_lsb0
+        values.update(zip(LATCHES, ckpt.latches))
+
+        # The new values go in next, and the step commits them.
+        lib, handle = self._lib, self._handle
+        for name, value in values.items():
+            lib.cpu_set(handle, self._state_port(name), value)
+        lib.cpu_step(handle)
+        ckpt.restore_run(self)
+        self._instr_pc = ckpt.instr_pc if ckpt.instr_pc is not None else -1
+        self._retired_pc = None
+
+    def _get(self, name: str) -> int:
+        return self._lib.cpu_get(self._handle, self._ports[name])
+
+    def _set(self, name: str, value: int):
+        self._lib.cpu_set(self._handle, self._ports[name], value)
+
+    def _get_state(self, name: str) -> int:
+        return self._lib.cpu_get(self._handle, self._state_port(name))
+
+    def _read_reg(self, page: int, num: int) -> int:
+        """Reads a register, which reads as zero if it is x0."""
+        return self._get_state(f"x_bank[{page * 32 + num}]") if num else 0
+
+    def run(self, max_instrs: Optional[int] = None,
+            max_cycles: Optional[int] = None) -> SimStats:
+        """Runs until the program halts or a limit is reached.
+
+        A halted simulation can be resumed by calling run again with higher
+        limits, unless it halted because of a fatal exception.
+
+        Args:
+            max_instrs: Stop after this many instructions have been retired in total.
+            max_cycles: Stop after this many machine cycles have been run in total.
+        """
+        stats = self.stats
+        if stats.halt != Halt.FATAL:
+            stats.halt = Halt.NONE
+
+        lib, handle = self._lib, self._handle
+        clk = self._ports["clk"]
+        start = time.perf_counter()
+        while True:
+            if self._phase == 0:
+                # Halted runs stop at the start of a machine cycle.
+                self._check_self_loop()
+                if stats.halt != Halt.NONE:
+                    break
+                self._start_cycle()
+            elif self._phase == 5:
+                self._end_cycle(max_instrs, max_cycles)
+            # One period of the sync clock.
+            lib.cpu_set(handle, clk, 1)
+            lib.cpu_step(handle)
+            lib.cpu_set(handle, clk, 0)
+            lib.cpu_step(handle)
+            self._phase = 0 if self._phase == 5 else self._phase + 1
+        stats.seconds += time.perf_counter() - start
+        return stats
+
+    def _check_self_loop(self):
+        """Halts if the instruction that just retired jumped to itself."""
+        if self._retired_pc is not None:
+            self._instr_pc = self._get("pc")
+            # A self-loop takes precedence over a limit reached by the same instruction.
+            if (self.halt_on_self_loop and self._instr_pc == self._retired_pc and
+                    self.stats.halt in (Halt.NONE, Halt.MAX_INSTRS, Halt.MAX_CYCLES)):
+                if not irq_can_wake(self._get("mstatus"), self._get("mie")):
+                    self.stats.halt = Halt.SELF_LOOP
+            self._retired_pc = None
+
+    def _start_cycle(self):
+        """Serves the memory read for the machine cycle."""
+        devices = self.devices
+        if devices is not None and self.stats.cycles >= devices.next_event:
+            devices.update(self.stats.cycles)
+        data = self.memory.read_word(self._get("memaddr"))
+        self._set("memdata_rd", data)
+        self._set("csr_rd_data", self.csr_rd_data)
+        self._set("time_irq", 1 if self.time_irq else 0)
+        self._set("ext_irq", 1 if self.ext_irq else 0)
+        self._lib.cpu_step(self._handle)
+        if (self.trace is not None and not self._get_state("instr_phase") and
+                not self._get_state("trap")):
+            page = self._get_state("reg_page")
+            self._trace_start = (self._get_state("pc"), data,
+                                 self._read_reg(page, (data >> 15) & 0x1F),
+                                 self._read_reg(page, (data >> 20) & 0x1F))
+
+    def _trace_instr(self):
+        """Adds the trace record of the instruction or trap entry completing in this machine cycle."""
+        cycles = self.stats.cycles
+        if self._get_state("trap"):
+            self.trace.add(trap_record(cycles, self._get_state("mepc"),
+                                       self._get_state("mcause"), self._get_state("mtval")))
+            return
+        pc, instr, rs1_data, rs2_data = self._trace_start
+        rd_data = self._read_reg(self._get_state("reg_page"), (instr >> 7) & 0x1F)
+        field = CSR_FIELDS.get(instr >> 20)
+        csr_data = self._get_state(field) if field is not None else self.csr_rd_data
+        self.trace.add(instr_record(cycles, pc, instr, rs1_data, rs2_data, rd_data,
+                                    lambda _: csr_data, self.memory.read_word))
+
+    def _count_coverage(self):
+        """Counts the addresses of the ROMs in control in this machine cycle."""
+        coverage = self.coverage
+        if self._get("enable_sequencer_rom"):
+            coverage.sequencer_rom[self._get("sequencer_rom_addr")] += 1
+            coverage.irq_load_rom[self._get("irq_load_rom_addr")] += 1
+        else:
+            coverage.trap_rom[self._get("trap_rom_addr")] += 1
+
+    def _end_cycle(self, max_instrs: Optional[int], max_cycles: Optional[int]):
+        """Commits memory writes and accounts for the machine cycle."""
+        stats = self.stats
+        stats.cycles += 1
+        if self.coverage is not None:
+            self._count_coverage()
+
+        if self._get("mem_wr"):
+            addr = self._get("memaddr")
+            data = self._get("memdata_wr")
+            self.memory.write_word(addr, data, self._get("mem_wr_mask"))
+            if self.tohost is not None and (addr & ~3) == (self.tohost & ~3):
+                stats.exit_code = data >> 1
+                stats.halt = Halt.TOHOST
+
+        if self._get("instr_complete"):
+            if self.trace is not None:
+                self._trace_instr()
+            if self._get("trap"):
+                stats.traps += 1
+                # The handler's first instruction is never a self-loop.
+                self._instr_pc = -1
+            else:
+                stats.instrs += 1
+            self._retired_pc = self._instr_pc
+
+        if self._get("fatal"):
+            stats.halt = Halt.FATAL
+        elif stats.halt == Halt.NONE:
+            if max_instrs is not None and stats.instrs >= max_instrs:
+                stats.halt = Halt.MAX_INSTRS
+            elif max_cycles is not None and stats.cycles >= max_cycles:
+                stats.halt = Halt.MAX_CYCLES
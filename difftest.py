@@ -0,0 +1,282 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module runs a cycle-level simulator and a reference ISS in lockstep,
+and stops at the first instruction where they disagree.
+
+Both simulators write trace records (see sim_trace.py) into memory: one for
+each retired instruction, with its PC, the cycle it completed in, the value
+it wrote to rd, its memory access or the CSR it accessed and that CSR's new
+value; and one for each trap entry, with mepc, mcause and mtval. Every
+change to the architectural state shows up in a record, so comparing the
+records compares the PC, registers, CSRs and memory writes incrementally,
+without diffing the whole state. The simulators run in chunks of
+instructions, and their records are compared after each chunk. At the end
+the register files and CSRs are compared in full once.
+
+On a divergence, the reference ISS is run again from the start to a few
+instructions before it, and saves a checkpoint there. That checkpoint is a
+short reproducer: run it again with --restore to replay the divergence.
+
+    python difftest.py <image.bin> [--base ADDR] [--tohost ADDR]
+        [--engine pysim|microcode|cxxrtl] [--ref iss|microcode]
+        [--max-instrs N] [--chunk N] [--repro FILE] [--context N]
+    python difftest.py --restore FILE [...]
+
+Devices aren't attached, since their side effects can't happen twice.
+"""
+import argparse
+import sys
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from checkpoint import load_checkpoint, save_checkpoint
+from cpu_sim import ENGINES
+from cpu_state import Halt
+from sim_memory import MainMemory
+from sim_trace import TRACE_DTYPE, TRAP, records_array
+
+
+class _Records:
+    """Collects the trace records of a simulator in memory.
+
+    It has the interface of TraceWriter that the simulators use, with blocks
+    too big to ever fill, so the records stay in records until taken.
+    """
+
+    def __init__(self):
+        self.records: List[int] = []
+        self.block_records = 1 << 62
+
+    def add(self, record):
+        self.records.extend(record)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def take(self) -> np.ndarray:
+        """Returns the records added since the last call, as an array of TRACE_DTYPE."""
+        records = self.records
+        self.records = []
+        return records_array(records)
+
+
+class Divergence:
+    """Where two simulators first disagreed.
+
+    Attributes:
+        index: The number of trace records before the one that differs.
+        instrs: The number of instructions the reference had retired in total
+            before it.
+        what: What differs.
+        dut: The device under test's record, or None.
+        ref: The reference's record, or None.
+    """
+
+    def __init__(self, index: int, instrs: int, what: str,
+                 dut: Optional[np.void] = None, ref: Optional[np.void] = None):
+        self.index = index
+        self.instrs = instrs
+        self.what = what
+        self.dut = dut
+        self.ref = ref
+
+    def report(self) -> str:
+        """Returns a human-readable description."""
+        lines = [f"divergence after {self.index} trace records "
+                 f"({self.instrs} instructions): {self.what}"]
+        for name, record in (("dut", self.dut), ("ref", self.ref)):
+            if record is not None:
+                lines.append(f"  {name}: " + " ".join(
+                    f"{field}={int(record[field]):#x}" for field in TRACE_DTYPE.names
+                    if field != "reserved"))
+        return "\n".join(lines)
+
+
+def _describe(dut: np.void, ref: np.void) -> str:
+    fields = [field for field in TRACE_DTYPE.names if dut[field] != ref[field]]
+    return ", ".join(fields) + " differ"
+
+
+class DiffTest:
+    """Runs a simulator and a reference simulator in lockstep.
+
+    The simulators need their own memories holding the same program.
+
+    Attributes:
+        dut: The simulator under test.
+        ref: The reference simulator.
+        chunk: The number of instructions run between comparisons.
+        records: The number of trace records compared so far.
+        instrs: The number of instructions the reference had retired in total
+            before the next record to compare.
+    """
+
+    def __init__(self, dut, ref, chunk: int = 1000):
+        self.dut = dut
+        self.ref = ref
+        self.chunk = chunk
+        self.records = 0
+        self.instrs = ref.stats.instrs
+        self._dut_records = dut.trace = _Records()
+        self._ref_records = ref.trace = _Records()
+        self._dut_pending = np.zeros(0, dtype=TRACE_DTYPE)
+        self._ref_pending = np.zeros(0, dtype=TRACE_DTYPE)
+
+    def run(self, max_instrs: Optional[int] = None) -> Optional[Divergence]:
+        """Runs until a divergence, a halt, or the instruction limit.
+
+        Returns:
+            The divergence, or None if there was none.
+        """
+        dut, ref = self.dut, self.ref
+        while True:
+            target = dut.stats.instrs + self.chunk
+            if max_instrs is not None:
+                target = min(target, max_instrs)
+            dut.run(max_instrs=target)
+            ref.run(max_instrs=target)
+            divergence = self._compare()
+            if divergence is not None:
+                return divergence
+            halts = (dut.stats.halt, ref.stats.halt)
+            if Halt.MAX_INSTRS not in halts or halts[0] != halts[1]:
+                break
+            if max_instrs is not None and target >= max_instrs:
+                break
+        if dut.stats.halt != ref.stats.halt:
+            return Divergence(self.records, self.instrs,
+                              f"dut halted with {dut.stats.halt.name}, "
+                              f"ref with {ref.stats.halt.name}")
+        return self._compare_state()
+
+    def _compare(self) -> Optional[Divergence]:
+        """Compares the records both simulators have made, keeping the rest for later."""
+        dut = np.concatenate([self._dut_pending, self._dut_records.take()])
+        ref = np.concatenate([self._ref_pending, self._ref_records.take()])
+        n = min(len(dut), len(ref))
+        differ = np.flatnonzero(dut[:n] != ref[:n])
+        if len(differ):
+            i = int(differ[0])
+            return Divergence(self.records + i, self.instrs + self._instrs_in(ref[:i]),
+                              _describe(dut[i], ref[i]), dut[i], ref[i])
+        self.records += n
+        self.instrs += self._instrs_in(ref[:n])
+        self._dut_pending = dut[n:]
+        self._ref_pending = ref[n:]
+        return None
+
+    @staticmethod
+    def _instrs_in(records: np.ndarray) -> int:
+        return int(np.count_nonzero(records["flags"] & TRAP == 0))
+
+    def _compare_state(self) -> Optional[Divergence]:
+        """Compares the records left over, then the registers and CSRs in full."""
+        dut, ref = self._dut_pending, self._ref_pending
+        if len(dut) != len(ref):
+            return Divergence(self.records, self.instrs,
+                              f"dut made {len(dut)} more trace records, ref {len(ref)}",
+                              dut[0] if len(dut) else None, ref[0] if len(ref) else None)
+        dut_state = self.dut.checkpoint().state
+        ref_state = self.ref.checkpoint().state
+        page = ref_state.reg_page * 32
+        for i in range(1, 32):
+            if dut_state.regs[page + i] != ref_state.regs[page + i]:
+                return Divergence(self.records, self.instrs,
+                                  f"x{i} is {dut_state.regs[page + i]:#x} in dut, "
+                                  f"{ref_state.regs[page + i]:#x} in ref")
+        for name in ("pc", "reg_page", "mtvec", "mcause", "mepc", "mtval",
+                     "mstatus", "mie", "mip"):
+            if getattr(dut_state, name) != getattr(ref_state, name):
+                return Divergence(self.records, self.instrs,
+                                  f"{name} is {getattr(dut_state, name):#x} in dut, "
+                                  f"{getattr(ref_state, name):#x} in ref")
+        return None
+
+
+def write_reproducer(make_ref: Callable[[], object], divergence: Divergence, path: str,
+                     context: int = 16) -> int:
+    """Saves a checkpoint a few instructions before a divergence.
+
+    Args:
+        make_ref: Returns a new reference simulator at the start of the run.
+        divergence: The divergence.
+        path: The checkpoint file to write.
+        context: The number of instructions to leave before the divergence.
+
+    Returns:
+        The number of instructions retired at the checkpoint.
+    """
+    ref = make_ref()
+    start = max(ref.stats.instrs, divergence.instrs - context)
+    if start > ref.stats.instrs:
+        ref.run(max_instrs=start)
+    save_checkpoint(ref.checkpoint(), path)
+    return ref.stats.instrs
+
+
+def main(argv: List[str]):
+    """Runs a program on two simulators in lockstep, and reports the first divergence."""
+    parser = argparse.ArgumentParser(
+        prog="difftest.py",
+        description="Runs an RV32I program on a cycle-level simulator and a reference "
+        "simulator in lockstep.")
+    parser.add_argument("image", nargs="?", help="flat binary image to load")
+    parser.add_argument("--base", type=lambda s: int(s, 0), default=0,
+                        help="load address of the image (default 0, the reset PC)")
+    parser.add_argument("--tohost", type=lambda s: int(s, 0), default=None,
+                        help="halt when the program writes to this address")
+    parser.add_argument("--restore", metavar="FILE", default=None,
+                        help="start from a checkpoint instead of loading an image")
+    parser.add_argument("--engine", choices=sorted(set(ENGINES) - {"iss"}), default="microcode",
+                        help="simulator under test (default microcode)")
+    parser.add_argument("--ref", choices=("iss", "microcode"), default="iss",
+                        help="reference simulator (default iss)")
+    parser.add_argument("--max-instrs", type=int, default=None,
+                        help="stop after this many retired instructions")
+    parser.add_argument("--chunk", type=int, default=1000,
+                        help="instructions run between comparisons (default 1000)")
+    parser.add_argument("--repro", metavar="FILE", default="difftest.ckpt",
+                        help="checkpoint to save before a divergence (default difftest.ckpt)")
+    parser.add_argument("--context", metavar="N", type=int, default=16,
+                        help="instructions the reproducer runs before the divergence "
+                        "(default 16)")
+    args = parser.parse_args(argv)
+    if (args.image is None) == (args.restore is None):
+        parser.error("give either an image or --restore")
+    if args.engine == args.ref:
+        parser.error("the engine and the reference must differ")
+
+    def make(engine: str):
+        if args.restore is not None:
+            ckpt = load_checkpoint(args.restore)
+            sim = ENGINES[engine](ckpt.memory, tohost=args.tohost)
+            sim.restore(ckpt)
+        else:
+            memory = MainMemory()
+            memory.load_file(args.image, args.base)
+            sim = ENGINES[engine](memory, tohost=args.tohost)
+        return sim
+
+    dut = make(args.engine)
+    diff = DiffTest(dut, make(args.ref), chunk=args.chunk)
+    divergence = diff.run(args.max_instrs)
+    print(dut.stats.report())
+    if divergence is None:
+        print(f"no divergence in {diff.records} trace records")
+        return
+    print(divergence.report())
+    start = write_reproducer(lambda: make(args.ref), divergence, args.repro, args.context)
+    tohost = f" --tohost {args.tohost:#x}" if args.tohost is not None else ""
+    print(f"saved a reproducer {divergence.instrs - start} instructions before the divergence:")
+    print(f"  python difftest.py --restore {args.repro} --engine {args.engine} "
+          f"--ref {args.ref} --max-instrs {divergence.instrs + 1}{tohost}")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
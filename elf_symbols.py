@@ -0,0 +1,166 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module reads ELF files, without external tools.
+
+Only what's needed to load a program and map addresses to functions is
+read: the program headers, the section headers, the symbol table and its
+string table. Both 32-bit and 64-bit little-endian files are understood.
+"""
+import struct
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from sim_memory import MainMemory
+
+_SHT_SYMTAB = 2
+_SHT_DYNSYM = 11
+_STT_NOTYPE = 0
+_STT_FUNC = 2
+_STT_SECTION = 3
+_STT_FILE = 4
+_PT_LOAD = 1
+_SHN_UNDEF = 0
+_SHN_ABS = 0xFFF1
+
+# (ELF header after e_ident, section header, symbol, program header) formats
+# by EI_CLASS.
+_FORMATS = {
+    1: ("<HHIIIIIHHHHHH", "<IIIIIIIIII", "<IIIBBH", "<IIIIIIII"),
+    2: ("<HHIQQQIHHHHHH", "<IIQQQQIIQQ", "<IBBHQQ", "<IIQQQQQQ"),
+}
+
+
+class _ElfFile:
+    """The parts of an ELF file that are read.
+
+    Attributes:
+        data: The contents of the file.
+        elf_class: 1 for a 32-bit file, 2 for a 64-bit one.
+        entry: The entry point.
+        sections: The (type, offset, size, link, entsize) of each section.
+        segments: The (type, offset, paddr, filesz) of each program header.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.data = data = f.read()
+        if data[:4] != b"\x7fELF" or data[4] not in _FORMATS:
+            raise ValueError(f"{path} is not an ELF file")
+        if data[5] != 1:
+            raise ValueError(f"{path} is not little-endian")
+        self.elf_class = data[4]
+        header, section, _, program = (struct.Struct(fmt) for fmt in _FORMATS[data[4]])
+        fields = header.unpack_from(data, 16)
+        self.entry = fields[3]
+        phoff, phentsize, phnum = fields[4], fields[8], fields[9]
+        shoff, shentsize, shnum = fields[5], fields[10], fields[11]
+        sections = [section.unpack_from(data, shoff + i * shentsize) for i in range(shnum)]
+        self.sections = [(s[1], s[4], s[5], s[6], s[9]) for s in sections]
+        segments = [program.unpack_from(data, phoff + i * phentsize) for i in range(phnum)]
+        if data[4] == 1:
+            self.segments = [(s[0], s[1], s[3], s[4]) for s in segments]
+        else:
+            self.segments = [(s[0], s[2], s[4], s[5]) for s in segments]
+
+
+def read_symbols(path: str) -> List[Tuple[str, int, int, int]]:
+    """Returns the (name, value, size, type) of the named, defined symbols of an ELF file.
+
+    The symbol table is read, or the dynamic symbol table if there is none.
+    """
+    elf = _ElfFile(path)
+    data = elf.data
+    symbol = struct.Struct(_FORMATS[elf.elf_class][2])
+    symtabs = [s for s in elf.sections if s[0] == _SHT_SYMTAB]
+    if not symtabs:
+        symtabs = [s for s in elf.sections if s[0] == _SHT_DYNSYM]
+    symbols = []
+    for _, offset, size, link, entsize in symtabs:
+        _, str_offset, str_size, _, _ = elf.sections[link]
+        strings = data[str_offset:str_offset + str_size]
+        for pos in range(offset + entsize, offset + size, entsize):
+            if elf.elf_class == 1:
+                name, value, sym_size, info, _, shndx = symbol.unpack_from(data, pos)
+            else:
+                name, info, _, shndx, value, sym_size = symbol.unpack_from(data, pos)
+            if shndx in (_SHN_UNDEF, _SHN_ABS) or info & 0xF in (_STT_SECTION, _STT_FILE):
+                continue
+            name = strings[name:strings.index(b"\0", name)].decode(errors="replace")
+            if name:
+                symbols.append((name, value, sym_size, info & 0xF))
+    return symbols
+
+
+def symbol_addresses(path: str) -> Dict[str, int]:
+    """Returns the values of the named, defined symbols of an ELF file, by name."""
+    return {name: value for name, value, _, _ in read_symbols(path)}
+
+
+def load_elf(path: str, memory: MainMemory) -> int:
+    """Loads the PT_LOAD segments of an ELF file at their physical addresses.
+
+    The part of a segment past its file size is left as it is, which is zero
+    in a new MainMemory.
+
+    Returns:
+        The entry point.
+    """
+    elf = _ElfFile(path)
+    for kind, offset, paddr, filesz in elf.segments:
+        if kind == _PT_LOAD and filesz:
+            memory.load_image(elf.data[offset:offset + filesz], paddr)
+    return elf.entry
+
+
+class SymbolTable:
+    """The functions of an ELF file, sorted by address.
+
+    Symbols without a size (like assembly labels) extend to the next symbol.
+
+    Attributes:
+        starts: The start address of each function.
+        ends: The address just past the end of each function.
+        names: The name of each function.
+    """
+
+    def __init__(self, symbols: List[Tuple[int, int, str]]):
+        """Makes a table from (address, size, name) triples."""
+        by_addr = {}
+        for addr, size, name in sorted(symbols):
+            # Of symbols at the same address, the first with a size wins.
+            if addr not in by_addr or (by_addr[addr][0] == 0 and size):
+                by_addr[addr] = (size, name)
+        starts = sorted(by_addr)
+        ends = []
+        for i, addr in enumerate(starts):
+            size = by_addr[addr][0]
+            limit = starts[i + 1] if i + 1 < len(starts) else (1 << 64) - 1
+            ends.append(min(addr + size, limit) if size else limit)
+        self.starts = np.array(starts, dtype=np.uint64)
+        self.ends = np.array(ends, dtype=np.uint64)
+        self.names = [by_addr[addr][1] for addr in starts]
+
+    @classmethod
+    def from_elf(cls, path: str) -> "SymbolTable":
+        """Reads the function and label symbols of an ELF file."""
+        symbols = []
+        for name, value, size, kind in read_symbols(path):
+            # Skip mapping symbols and local labels.
+            if kind in (_STT_NOTYPE, _STT_FUNC) and not name.startswith(("$", ".L")):
+                symbols.append((value, size, name))
+        return cls(symbols)
+
+    def lookup(self, addrs: np.ndarray) -> np.ndarray:
+        """Returns the index of the function holding each address, or -1."""
+        addrs = np.asarray(addrs, dtype=np.uint64)
+        i = np.searchsorted(self.starts, addrs, side="right") - 1
+        found = i >= 0
+        found[found] &= addrs[found] < self.ends[i[found]]
+        return np.where(found, i, -1)
+
+    def name(self, addr: int) -> str:
+        """Returns the name of the function holding an address, or the address in hex."""
+        i = int(self.lookup(np.array([addr]))[0])
+        return self.names[i] if i >= 0 else f"{addr:#010x}"
@@ -99,7 +99,8 @@ class ExcCard(Elaboratable):
 
         clk is the clock domain on which the register is clocked.
 
-        reg is the register signal.
+        reg is the register signal. It becomes the register itself, so that simulators
+        can read and write it.
 
         sels is an array of Signals which select that input for the multiplexer (active high). If
         no select is active, then the register retains its value.
@@ -109,9 +110,8 @@ class ExcCard(Elaboratable):
         assert len(sels) == len(sigs)
 
         muxreg = IC_reg32_with_mux(
-            clk=clk, N=len(sels), ext_init=self._ext_init, faster=True)
+            clk=clk, N=len(sels), ext_init=self._ext_init, faster=True, q=reg)
         m.submodules += muxreg
-        m.d.comb += reg.eq(muxreg.q)
         for i in range(len(sels)):
             m.d.comb += muxreg.n_sel[i].eq(~sels[i])
             m.d.comb += muxreg.d[i].eq(sigs[i])
@@ -2,34 +2,87 @@
 # pylint: disable=C0103
 # Disable protected access warnings
 # pylint: disable=W0212
+import argparse
+import json
+import multiprocessing
+import os
 import sys
-from typing import List, Tuple
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from nmigen import Array, Signal, Module, Elaboratable, ClockDomain, Mux, Repl
 from nmigen import ClockSignal, ResetSignal
 from nmigen.build import Platform
+from nmigen.hdl import Fragment
 from nmigen.asserts import Assert, Assume, Cover, Stable, Past, Initial, AnyConst, Rose, Fell
 
 from alu_card import AluCard
 from consts import AluFunc, AluOp, BranchCond, CSRAddr, MemAccessWidth, Opcode
 from consts import SystemFunc, TrapCause, MStatus, MInterrupt
+from cpu_state import LATCHES
 from exc_card import ExcCard
 from irq_card import IrqCard
 from reg_card import RegCard
 from sequencer_card import SequencerCard, SequencerState
 from shift_card import ShiftCard
-from util import main
+from util import generate, main, write_if_changed
 
 mode = ""
 MRET = 0x30200073
 ECALL = 0x00000073
 EBREAK = 0x00100073
 
+# The phases of a machine cycle, which make_clock counts.
+PHASES = 6
+
+# The machine cycles the instruction of each mode takes. formal checks that
+# the instruction completes in them.
+CYCLES = {
+    "op": 1,
+    "op_imm": 1,
+    "lui": 1,
+    "auipc": 1,
+    "jal": 2,
+    "jalr": 2,
+    "branch": 2,
+    "csr": 2,
+    "lb": 3,
+    "lbu": 3,
+    "lh": 3,
+    "lhu": 3,
+    "lw": 3,
+    "sb": 3,
+    "sh": 3,
+    "sw": 3,
+}
+
+# The machine cycles the proof of each mode has to look at: those of its
+# instruction, or of the trap or interrupt sequence.
+PROOF_CYCLES = dict(CYCLES, ecall=2, fatal1=3, fatal2=3, fatal3=3, fatal4=1, irq=3)
+
+# The engine each task is verified with, by target like op-prove, if not
+# DEFAULT_ENGINE. formal_jobs.py --portfolio keeps the engines that won its
+# races in ENGINES_FILE.
+DEFAULT_ENGINE = "smtbmc z3"
+ENGINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "formal_engines.json")
+
+
+def load_engines(path: str = ENGINES_FILE) -> Dict[str, str]:
+    """Returns the engine of each target in an engines file, or none if there's no file."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+TASK_ENGINES = load_engines()
+
 
 class FormalCPU(Elaboratable):
     """Formal verification for the CPU."""
 
-    def __init__(self):
+    def __init__(self, chips: bool = True):
         # CPU bus
         self.mcycle_end = Signal()
         self.instr_complete = Signal()
@@ -72,7 +125,7 @@ class FormalCPU(Elaboratable):
         self.shifter = ShiftCard()
         self.exc = ExcCard(ext_init=True)
         self.irq = IrqCard(ext_init=True)
-        self.seq = SequencerCard(ext_init=True, chips=True)
+        self.seq = SequencerCard(ext_init=True, chips=chips)
 
     def elaborate(self, _: Platform) -> Module:
         """Implements a CPU."""
@@ -200,6 +253,114 @@ class FormalCPU(Elaboratable):
 
         return m
 
+    def state_signals(self) -> Dict[str, Signal]:
+        """Returns every signal that holds state across machine cycles.
+
+        The keys are the CPUState field names, "z_2_lsb0" for the sequencer's
+        data_z_in_2_lsb0 register, "x_bank[i]" and "y_bank[i]" for the cells
+        of the two register file banks, and the names in cpu_state.LATCHES
+        for the contents of the RegCard latches.
+        """
+        seq = self.seq.state
+        signals = {
+            "pc": seq._pc,
+            "instr_phase": seq._instr_phase,
+            "instr": seq._instr,
+            "stored_alu_eq": seq._stored_alu_eq,
+            "stored_alu_lt": seq._stored_alu_lt,
+            "stored_alu_ltu": seq._stored_alu_ltu,
+            "memaddr": seq.memaddr,
+            "memdata_wr": seq.memdata_wr,
+            "tmp": seq._tmp,
+            "reg_page": seq.reg_page,
+            "trap": seq.trap,
+            "exception": seq.exception,
+            "fatal": seq.fatal,
+            "mtvec": seq._mtvec,
+            "mcause": self.exc._mcause,
+            "mepc": self.exc._mepc,
+            "mtval": self.exc._mtval,
+            "mstatus": self.irq._mstatus,
+            "mie": self.irq._mie,
+            "mip": self.irq._mip,
+            "z_2_lsb0": self.seq.data_z_in_2_lsb0,
+        }
+        for i in range(64):
+            signals[f"x_bank[{i}]"] = self.regs._x_bank._mem[i]
+            signals[f"y_bank[{i}]"] = self.regs._y_bank._mem[i]
+        for name in LATCHES:
+            signals[name] = getattr(self.regs, "_" + name)._latched
+        return signals
+
+    def probe_signals(self) -> Dict[str, Dict[str, Signal]]:
+        """Returns groups of signals worth watching in waveforms, by group name.
+
+        The groups are "bus" for the memory bus and the x, y and z buses,
+        "state" for the SequencerState, "rom" for the control lines the
+        sequencer's ROMs drive, and "csr" for the trap and interrupt CSRs and
+        lines. Signal names are unique across the groups.
+        """
+        seq = self.seq
+        return {
+            "bus": {
+                "memaddr": self.memaddr,
+                "memdata_rd": self.memdata_rd,
+                "memdata_wr": self.memdata_wr,
+                "mem_rd": self.mem_rd,
+                "mem_wr": self.mem_wr,
+                "mem_wr_mask": self.mem_wr_mask,
+                "x_bus": self.x_bus,
+                "y_bus": self.y_bus,
+                "z_bus": self.z_bus,
+            },
+            "state": {
+                "pc": seq.state._pc,
+                "instr_phase": seq.state._instr_phase,
+                "instr": seq.state._instr,
+                "stored_alu_eq": seq.state._stored_alu_eq,
+                "stored_alu_lt": seq.state._stored_alu_lt,
+                "stored_alu_ltu": seq.state._stored_alu_ltu,
+                "tmp": seq.state._tmp,
+                "reg_page": seq.state.reg_page,
+                "trap": seq.state.trap,
+                "exception": seq.state.exception,
+                "fatal": seq.state.fatal,
+                "mtvec": seq.state._mtvec,
+            },
+            "rom": {
+                "x_reg": self.x_reg,
+                "y_reg": self.y_reg,
+                "z_reg": self.z_reg,
+                "reg_to_x": self.reg_to_x,
+                "reg_to_y": self.reg_to_y,
+                "alu_op": self.alu_op,
+                "alu_to_z": self.alu_to_z,
+                "csr_num": self.csr_num,
+                "csr_to_x": self.csr_to_x,
+                "z_to_csr": self.z_to_csr,
+                "save_trap_csrs": self.save_trap_csrs,
+                "instr_complete": self.instr_complete,
+                "x_mux_select": seq.x_mux_select,
+                "y_mux_select": seq.y_mux_select,
+                "z_mux_select": seq.z_mux_select,
+                "pc_mux_select": seq.pc_mux_select,
+                "tmp_mux_select": seq.tmp_mux_select,
+                "memaddr_mux_select": seq.memaddr_mux_select,
+                "memdata_wr_mux_select": seq.memdata_wr_mux_select,
+                "mtvec_mux_select": seq.mtvec_mux_select,
+            },
+            "csr": {
+                "mcause": self.exc._mcause,
+                "mepc": self.exc._mepc,
+                "mtval": self.exc._mtval,
+                "mstatus": self.irq._mstatus,
+                "mie": self.irq._mie,
+                "mip": self.irq._mip,
+                "time_irq": self.time_irq,
+                "ext_irq": self.ext_irq,
+            },
+        }
+
     @classmethod
     def decode_imm(cls, m: Module, instr: Signal) -> Signal:
         """Decodes the immediate value out of the instruction."""
@@ -215,7 +376,7 @@ class FormalCPU(Elaboratable):
                     imm[0:12].eq(0),
                 ]
 
-            with m.Case(Opcode.OP_IMM, Opcode.LOAD):
+            with m.Case(Opcode.OP_IMM, Opcode.LOAD, Opcode.JALR):
                 # Format I
                 m.d.comb += [
                     imm[11:].eq(Repl(instr[31], 32)),
@@ -228,7 +389,7 @@ class FormalCPU(Elaboratable):
                 # Format R
                 m.d.comb += imm.eq(0)
 
-            with m.Case(Opcode.JAL, Opcode.JALR):
+            with m.Case(Opcode.JAL):
                 # Format J
                 m.d.comb += [
                     imm[20:].eq(Repl(instr[31], 32)),
@@ -342,7 +503,9 @@ class FormalCPU(Elaboratable):
                 self.rd.eq(self.instr[7:12]),
                 self.funct3.eq(self.instr[12:15]),
                 self.funct7.eq(self.instr[25:]),
-                self.alu_func[3].eq(self.funct7[5]),
+                # In OP_IMM, bit 30 is part of the immediate, except for the shifts.
+                self.alu_func[3].eq(self.funct7[5] & ((self.opcode == Opcode.OP) |
+                                                      (self.funct3[:2] == 0b01))),
                 self.alu_func[0:3].eq(self.funct3),
                 self.funct12.eq(self.instr[20:]),
                 self.csr_num.eq(self.funct12),
@@ -1285,7 +1448,7 @@ class FormalCPU(Elaboratable):
         mcycle_end = Signal()
 
         m.d.sync += phase_count.eq(phase_count + 1)
-        with m.If(phase_count == 5):
+        with m.If(phase_count == PHASES - 1):
             m.d.sync += phase_count.eq(0)
 
         with m.Switch(phase_count):
@@ -1307,12 +1470,30 @@ class FormalCPU(Elaboratable):
 
         return (phase_count, mcycle_end)
 
+    @classmethod
+    def sim(cls):
+        """Runs a program image on the CPU in the nMigen simulator.
+
+        See cpu_sim.py for the command line arguments.
+        """
+        # cpu_sim imports this module, so it can't be imported at the top.
+        from cpu_sim import sim_main  # pylint: disable=C0415
+        sim_main(sys.argv[2:])
+
     @ classmethod
-    def formal(cls) -> Tuple[Module, List[Signal]]:
-        """Formal verification for the CPU."""
+    def formal(cls, cpu: Optional["FormalCPU"] = None,
+               fragment: Optional[Fragment] = None) -> Tuple[Module, List[Signal]]:
+        """Formal verification for the CPU.
+
+        Args:
+            cpu: The CPU to verify, or None to make one.
+            fragment: The elaborated cpu, to use instead of elaborating it again.
+        """
         m = Module()
 
-        m.submodules.cpu = cpu = FormalCPU()
+        if cpu is None:
+            cpu = FormalCPU()
+        m.submodules.cpu = fragment if fragment is not None else cpu
 
         phase_count, mcycle_end = FormalCPU.make_clock(m)
 
@@ -1420,24 +1601,6 @@ class FormalCPU(Elaboratable):
         # m.d.comb += Cover(Past(cpu.seq.state._instr, 18) == ECALL)
 
         # Asserts and Assumptions based on which instructions we're verifying.
-        cycles = {
-            "op": 1,
-            "op_imm": 1,
-            "lui": 1,
-            "auipc": 1,
-            "jal": 2,
-            "jalr": 2,
-            "branch": 2,
-            "csr": 2,
-            "lb": 3,
-            "lbu": 3,
-            "lh": 3,
-            "lhu": 3,
-            "lw": 3,
-            "sb": 3,
-            "sh": 3,
-            "sw": 3,
-        }
         opcodes = {
             "op": Opcode.OP,
             "op_imm": Opcode.OP_IMM,
@@ -1466,11 +1629,11 @@ class FormalCPU(Elaboratable):
             "sh": MemAccessWidth.H,
             "sw": MemAccessWidth.W,
         }
-        if mode in cycles:
+        if mode in CYCLES:
             with m.If(phase_count == 5):
                 m.d.comb += Assume(cpu.instr_complete ==
-                                   (mcycle == cycles[mode]-1))
-            m.d.comb += Assert(mcycle < cycles[mode])
+                                   (mcycle == CYCLES[mode]-1))
+            m.d.comb += Assert(mcycle < CYCLES[mode])
 
         if mode in widths:
             with m.If((mcycle == 0) & (phase_count == 2)):
@@ -1827,8 +1990,143 @@ class FormalCPU(Elaboratable):
         return m, [sync_clk, cpu.memdata_rd, cpu.csr_rd_data, cpu.time_irq, cpu.ext_irq]
 
 
+# The modes formal_cpu.sby verifies, as the Makefile runs them.
+MODES = ("op", "op_imm", "lui", "auipc", "jal", "jalr", "branch", "csr", "ecall",
+         "lb", "lbu", "lh", "lhu", "lw", "sb", "sh", "sw",
+         "fatal1", "fatal2", "fatal3", "fatal4", "irq")
+
+# The SymbiYosys script that reads an RTLIL file, with a formal $dff for yosys.
+_SBY_SCRIPT = """\
+[script]
+read_verilog <<END
+module \\$dff (CLK, D, Q);
+  parameter WIDTH = 0;
+  parameter CLK_POLARITY = 1'b1;
+  input CLK;
+  input [WIDTH-1:0] D;
+  output reg [WIDTH-1:0] Q;
+  \\$ff #(.WIDTH(WIDTH)) _TECHMAP_REPLACE_ (.D(D),.Q(Q));
+endmodule
+END
+design -stash dff2ff
+read_ilang {il}
+proc
+attrmap -remove init a:uninitialized
+techmap -map %dff2ff top/w:clk %co
+prep -top top
+
+[files]
+{il}
+"""
+
+
+def sby_config(gen_mode: str, engine: Optional[str] = None) -> str:
+    """Returns the SymbiYosys configuration for the bmc and prove tasks of a mode.
+
+    The prove depth covers the machine cycles in PROOF_CYCLES, at PHASES
+    steps each, and bmc looks one step further. Both read
+    formal_cpu_<mode>.il.
+
+    Args:
+        gen_mode: The mode.
+        engine: The engine of both tasks, or None for their ones in
+            TASK_ENGINES.
+    """
+    depth = PROOF_CYCLES[gen_mode] * PHASES
+    engines = [f"{task}: {engine or TASK_ENGINES.get(f'{gen_mode}-{task}', DEFAULT_ENGINE)}"
+               for task in ("bmc", "prove")]
+    return "\n".join([
+        "[tasks]",
+        "bmc",
+        "prove",
+        "",
+        "[options]",
+        "bmc: mode bmc",
+        f"bmc: depth {depth + 1}",
+        "prove: mode prove",
+        f"prove: depth {depth}",
+        "multiclock on",
+        "",
+        "[engines]",
+        *engines,
+        "",
+        _SBY_SCRIPT.format(il=f"formal_cpu_{gen_mode}.il"),
+    ])
+
+
+def write_sby(gen_mode: str, engine: Optional[str] = None) -> str:
+    """Writes formal_cpu_<mode>.sby from sby_config if it changed, and returns its name."""
+    filename = f"formal_cpu_{gen_mode}.sby"
+    write_if_changed(filename, sby_config(gen_mode, engine))
+    return filename
+
+
+# The CPU and its elaborated fragment, shared by the modes gen_all generates.
+_shared_cpu: Optional[Tuple[FormalCPU, Fragment]] = None
+
+
+def _gen_mode(gen_mode: str) -> Tuple[str, bool, float]:
+    """Generates the RTLIL of one mode, in a process of its own."""
+    global mode  # pylint: disable=W0603
+    mode = gen_mode
+    start = time.monotonic()
+    cpu, fragment = _shared_cpu if _shared_cpu is not None else (None, None)
+    generated = generate(FormalCPU, f"formal_cpu_{gen_mode}.il", ["gen", gen_mode],
+                         cpu=cpu, fragment=fragment)
+    write_sby(gen_mode)
+    return gen_mode, generated, time.monotonic() - start
+
+
+def gen_all(modes: Sequence[str], jobs: Optional[int] = None):
+    """Generates the RTLIL of several modes, like formal_cpu.py gen does for one.
+
+    The CPU doesn't depend on the mode, only the checks around it do, so it is
+    made and elaborated once, here. Each mode is then converted in a process
+    forked from this one, in parallel. A process only converts one mode, since
+    converting changes the fragments it converts. Modes whose RTLIL is cached
+    (see rtlil_cache.py) are just copied. The .sby file of each mode is
+    written too, see write_sby.
+
+    Args:
+        modes: The modes to generate.
+        jobs: The number of worker processes. Defaults to the number of CPUs.
+    """
+    global _shared_cpu  # pylint: disable=W0603
+    cpu = FormalCPU()
+    _shared_cpu = (cpu, Fragment.get(cpu, None))
+    jobs = min(jobs or os.cpu_count() or 1, len(modes))
+    methods = multiprocessing.get_all_start_methods()
+    # Without fork, each process makes its own CPU.
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with context.Pool(jobs, maxtasksperchild=1) as pool:
+        for gen_mode, generated, secs in pool.imap_unordered(_gen_mode, modes):
+            how = "generated" if generated else "cached"
+            print(f"formal_cpu_{gen_mode}.il: {how} in {secs:.1f}s", flush=True)
+
+
+def _gen_all_main(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="formal_cpu.py gen-all",
+        description="Generates the RTLIL of several formal verification modes in parallel.")
+    parser.add_argument("modes", nargs="*", default=list(MODES),
+                        help="modes to generate (default all of them)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default the number of CPUs)")
+    args = parser.parse_args(argv)
+    unknown = sorted(set(args.modes) - set(MODES))
+    if unknown:
+        parser.error(f"unknown modes: {' '.join(unknown)}")
+    gen_all(args.modes, args.jobs)
+
+
 if __name__ == "__main__":
-    mode = sys.argv[2] if len(sys.argv) > 2 else ""
+    if len(sys.argv) > 1 and sys.argv[1] == "gen-all":
+        _gen_all_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == "gen":
+        mode = sys.argv[2]
     filename = f"formal_cpu_{mode}.il" if mode != "" else "toplevel.il"
 
     main(FormalCPU, filename=filename)
+    if mode in PROOF_CYCLES:
+        write_sby(mode)
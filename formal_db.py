@@ -0,0 +1,270 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module keeps how long formal verification tasks take, in a SQLite
+database, and reports the tasks that got slower.
+
+formal_jobs.py adds a row to .formal_timing.db for every sby task it runs,
+card tasks and formal_cpu modes alike, including the ones make runs through
+formal_jobs.py --make, with the task's engine, depth,
+whether it was a portfolio race, status, wall-clock time, peak memory, a
+hash of the RTLIL it read, and the commit the sources were at.
+
+The report compares the latest passing run of each task with a baseline:
+the median of the passing runs before it with the same engine, depth and
+portfolio flag, up to --baseline of them. A portfolio race shares the CPU
+with the engines it races, and a deeper proof does more work, so runs that
+differ in those aren't compared. A task
+whose latest run took longer than the baseline by more than --threshold
+percent is flagged, so that an edit that quietly doubles a proof time, like
+a new Assume in FormalCPU.formal, shows up on the commit that made it. The
+exit status is 1 if any task is flagged.
+
+    python formal_db.py report [--db FILE] [--threshold PCT] [--baseline N] [--all]
+    python formal_db.py history <task> [--db FILE] [--limit N]
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+from typing import List, Optional
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".formal_timing.db")
+
+_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    task TEXT NOT NULL,
+    engine TEXT,
+    depth INTEGER,
+    status TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    peak_kb INTEGER,
+    source TEXT,
+    commit_id TEXT,
+    portfolio INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_by_name ON runs (name, id);
+"""
+
+_COLUMNS = ("started", "name", "mode", "task", "engine", "depth", "status", "seconds",
+            "peak_kb", "source", "commit_id", "portfolio")
+
+# Columns added since the first version of the database, with their definitions.
+_ADDED_COLUMNS = {"portfolio": "INTEGER NOT NULL DEFAULT 0"}
+
+
+class TimedRun:
+    """One run of an sby task.
+
+    Attributes:
+        started: When the run started, as an ISO 8601 UTC time.
+        name: The target name, like op-prove or alu_card-bmc.
+        mode: The formal_cpu mode, or the card, like op or alu_card.
+        task: The sby task, like prove.
+        engine: The engine the task ran with, like smtbmc z3, or None if
+            unknown.
+        depth: The depth the task ran to, or None if unknown.
+        status: PASS, FAIL, UNKNOWN, TIMEOUT or ERROR.
+        seconds: How long sby ran.
+        peak_kb: The peak resident memory of sby or a solver it ran, in
+            KiB, or None if unknown.
+        source: A hash of the RTLIL the task read, without its src
+            attributes, or None if unknown.
+        commit_id: The commit the sources were at, like git describe
+            --dirty shows it, or None if unknown.
+        portfolio: Whether the run raced several engines, engine being the
+            one that won.
+    """
+
+    def __init__(self, started: str, name: str, mode: str, task: str, engine: Optional[str],
+                 depth: Optional[int], status: str, seconds: float, peak_kb: Optional[int],
+                 source: Optional[str], commit_id: Optional[str], portfolio: bool = False):
+        self.started = started
+        self.name = name
+        self.mode = mode
+        self.task = task
+        self.engine = engine
+        self.depth = depth
+        self.status = status
+        self.seconds = seconds
+        self.peak_kb = peak_kb
+        self.source = source
+        self.commit_id = commit_id
+        self.portfolio = bool(portfolio)
+
+
+class Regression:
+    """How the latest passing run of a task compares with its baseline.
+
+    Attributes:
+        latest: The latest passing run.
+        baseline: The median seconds of the passing runs before it with
+            the same engine, depth and portfolio flag.
+        runs: How many runs the baseline is the median of.
+        change: How much longer the latest run took, in percent of the
+            baseline. Negative if it was faster.
+        flagged: Whether the change is over the threshold.
+    """
+
+    def __init__(self, latest: TimedRun, baseline: float, runs: int, threshold: float):
+        self.latest = latest
+        self.baseline = baseline
+        self.runs = runs
+        self.change = (latest.seconds / baseline - 1) * 100 if baseline > 0 else 0.0
+        self.flagged = self.change > threshold
+
+
+class TimingDB:
+    """The database of formal task runs.
+
+    Attributes:
+        path: The SQLite file.
+    """
+
+    def __init__(self, path: str = DEFAULT_DB):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(runs)")}
+        with self._conn:
+            for column, definition in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE runs ADD COLUMN {column} {definition}")
+
+    def close(self):
+        """Closes the database."""
+        self._conn.close()
+
+    def add(self, run: TimedRun):
+        """Appends a run."""
+        with self._conn:
+            self._conn.execute(
+                f"INSERT INTO runs ({', '.join(_COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in _COLUMNS)})",
+                [getattr(run, column) for column in _COLUMNS])
+
+    def runs(self, name: str, limit: Optional[int] = None, status: Optional[str] = None,
+             like: Optional[TimedRun] = None) -> List[TimedRun]:
+        """Returns the runs of a task, latest first.
+
+        Args:
+            name: The target name, like op-prove.
+            limit: The most runs to return, or None for all of them.
+            status: Only return runs with this status, or None for all.
+            like: Only return runs with the same engine, depth and portfolio
+                flag as this one, or None for all.
+        """
+        query = f"SELECT {', '.join(_COLUMNS)} FROM runs WHERE name = ?"
+        params: List = [name]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        if like is not None:
+            query += " AND engine IS ? AND depth IS ? AND portfolio = ?"
+            params.extend([like.engine, like.depth, int(like.portfolio)])
+        query += " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [TimedRun(*row) for row in self._conn.execute(query, params)]
+
+    def names(self, task: Optional[str] = None) -> List[str]:
+        """Returns the target names with runs, of one sby task or of all of them."""
+        query = "SELECT DISTINCT name FROM runs"
+        params: List = []
+        if task is not None:
+            query += " WHERE task = ?"
+            params.append(task)
+        return sorted(row[0] for row in self._conn.execute(query + " ORDER BY name", params))
+
+    def regressions(self, threshold: float, baseline_runs: int, task: Optional[str] = "prove",
+                    ) -> List[Regression]:
+        """Compares the latest passing run of each task with the median of the ones before it.
+
+        Only the runs before it with the same engine, depth and portfolio
+        flag are compared.
+
+        Args:
+            threshold: The percent a run may take longer than its baseline
+                without being flagged.
+            baseline_runs: The most passing runs before the latest the
+                baseline is the median of.
+            task: Only compare runs of this sby task, or None for all.
+
+        Returns:
+            The comparison for each task with a baseline, slowest change
+            first.
+        """
+        results = []
+        for name in self.names(task):
+            latest = self.runs(name, 1, "PASS")
+            if not latest:
+                continue
+            passed = self.runs(name, baseline_runs + 1, "PASS", latest[0])
+            if len(passed) < 2:
+                continue
+            baseline = statistics.median(run.seconds for run in passed[1:])
+            results.append(Regression(passed[0], baseline, len(passed) - 1, threshold))
+        results.sort(key=lambda result: -result.change)
+        return results
+
+
+def _memory(peak_kb: Optional[int]) -> str:
+    return f"{peak_kb / 1024:.0f} MiB" if peak_kb is not None else "-"
+
+
+def main(argv: List[str]):
+    """Reports the formal tasks that got slower, or the runs of one task."""
+    parser = argparse.ArgumentParser(
+        prog="formal_db.py",
+        description="Reports on the formal task runs formal_jobs.py keeps.")
+    parser.add_argument("--db", metavar="FILE", default=DEFAULT_DB,
+                        help="the database (default .formal_timing.db)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report = subparsers.add_parser("report", help="flag tasks that got slower")
+    report.add_argument("--threshold", metavar="PCT", type=float, default=25.0,
+                        help="percent slower than the baseline to flag (default 25)")
+    report.add_argument("--baseline", metavar="N", type=int, default=5,
+                        help="passing runs the baseline is the median of (default 5)")
+    report.add_argument("--all", action="store_true",
+                        help="compare every task, not just prove ones")
+    history = subparsers.add_parser("history", help="list the runs of a task")
+    history.add_argument("name", help="the task, like op-prove")
+    history.add_argument("--limit", metavar="N", type=int, default=20,
+                         help="runs to list (default 20)")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} doesn't exist; formal_jobs.py makes it")
+    db = TimingDB(args.db)
+    try:
+        if args.command == "history":
+            for run in db.runs(args.name, args.limit):
+                print(f"{run.started}  {run.status:<8} {run.seconds:8.1f}s "
+                      f"{_memory(run.peak_kb):>9}  depth {run.depth}  {run.engine}"
+                      f"{' (portfolio)' if run.portfolio else ''}  {run.commit_id}")
+            return
+        results = db.regressions(args.threshold, args.baseline, None if args.all else "prove")
+    finally:
+        db.close()
+
+    for result in results:
+        latest = result.latest
+        flag = "SLOWER" if result.flagged else ""
+        print(f"{latest.name:<24} {latest.seconds:8.1f}s vs {result.baseline:8.1f}s "
+              f"({result.change:+6.1f}%, {result.runs} runs)  {latest.engine}"
+              f"{' (portfolio)' if latest.portfolio else ''}  {latest.commit_id}  {flag}")
+    flagged = [result for result in results if result.flagged]
+    print(f"{len(flagged)} of {len(results)} tasks took over {args.threshold:g}% longer "
+          "than their baseline")
+    if flagged:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
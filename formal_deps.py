@@ -0,0 +1,453 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module finds what a formal verification task depends on, from the
+cone of influence of its checks in the generated RTLIL.
+
+The cone of influence is everything the asserts, assumes and covers of a
+design read, directly or not: the cells, processes and connections driving
+their inputs, through the submodules. Logic outside of it can't change the
+outcome of a proof, so two designs with the same cone have the same
+outcome. The cone is fingerprinted with the src attributes left out, so
+that moving code around doesn't change it. Every other attribute stays in,
+since some, like uninitialized or init, change what's being proved.
+
+The src attributes of the logic in the cone give the functions the task
+depends on, like SequencerROM.handle_load, AluCard.elaborate or
+Collected.verify_opcode_OP. With a hash of each function's source, that
+explains which edits made a fingerprint change.
+
+The cone is found a whole wire, cell or process at a time, not a bit at a
+time, so it can be bigger than it has to be, but not smaller. Most of the
+CPU is in the cone of every mode: the checks of a mode look at the
+registers and the state, which everything else drives. What differs
+between modes is the checks, and so what the functions of the checks of
+other modes don't get into.
+
+    python formal_deps.py <file.il>... [--functions]
+"""
+import argparse
+import ast
+import functools
+import hashlib
+import os
+import re
+import sys
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+# The cells that check something: the cone is what they read.
+SINK_CELLS = ("$assert", "$assume", "$cover", "$live", "$fair")
+
+# The output ports of the internal cells. All other ports are inputs.
+_OUTPUT_PORTS = {"\\Y", "\\Q", "\\X", "\\CO", "\\RD_DATA"}
+
+_TOKEN = re.compile(r'\{|\}|\[[^\]]*\]|"(?:[^"\\]|\\.)*"|\S+')
+_SRC = re.compile(r'^\s*attribute \\src "(.*)"\s*$')
+
+
+def _tokens(line: str) -> List[str]:
+    return _TOKEN.findall(line)
+
+
+def _sigspec(tokens: List[str], i: int) -> Tuple[Set[str], int]:
+    """Returns the wires a sigspec starting at a token refers to, and the token after it."""
+    wires = set()
+    if tokens[i] == "{":
+        i += 1
+        while tokens[i] != "}":
+            inner, i = _sigspec(tokens, i)
+            wires |= inner
+        i += 1
+    else:
+        if tokens[i][0] in "\\$":
+            wires.add(tokens[i])
+        i += 1
+    while i < len(tokens) and tokens[i].startswith("["):
+        i += 1
+    return wires, i
+
+
+def _two_sigspecs(tokens: List[str], i: int) -> Tuple[Set[str], Set[str]]:
+    lhs, i = _sigspec(tokens, i)
+    rhs, _ = _sigspec(tokens, i)
+    return lhs, rhs
+
+
+class Element:
+    """A cell, process or connection of a module.
+
+    Attributes:
+        kind: cell, process or connect.
+        type: The cell type, like $mux or the name of a submodule.
+        name: The cell or process name, or "" for a connection.
+        text: The element's RTLIL without its src attributes.
+        srcs: The file:line locations in its src attributes.
+        reads: The wires (and, for a submodule, port connections) it reads.
+        drives: The wires it drives.
+        ports: For a cell, the wires connected to each port.
+    """
+
+    def __init__(self, kind: str, type_: str, name: str):
+        self.kind = kind
+        self.type = type_
+        self.name = name
+        self.text: List[str] = []
+        self.srcs: List[str] = []
+        self.reads: Set[str] = set()
+        self.drives: Set[str] = set()
+        self.ports: Dict[str, Set[str]] = {}
+
+
+class RtlilModule:
+    """A module of an RTLIL design.
+
+    Attributes:
+        name: The module name.
+        attributes: The module's attributes other than src.
+        wires: The declaration of each wire without its src attributes, by name.
+        wire_srcs: The src locations of each wire, by name.
+        inputs: The names of the input ports.
+        outputs: The names of the output ports.
+        elements: The cells, processes and connections.
+        top: Whether the module is the top one.
+    """
+
+    def __init__(self, name: str, top: bool):
+        self.name = name
+        self.attributes: List[str] = []
+        self.wires: Dict[str, str] = {}
+        self.wire_srcs: Dict[str, List[str]] = {}
+        self.inputs: Set[str] = set()
+        self.outputs: Set[str] = set()
+        self.elements: List[Element] = []
+        self.top = top
+
+    def drivers(self) -> Dict[str, List[int]]:
+        """Returns the elements driving each wire, by wire name."""
+        drivers: Dict[str, List[int]] = {}
+        for i, element in enumerate(self.elements):
+            for wire in element.drives:
+                drivers.setdefault(wire, []).append(i)
+        return drivers
+
+
+def _srcs(attributes: List[str]) -> List[str]:
+    srcs = []
+    for line in attributes:
+        match = _SRC.match(line)
+        if match:
+            srcs.extend(match.group(1).split("|"))
+    return srcs
+
+
+def _kept(attributes: List[str]) -> List[str]:
+    """Returns the attributes to keep in the text, which is all but the src ones, like
+    util.rtlil_digest."""
+    return [line.strip() for line in attributes if not _SRC.match(line)]
+
+
+def parse_rtlil(text: str) -> Dict[str, RtlilModule]:
+    """Parses the modules of an RTLIL design, by name."""
+    modules: Dict[str, RtlilModule] = {}
+    module: Optional[RtlilModule] = None
+    element: Optional[Element] = None
+    attributes: List[str] = []
+    depth = 0
+    for line in text.splitlines():
+        tokens = _tokens(line)
+        if not tokens:
+            continue
+        word = tokens[0]
+        if word == "attribute":
+            attributes.append(line)
+            continue
+
+        if element is not None:
+            element.srcs.extend(_srcs(attributes))
+            element.text.extend(_kept(attributes))
+            attributes = []
+            if word == "end" and depth == 0:
+                module.elements.append(element)
+                element = None
+                continue
+            element.text.append(line.strip())
+            if element.kind == "cell":
+                if word == "connect":
+                    wires, _ = _sigspec(tokens, 2)
+                    element.ports[tokens[1]] = wires
+            elif word == "switch":
+                depth += 1
+                element.reads |= _sigspec(tokens, 1)[0]
+            elif word == "end":
+                depth -= 1
+            elif word in ("assign", "update"):
+                lhs, rhs = _two_sigspecs(tokens, 1)
+                element.drives |= lhs
+                element.reads |= rhs
+            elif word == "sync" and len(tokens) > 2:
+                element.reads |= _sigspec(tokens, 2)[0]
+            continue
+
+        if word == "module":
+            module = RtlilModule(tokens[1], any(a.split()[1:] == ["\\top", "1"]
+                                                for a in attributes))
+            module.attributes = _kept(attributes)
+            modules[module.name] = module
+            attributes = []
+        elif word == "end":
+            module = None
+            attributes = []
+        elif word == "wire":
+            name = tokens[-1]
+            module.wires[name] = "\n".join(_kept(attributes) + [line.strip()])
+            module.wire_srcs[name] = _srcs(attributes)
+            if "input" in tokens or "inout" in tokens:
+                module.inputs.add(name)
+            if "output" in tokens or "inout" in tokens:
+                module.outputs.add(name)
+            attributes = []
+        elif word in ("cell", "process"):
+            element = Element(word, tokens[1], tokens[-1])
+            element.srcs = _srcs(attributes)
+            element.text.extend(_kept(attributes))
+            element.text.append(line.strip())
+            attributes = []
+        elif word == "connect":
+            connect = Element("connect", "", "")
+            connect.srcs = _srcs(attributes)
+            connect.text.extend(_kept(attributes))
+            connect.text.append(line.strip())
+            connect.drives, connect.reads = _two_sigspecs(tokens, 1)
+            module.elements.append(connect)
+            attributes = []
+        elif word == "memory":
+            raise ValueError("memories aren't supported")
+        else:
+            attributes = []
+
+    # Now that every module is known, sort the cell ports into inputs and outputs.
+    for module in modules.values():
+        for element in module.elements:
+            if element.kind != "cell":
+                continue
+            sub = modules.get(element.type)
+            for port, wires in element.ports.items():
+                is_output = port in sub.outputs if sub is not None else port in _OUTPUT_PORTS
+                if is_output:
+                    element.drives |= wires
+                else:
+                    element.reads |= wires
+    return modules
+
+
+class Cone:
+    """The cone of influence of the checks of an RTLIL design.
+
+    Attributes:
+        modules: The modules of the design, by name.
+        elements: The indices of the elements in the cone, by module name.
+        wires: The names of the wires in the cone, by module name.
+    """
+
+    def __init__(self, modules: Dict[str, RtlilModule]):
+        self.modules = modules
+        self.elements: Dict[str, Set[int]] = {name: set() for name in modules}
+        self.wires: Dict[str, Set[str]] = {name: set() for name in modules}
+        self._drivers = {name: module.drivers() for name, module in modules.items()}
+
+        tops = [module for module in modules.values() if module.top]
+        if len(tops) != 1:
+            raise ValueError("the design needs one top module")
+        # The instances, by path, as (module, parent path, cell index in the parent).
+        self._instances: Dict[str, Tuple[str, Optional[str], int]] = {}
+        self._add_instance(tops[0].name, tops[0].name, None, -1)
+
+        todo: List[Tuple[str, str]] = []
+        for path, (name, _, _) in self._instances.items():
+            for i, element in enumerate(modules[name].elements):
+                if element.kind == "cell" and element.type in SINK_CELLS:
+                    self.elements[name].add(i)
+                    todo.extend((path, wire) for wire in element.reads)
+        seen: Set[Tuple[str, str]] = set()
+        while todo:
+            node = todo.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            todo.extend(self._sources(*node))
+
+    def _add_instance(self, name: str, path: str, parent: Optional[str], cell: int):
+        self._instances[path] = (name, parent, cell)
+        for i, element in enumerate(self.modules[name].elements):
+            if element.kind == "cell" and element.type in self.modules:
+                self._add_instance(element.type, f"{path}.{element.name}", path, i)
+
+    def _sources(self, path: str, wire: str) -> Iterator[Tuple[str, str]]:
+        """Marks a wire and what drives it as in the cone, and returns what those read."""
+        name, parent, cell = self._instances[path]
+        module = self.modules[name]
+        self.wires[name].add(wire)
+        for i in self._drivers[name].get(wire, ()):
+            element = module.elements[i]
+            self.elements[name].add(i)
+            if element.kind == "cell" and element.type in self.modules:
+                sub = f"{path}.{element.name}"
+                for port, wires in element.ports.items():
+                    if wire in wires and port in self.modules[element.type].outputs:
+                        yield sub, port
+            else:
+                for read in element.reads:
+                    yield path, read
+        if wire in module.inputs and parent is not None:
+            parent_name = self._instances[parent][0]
+            element = self.modules[parent_name].elements[cell]
+            self.elements[parent_name].add(cell)
+            for read in element.ports.get(wire, ()):
+                yield parent, read
+
+    def fingerprint(self) -> str:
+        """Returns a hash of the RTLIL of the cone, without its src attributes."""
+        h = hashlib.sha256()
+        for name in sorted(self.modules):
+            module = self.modules[name]
+            h.update(f"module {name} {module.top}\n".encode())
+            h.update("".join(a + "\n" for a in module.attributes).encode())
+            for wire in sorted(self.wires[name] & set(module.wires)):
+                h.update(module.wires[wire].encode() + b"\n")
+            for i in sorted(self.elements[name]):
+                h.update("\n".join(module.elements[i].text).encode() + b"\n")
+        return h.hexdigest()[:16]
+
+    def sources(self) -> Set[str]:
+        """Returns the file:line locations of the logic in the cone."""
+        srcs = set()
+        for name, module in self.modules.items():
+            for i in self.elements[name]:
+                srcs.update(module.elements[i].srcs)
+            for wire in self.wires[name]:
+                srcs.update(module.wire_srcs.get(wire, ()))
+        return srcs
+
+
+@functools.lru_cache(maxsize=None)
+def _functions(path: str) -> Tuple[List[Tuple[int, int, str]], List[str]]:
+    """Returns the (first line, last line, qualified name) of each function of a file, and its
+    lines."""
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    functions = []
+
+    def visit(node: ast.AST, prefix: str):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = f"{prefix}{child.name}"
+                if not isinstance(child, ast.ClassDef):
+                    functions.append((child.lineno, child.end_lineno, name))
+                visit(child, name + ".")
+            else:
+                visit(child, prefix)
+
+    visit(ast.parse(source, filename=path), "")
+    return functions, source.splitlines()
+
+
+def _function_at(path: str, line: int) -> Tuple[str, int, int]:
+    """Returns the innermost function holding a line, and its lines, or <module>."""
+    best = ("<module>", 0, 0)
+    for first, last, name in _functions(path)[0]:
+        if first <= line <= last and (best[1] == 0 or first >= best[1]):
+            best = (name, first, last)
+    return best
+
+
+def function_hash(function: str, src_dir: str) -> Optional[str]:
+    """Returns a hash of a function's source, given as module.qualname, or None if it's gone."""
+    module, _, qualname = function.partition(".")
+    path = os.path.join(src_dir, module + ".py")
+    if not os.path.exists(path):
+        return None
+    functions, lines = _functions(path)
+    if qualname == "<module>":
+        body = [line for i, line in enumerate(lines, 1)
+                if not any(first <= i <= last for first, last, _ in functions)]
+    else:
+        found = [(first, last) for first, last, name in functions if name == qualname]
+        if not found:
+            return None
+        first, last = found[0]
+        body = lines[first - 1:last]
+    return hashlib.sha256("\n".join(body).encode()).hexdigest()[:16]
+
+
+class Dependencies:
+    """What the checks of a design depend on.
+
+    Attributes:
+        fingerprint: The hash of the cone of influence of the checks.
+        functions: A hash of the source of each function of this directory
+            with logic in the cone, by module.qualname, like
+            sequencer_rom.SequencerROM.handle_load.
+    """
+
+    def __init__(self, fingerprint: str, functions: Dict[str, str]):
+        self.fingerprint = fingerprint
+        self.functions = functions
+
+    @classmethod
+    def of_file(cls, path: str) -> "Dependencies":
+        """Finds the dependencies of an RTLIL file, generated from this directory's sources."""
+        with open(path, encoding="utf-8") as f:
+            cone = Cone(parse_rtlil(f.read()))
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        functions = {}
+        for src in cone.sources():
+            file, _, line = src.rpartition(":")
+            if os.path.dirname(file) != src_dir or not line.split(".")[0].isdigit():
+                continue
+            name = _function_at(file, int(line.split(".")[0]))[0]
+            function = f"{os.path.splitext(os.path.basename(file))[0]}.{name}"
+            if function not in functions:
+                functions[function] = function_hash(function, src_dir)
+        return cls(cone.fingerprint(), dict(sorted(functions.items())))
+
+    def to_json(self) -> Dict:
+        """Returns the dependencies as a JSON-able dict."""
+        return {"fingerprint": self.fingerprint, "functions": self.functions}
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "Dependencies":
+        """Returns dependencies from to_json."""
+        return cls(data["fingerprint"], data["functions"])
+
+    def changed(self, other: "Dependencies") -> List[str]:
+        """Returns the functions this depends on whose source differs in another."""
+        return sorted(name for name, h in self.functions.items()
+                      if other.functions.get(name) != h)
+
+
+def main(argv: List[str]):
+    """Prints the cone fingerprint and the functions each RTLIL file depends on."""
+    parser = argparse.ArgumentParser(
+        prog="formal_deps.py",
+        description="Finds what the checks of generated RTLIL depend on.")
+    parser.add_argument("files", nargs="+", help="RTLIL files, like formal_cpu_op.il")
+    parser.add_argument("--functions", action="store_true",
+                        help="list the functions, not just how many of each module")
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        deps = Dependencies.of_file(path)
+        print(f"{path}: cone {deps.fingerprint}, {len(deps.functions)} functions")
+        by_module: Dict[str, List[str]] = {}
+        for function in deps.functions:
+            module, _, name = function.partition(".")
+            by_module.setdefault(module, []).append(name)
+        for module, names in sorted(by_module.items()):
+            if args.functions:
+                print(f"  {module}: {' '.join(names)}")
+            else:
+                print(f"  {module}: {len(names)}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,801 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module runs formal verification jobs over a pool of workers: the sby
+tasks of each formal_cpu mode, and those of the cards' .sby files.
+
+    python formal_jobs.py [TARGET...] [-j N] [--timeout SECS]
+        [--history FILE] [--results FILE] [--force] [--summary FILE]
+        [--sby CMD] [--make]
+
+A target is a formal_cpu task like op-prove or irq-bmc, a card task like
+alu_card-bmc, or a group: prove or bmc for that task of every mode, cards
+for every task of every card, and all for everything. The default is prove
+and cards.
+
+The RTLIL is generated first. The formal_cpu modes are generated with
+formal_cpu.py gen-all, which also writes their .sby files. The cards all
+generate toplevel.il, so each card is generated in a directory of its own
+under formal_runs, and its tasks run there. The formal_cpu tasks run here,
+like make runs them.
+
+A task that passed before doesn't run again if its .sby file, apart from
+its engines, and the cone of influence of its checks in the RTLIL are the
+same (see formal_deps.py).
+So editing the checks of one mode only runs that mode's tasks again. The
+outcomes, and the functions each task depended on, are kept in
+.formal_results.json, and a task that runs again shows which of those
+functions changed. --force runs every task.
+
+Then the sby tasks run, longest first. How long a task takes comes from
+its runtimes in earlier runs, kept in .formal_history.json. Tasks that
+never ran go first, the later modes first like in the Makefile. With the
+longest tasks started first, the workers stay busy until the end, so the
+wall-clock time approaches the total task time divided by the number of
+workers, or the longest task, whichever is more.
+
+With --portfolio, each task runs with several engines at once, smtbmc with
+z3, boolector and yices by default (see --engines). The first engine to
+pass or fail the task decides it, and the others are killed. The engine
+that won each formal_cpu task is kept in formal_engines.json, and
+formal_cpu.py gen writes it into the mode's .sby file, so later runs, and
+make, use the fastest engine of each task. Winning engines of the cards are
+only reported: their .sby files are written by hand.
+
+Each task that runs is added to the timing database, .formal_timing.db,
+with its engine, depth, whether it was a portfolio race, status, runtime,
+peak memory and RTLIL hash.
+formal_db.py report flags the prove tasks that got slower (see
+formal_db.py).
+
+The Makefile runs each task through --make, so that make's runs go into
+the timing database too. With --make the tasks run as make asks: their
+RTLIL is already generated, every task runs, and nothing but the timing
+database is written, since make -j runs many of these at once.
+
+A line is printed as each task finishes, and a JSON summary of every task
+is written to formal_summary.json. The exit status is 1 if any task didn't
+pass.
+"""
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import IO, Dict, List, Optional, Sequence, Tuple
+
+from formal_cpu import ENGINES_FILE, MODES, load_engines
+from formal_db import DEFAULT_DB, TimedRun, TimingDB
+from formal_deps import Dependencies
+from util import rtlil_digest
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_HISTORY = os.path.join(SRC_DIR, ".formal_history.json")
+DEFAULT_RESULTS = os.path.join(SRC_DIR, ".formal_results.json")
+DEFAULT_SUMMARY = "formal_summary.json"
+CARD_RUN_DIR = os.path.join(SRC_DIR, "formal_runs")
+
+# The tasks of each formal_cpu mode.
+CPU_TASKS = ("bmc", "prove")
+
+# The engines a portfolio races by default.
+PORTFOLIO = ("smtbmc z3", "smtbmc boolector", "smtbmc yices")
+
+# The statuses sby exits with, by exit status.
+_SBY_STATUS = {0: "PASS", 2: "FAIL", 4: "UNKNOWN", 8: "TIMEOUT", 16: "ERROR"}
+
+# The statuses that decide a task, ending a portfolio race.
+_CONCLUSIVE = ("PASS", "FAIL")
+
+# How often running sby processes are checked on, in seconds.
+_POLL_SECS = 0.1
+
+# The task names a line of a .sby file starts with, if it only applies to them.
+_TASK_PREFIX = re.compile(r"^\s*([\w ]+):(.*)$")
+
+# The runtimes of a task kept in the history.
+_HISTORY_RUNS = 5
+
+# The lines of sby's output kept for a task that didn't pass.
+_OUTPUT_LINES = 20
+
+# The changed functions shown for a task that runs again.
+_CHANGED_SHOWN = 5
+
+
+def _sby_sections(text: str) -> List[List[str]]:
+    """Splits a .sby file into its sections, each its header line and the lines after it."""
+    sections: List[List[str]] = [[]]
+    for line in text.splitlines():
+        if line.startswith("["):
+            sections.append([])
+        sections[-1].append(line)
+    return sections
+
+
+def with_engine(text: str, engine: str) -> str:
+    """Returns a .sby file with the engines of all its tasks replaced by one engine."""
+    sections = _sby_sections(text)
+    for section in sections:
+        if section and section[0].strip() == "[engines]":
+            section[1:] = [engine, ""] if engine else [""]
+    return "\n".join(line for section in sections for line in section) + "\n"
+
+
+def sby_task_lines(text: str, section: str, task: str) -> List[str]:
+    """Returns the lines of a section of a .sby file that apply to a task, without task prefixes.
+
+    Args:
+        text: The .sby file.
+        section: The section, like engines.
+        task: The task, like prove.
+    """
+    lines = []
+    for part in _sby_sections(text):
+        if not part or part[0].strip() != f"[{section}]":
+            continue
+        for line in part[1:]:
+            match = _TASK_PREFIX.match(line)
+            if match is None:
+                lines.append(line.strip())
+            elif task in match.group(1).split():
+                lines.append(match.group(2).strip())
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def sby_depth(text: str, task: str) -> Optional[int]:
+    """Returns the depth of a task in a .sby file, or None if it has none."""
+    for line in sby_task_lines(text, "options", task):
+        words = line.split()
+        if len(words) == 2 and words[0] == "depth" and words[1].isdigit():
+            return int(words[1])
+    return None
+
+
+def _engine_name(engine: str) -> str:
+    """Returns an engine, like smtbmc z3, as a file name part, like smtbmc_z3."""
+    return re.sub(r"\W+", "_", engine.strip())
+
+
+def _read_status(workdir: str, returncode: Optional[int]) -> str:
+    """Returns the status sby wrote, or the one its exit status stands for."""
+    try:
+        with open(os.path.join(workdir, "status"), encoding="utf-8") as f:
+            words = f.read().split()
+        if words:
+            return words[0]
+    except OSError:
+        pass
+    return _SBY_STATUS.get(returncode, "ERROR")
+
+
+class Job:
+    """One sby task.
+
+    Attributes:
+        name: The target name, like op-prove or alu_card-bmc.
+        sby: The .sby file, relative to cwd.
+        task: The task in the .sby file.
+        cwd: The directory sby runs in.
+        workdir: sby's work directory, holding its status and logs.
+        mode: The formal_cpu mode, or None for a card.
+        engine: The engine that won the job's portfolio race, or None.
+        started: When the job started, as an ISO 8601 UTC time.
+        peak_kb: The peak resident memory of sby or a solver it ran, in KiB,
+            or None if the job didn't end by itself.
+        status: PASS, FAIL, UNKNOWN, TIMEOUT or ERROR once the job ran, or
+            None.
+        seconds: How long sby ran.
+        returncode: sby's exit status, or None if it didn't exit by itself.
+        output: The last lines of sby's output, if the job didn't pass.
+        rtlil: The RTLIL file the task reads.
+        deps: What the task's checks depend on, once it's known.
+        reused: Whether the job didn't run, since it passed before with the
+            same dependencies.
+    """
+
+    def __init__(self, name: str, sby: str, task: str, cwd: str, rtlil: str, workdir: str,
+                 mode: Optional[str] = None):
+        self.name = name
+        self.sby = sby
+        self.task = task
+        self.cwd = cwd
+        self.rtlil = rtlil
+        self.deps: Optional[Dependencies] = None
+        self.reused = False
+        self.workdir = workdir
+        self.mode = mode
+        self.engine: Optional[str] = None
+        self.started = ""
+        self.peak_kb: Optional[int] = None
+        self.status: Optional[str] = None
+        self.seconds = 0.0
+        self.returncode: Optional[int] = None
+        self.output = ""
+
+    def run(self, sby_cmd: Sequence[str], timeout: Optional[float] = None,
+            engines: Sequence[str] = ()):
+        """Runs the task, killing sby and its solvers if it takes longer than the timeout.
+
+        Args:
+            sby_cmd: The command that runs sby.
+            timeout: The seconds the task may run, or None for no limit.
+            engines: Engines to race, each in a copy of the .sby file with
+                only that engine and a work directory of its own. The first
+                to pass or fail wins: its work directory becomes the job's,
+                and the others are killed. No engines runs the .sby file as
+                it is.
+        """
+        start = time.monotonic()
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        if engines:
+            stem = os.path.splitext(self.sby)[0]
+            with open(os.path.join(self.cwd, self.sby), encoding="utf-8") as f:
+                text = f.read()
+            runs = []
+            for engine in engines:
+                name = _engine_name(engine)
+                sby = f"{stem}.{self.task}-{name}.sby"
+                with open(os.path.join(self.cwd, sby), "w", encoding="utf-8") as f:
+                    f.write(with_engine(text, engine))
+                runs.append((engine, sby, f"{self.workdir}.{name}"))
+        else:
+            runs = [(None, self.sby, self.workdir)]
+
+        procs: List[subprocess.Popen] = []
+        logs = [tempfile.TemporaryFile("w+") for _ in runs]
+        try:
+            for (_, sby, workdir), log in zip(runs, logs):
+                cmd = list(sby_cmd) + ["-f", "-d", workdir, sby, self.task]
+                procs.append(subprocess.Popen(cmd, cwd=self.cwd, stdout=log,
+                                              stderr=subprocess.STDOUT, text=True,
+                                              start_new_session=True))
+        except OSError as e:
+            self.status = "ERROR"
+            self.output = str(e)
+        else:
+            self._wait(runs, procs, logs, start, timeout)
+        for proc in procs:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+        for log in logs:
+            log.close()
+        if engines:
+            for _, sby, workdir in runs:
+                os.remove(os.path.join(self.cwd, sby))
+                shutil.rmtree(workdir, ignore_errors=True)
+        self.seconds = time.monotonic() - start
+
+    def _wait(self, runs: List[Tuple[Optional[str], str, str]], procs: List[subprocess.Popen],
+              logs: List[IO[str]], start: float, timeout: Optional[float]):
+        """Waits for the first of the running sby processes to decide the task, or all to end.
+
+        The outcome is that of the process that decided the task, or else the
+        first one to end. If none ended before the timeout, the task timed out.
+        """
+        pending = list(range(len(procs)))
+        ended: List[int] = []
+        peak_kb: Dict[int, int] = {}
+        winner = None
+        while pending and winner is None:
+            for i in list(pending):
+                # Reaping the process here gives its peak memory, and that of
+                # the solvers it waited for.
+                pid, status, rusage = os.wait4(procs[i].pid, os.WNOHANG)
+                if pid == 0:
+                    continue
+                procs[i].returncode = os.waitstatus_to_exitcode(status)
+                peak_kb[i] = rusage.ru_maxrss
+                pending.remove(i)
+                ended.append(i)
+                if _read_status(runs[i][2], procs[i].returncode) in _CONCLUSIVE:
+                    winner = i
+                    break
+            if timeout is not None and time.monotonic() - start > timeout:
+                break
+            if pending and winner is None:
+                time.sleep(_POLL_SECS)
+
+        chosen = winner if winner is not None else (ended[0] if ended else None)
+        if chosen is None:
+            self.status = "TIMEOUT"
+            chosen = 0
+        else:
+            engine, _, workdir = runs[chosen]
+            self.returncode = procs[chosen].returncode
+            self.peak_kb = peak_kb[chosen]
+            self.status = _read_status(workdir, self.returncode)
+            if winner is not None:
+                self.engine = engine
+            if workdir != self.workdir:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+                os.rename(workdir, self.workdir)
+        if self.status != "PASS":
+            logs[chosen].seek(0)
+            self.output = "\n".join(logs[chosen].read().splitlines()[-_OUTPUT_LINES:])
+
+    def fail(self, why: str):
+        """Marks the job as not run, because its RTLIL couldn't be generated."""
+        self.status = "ERROR"
+        self.output = why
+
+    def summary(self) -> Dict:
+        """Returns the job and its outcome, for the JSON summary."""
+        return {"name": self.name, "sby": self.sby, "task": self.task,
+                "workdir": os.path.relpath(self.workdir, SRC_DIR), "status": self.status,
+                "seconds": round(self.seconds, 3), "returncode": self.returncode,
+                "reused": self.reused, "engine": self.engine, "peak_kb": self.peak_kb,
+                "output": self.output}
+
+
+class RuntimeHistory:
+    """The runtimes of each job in earlier runs.
+
+    Attributes:
+        path: The JSON file the history is kept in.
+        runs: The latest runtimes of each job, oldest first, by job name.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.runs: Dict[str, List[float]] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.runs = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def estimate(self, name: str) -> Optional[float]:
+        """Returns how long a job is expected to take, or None if it never ran."""
+        runs = self.runs.get(name)
+        return sum(runs) / len(runs) if runs else None
+
+    def record(self, job: Job):
+        """Adds the runtime of a job that ran.
+
+        A job that timed out took at least the timeout, which is recorded.
+        """
+        if job.returncode is None and job.status != "TIMEOUT":
+            return
+        self.runs[job.name] = (self.runs.get(job.name, []) + [job.seconds])[-_HISTORY_RUNS:]
+
+    def save(self):
+        """Writes the history back to its file."""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.runs, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def _file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def _sby_hash(path: str) -> str:
+    """Returns a hash of a .sby file without its engines, which don't change an outcome."""
+    with open(path, encoding="utf-8") as f:
+        return hashlib.sha256(with_engine(f.read(), "").encode()).hexdigest()[:16]
+
+
+class ProofResults:
+    """The outcome of each job the last time it ran, and what it depended on then.
+
+    A job that passed doesn't need to run again while its .sby file, apart
+    from its engines, and the cone of influence of its checks are the same
+    (see formal_deps.py).
+
+    Attributes:
+        path: The JSON file the results are kept in.
+        results: By job name, the job's status, the hashes of its .sby file
+            and RTLIL, and its dependencies.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.results: Dict[str, Dict] = {}
+        self._deps: Dict[str, Dependencies] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.results = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def dependencies(self, job: Job) -> Dependencies:
+        """Returns the dependencies of a job's RTLIL, only analyzing RTLIL it hasn't seen."""
+        rtlil = _file_hash(job.rtlil)
+        if rtlil not in self._deps:
+            for result in self.results.values():
+                if result.get("rtlil") == rtlil:
+                    self._deps[rtlil] = Dependencies.from_json(result["deps"])
+                    break
+            else:
+                self._deps[rtlil] = Dependencies.of_file(job.rtlil)
+        return self._deps[rtlil]
+
+    def _key(self, job: Job) -> str:
+        return f"{_sby_hash(os.path.join(job.cwd, job.sby))}-{job.task}-{job.deps.fingerprint}"
+
+    def reusable(self, job: Job) -> bool:
+        """Returns whether a job passed before with the same .sby file and cone."""
+        result = self.results.get(job.name)
+        return (result is not None and result["status"] == "PASS"
+                and result["key"] == self._key(job))
+
+    def changed(self, job: Job) -> Optional[List[str]]:
+        """Returns the functions in a job's cone that changed since it last ran, or None."""
+        result = self.results.get(job.name)
+        if result is None:
+            return None
+        return job.deps.changed(Dependencies.from_json(result["deps"]))
+
+    def record(self, job: Job):
+        """Keeps the outcome of a job that ran."""
+        if job.deps is None or job.reused:
+            return
+        self.results[job.name] = {"status": job.status, "key": self._key(job),
+                                  "rtlil": _file_hash(job.rtlil), "deps": job.deps.to_json()}
+
+    def save(self):
+        """Writes the results back to their file."""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.results, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def card_tasks() -> Dict[str, List[str]]:
+    """Returns the tasks of each card's .sby file, by card name."""
+    cards = {}
+    for path in sorted(glob.glob(os.path.join(SRC_DIR, "*.sby"))):
+        card = os.path.splitext(os.path.basename(path))[0]
+        if card == "formal_cpu" or not os.path.exists(os.path.join(SRC_DIR, f"{card}.py")):
+            continue
+        tasks = []
+        with open(path, encoding="utf-8") as f:
+            in_tasks = False
+            for line in f:
+                line = line.strip()
+                if line.startswith("["):
+                    in_tasks = line == "[tasks]"
+                elif in_tasks and line and not line.startswith("#"):
+                    tasks.append(line.split()[0])
+        cards[card] = tasks
+    return cards
+
+
+def make_jobs(targets: Sequence[str]) -> List[Job]:
+    """Returns the jobs for some targets, in the order to run them if none ever ran.
+
+    Raises:
+        ValueError: A target isn't a task or a group.
+    """
+    cards = card_tasks()
+    cpu_names = [f"{mode}-{task}" for task in reversed(CPU_TASKS) for mode in reversed(MODES)]
+    card_names = [f"{card}-{task}" for card, tasks in cards.items() for task in tasks]
+    groups = {
+        "all": cpu_names + card_names,
+        "cards": card_names,
+    }
+    for task in CPU_TASKS:
+        groups[task] = [name for name in cpu_names if name.endswith(f"-{task}")]
+
+    wanted = set()
+    for target in targets:
+        if target in groups:
+            wanted.update(groups[target])
+        elif target in cpu_names or target in card_names:
+            wanted.add(target)
+        else:
+            raise ValueError(f"unknown target {target}")
+
+    jobs = []
+    for name in cpu_names:
+        if name in wanted:
+            mode, task = name.rsplit("-", 1)
+            # The work directories are named like make names them.
+            jobs.append(Job(name, f"formal_cpu_{mode}.sby", task, SRC_DIR,
+                            os.path.join(SRC_DIR, f"formal_cpu_{mode}.il"),
+                            os.path.join(SRC_DIR, f"formal_cpu_{name}"), mode))
+    for card, tasks in cards.items():
+        for task in tasks:
+            if f"{card}-{task}" in wanted:
+                run_dir = os.path.join(CARD_RUN_DIR, card)
+                jobs.append(Job(f"{card}-{task}", f"{card}.sby", task, run_dir,
+                                os.path.join(run_dir, "toplevel.il"),
+                                os.path.join(run_dir, f"{card}_{task}")))
+    return jobs
+
+
+def _run_quietly(cmd: List[str], cwd: str) -> Optional[str]:
+    """Runs a command, and returns its output if it failed, or None."""
+    proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          text=True, check=False)
+    if proc.returncode == 0:
+        return None
+    return "\n".join(proc.stdout.splitlines()[-_OUTPUT_LINES:]) or f"exit status {proc.returncode}"
+
+
+def generate_rtlil(jobs: List[Job], workers: int):
+    """Generates the RTLIL the jobs read, and fails the jobs whose RTLIL couldn't be."""
+    modes = []
+    for job in jobs:
+        if job.mode is not None and job.mode not in modes:
+            modes.append(job.mode)
+    cards = {}
+    for job in jobs:
+        if job.mode is None:
+            cards.setdefault(job.sby[:-len(".sby")], []).append(job)
+
+    def gen_card(card: str) -> Optional[str]:
+        run_dir = os.path.join(CARD_RUN_DIR, card)
+        os.makedirs(run_dir, exist_ok=True)
+        shutil.copyfile(os.path.join(SRC_DIR, f"{card}.sby"), os.path.join(run_dir, f"{card}.sby"))
+        return _run_quietly([sys.executable, os.path.join(SRC_DIR, f"{card}.py"), "gen"], run_dir)
+
+    with concurrent.futures.ThreadPoolExecutor(max(workers, 1)) as pool:
+        card_errors = dict(zip(cards, pool.map(gen_card, cards)))
+    for card, error in card_errors.items():
+        if error is not None:
+            for job in cards[card]:
+                job.fail(f"{card}.py gen failed:\n{error}")
+
+    if modes:
+        error = _run_quietly([sys.executable, "formal_cpu.py", "gen-all", *modes,
+                              "-j", str(workers)], SRC_DIR)
+        if error is not None:
+            for job in jobs:
+                if job.mode is not None:
+                    job.fail(f"formal_cpu.py gen-all failed:\n{error}")
+
+
+def reuse_results(jobs: List[Job], results: ProofResults, verbose: bool = True):
+    """Finds what each job depends on, and passes the jobs that passed before with the same."""
+    for job in jobs:
+        if job.status is not None:
+            continue
+        try:
+            job.deps = results.dependencies(job)
+        except (OSError, ValueError) as e:
+            # Without dependencies, the job just runs.
+            if verbose:
+                print(f"{job.name:<24} can't find dependencies: {e}", flush=True)
+            continue
+        if results.reusable(job):
+            job.status = "PASS"
+            job.reused = True
+            if verbose:
+                print(f"{job.name:<24} PASS     (passed before, cone unchanged)", flush=True)
+        elif verbose:
+            changed = results.changed(job)
+            if changed:
+                shown = ", ".join(changed[:_CHANGED_SHOWN])
+                if len(changed) > _CHANGED_SHOWN:
+                    shown += f" and {len(changed) - _CHANGED_SHOWN} more"
+                print(f"{job.name:<24} changed: {shown}", flush=True)
+
+
+def run_jobs(jobs: List[Job], history: RuntimeHistory, workers: Optional[int] = None,
+             timeout: Optional[float] = None, sby_cmd: Sequence[str] = ("sby",),
+             results: Optional[ProofResults] = None, verbose: bool = True,
+             engines: Sequence[str] = (), db: Optional[TimingDB] = None,
+             gen: bool = True) -> float:
+    """Generates the RTLIL for some jobs, then runs them longest first.
+
+    Args:
+        jobs: The jobs, in the order to run them if none ever ran.
+        history: The runtimes of earlier runs, which the runtimes of these
+            are added to.
+        workers: The number of jobs to run at a time. Defaults to the number
+            of CPUs.
+        timeout: The seconds a job may run, or None for no limit.
+        sby_cmd: The command that runs sby.
+        results: The outcomes of earlier runs. Jobs that passed with the
+            same dependencies don't run again, and the outcomes of these are
+            added. None to run every job.
+        verbose: Print a line as each job finishes.
+        engines: Engines to race each job with, or none to run the .sby
+            files as they are.
+        db: The timing database to add each job that ran to, or None.
+        gen: Generate the RTLIL first. Without it, the RTLIL must be there.
+
+    Returns:
+        The wall-clock time the jobs took, in seconds.
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.monotonic()
+    if gen:
+        generate_rtlil(jobs, workers)
+    for job in jobs:
+        if job.status is not None and verbose:
+            print(f"{job.name:<24} {job.status}", flush=True)
+    if results is not None:
+        reuse_results(jobs, results, verbose)
+    to_run = [job for job in jobs if job.status is None]
+    # Jobs that never ran first, then the longest. The sort is stable.
+    to_run.sort(key=lambda job: (history.estimate(job.name) is not None,
+                                 -(history.estimate(job.name) or 0)))
+
+    done = len(jobs) - len(to_run)
+    commit = commit_id() if db is not None and to_run else None
+    with concurrent.futures.ThreadPoolExecutor(max(min(workers, len(to_run)), 1)) as pool:
+        futures = {pool.submit(job.run, sby_cmd, timeout, engines): job for job in to_run}
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            job = futures[future]
+            done += 1
+            estimate = history.estimate(job.name)
+            history.record(job)
+            if results is not None:
+                results.record(job)
+            if db is not None and (job.returncode is not None or job.status == "TIMEOUT"):
+                db.add(timed_run(job, commit, bool(engines)))
+            if verbose:
+                expected = f"expected {estimate:.1f}s" if estimate is not None else "first run"
+                won = f", won by {job.engine}" if job.engine is not None else ""
+                print(f"[{done}/{len(jobs)}] {job.name:<24} {job.status:<8} "
+                      f"{job.seconds:8.1f}s ({expected}{won})", flush=True)
+    return time.monotonic() - start
+
+
+def commit_id() -> Optional[str]:
+    """Returns the commit the sources are at, with -dirty if they were edited, or None."""
+    try:
+        proc = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=SRC_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                              check=False)
+    except OSError:
+        return None
+    return proc.stdout.strip() or None
+
+
+def timed_run(job: Job, commit: Optional[str], portfolio: bool = False) -> TimedRun:
+    """Returns a job that ran, as a row of the timing database.
+
+    Args:
+        job: The job.
+        commit: The commit the sources were at, or None if unknown.
+        portfolio: Whether the job raced several engines.
+    """
+    depth = engine = source = None
+    try:
+        with open(os.path.join(job.cwd, job.sby), encoding="utf-8") as f:
+            text = f.read()
+        depth = sby_depth(text, job.task)
+        engine = job.engine or "; ".join(sby_task_lines(text, "engines", job.task)) or None
+        with open(job.rtlil, encoding="utf-8") as f:
+            source = rtlil_digest(f.read())[:16]
+    except OSError:
+        pass
+    return TimedRun(job.started, job.name, job.name.rsplit("-", 1)[0], job.task, engine, depth,
+                    job.status, round(job.seconds, 3), job.peak_kb, source, commit, portfolio)
+
+
+def save_engines(jobs: List[Job], path: str = ENGINES_FILE):
+    """Adds the engines that won the formal_cpu jobs' races to an engines file."""
+    engines = load_engines(path)
+    engines.update({job.name: job.engine for job in jobs
+                    if job.mode is not None and job.engine is not None})
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(engines, f, indent=1, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def write_summary(jobs: List[Job], wall: float, workers: int, path: str):
+    """Writes a JSON summary of the jobs and how long they took."""
+    summary = {
+        "wall_seconds": round(wall, 3),
+        "task_seconds": round(sum(job.seconds for job in jobs), 3),
+        "workers": workers,
+        "passed": sum(job.status == "PASS" for job in jobs),
+        "jobs": [job.summary() for job in jobs],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=1)
+
+
+def _report_failures(jobs: List[Job]):
+    """Prints the jobs that didn't pass with their output, and exits with 1 if there are any."""
+    for job in jobs:
+        if job.status != "PASS":
+            print(f"\n{job.name}: {job.status}")
+            if job.output:
+                print(job.output)
+    if any(job.status != "PASS" for job in jobs):
+        sys.exit(1)
+
+
+def main(argv: List[str]):
+    """Runs formal verification jobs, and reports how they went."""
+    parser = argparse.ArgumentParser(
+        prog="formal_jobs.py",
+        description="Runs sby tasks for the formal_cpu modes and the cards over a worker pool.")
+    parser.add_argument("targets", nargs="*", default=["prove", "cards"],
+                        help="tasks like op-prove or alu_card-bmc, or all, prove, bmc or cards "
+                        "(default prove cards)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="tasks to run at a time (default the number of CPUs, divided by "
+                        "the number of engines with --portfolio)")
+    parser.add_argument("--timeout", metavar="SECS", type=float, default=None,
+                        help="kill a task after this many seconds")
+    parser.add_argument("--history", metavar="FILE", default=DEFAULT_HISTORY,
+                        help="runtime history to schedule from and add to "
+                        "(default .formal_history.json)")
+    parser.add_argument("--summary", metavar="FILE", default=DEFAULT_SUMMARY,
+                        help=f"JSON summary to write (default {DEFAULT_SUMMARY})")
+    parser.add_argument("--results", metavar="FILE", default=DEFAULT_RESULTS,
+                        help="outcomes of earlier runs to reuse and add to "
+                        "(default .formal_results.json)")
+    parser.add_argument("--force", action="store_true",
+                        help="run every task, even ones that passed before with the same cone")
+    parser.add_argument("--db", metavar="FILE", default=DEFAULT_DB,
+                        help="timing database to add the tasks to (default .formal_timing.db)")
+    parser.add_argument("--no-db", action="store_true",
+                        help="don't add the tasks to the timing database")
+    parser.add_argument("--sby", metavar="CMD", default="sby",
+                        help="command that runs sby (default sby)")
+    parser.add_argument("--portfolio", action="store_true",
+                        help="race engines on each task, and keep the winners of the formal_cpu "
+                        "tasks in formal_engines.json")
+    parser.add_argument("--engines", metavar="LIST", default=",".join(PORTFOLIO),
+                        help=f"comma-separated engines to race (default {','.join(PORTFOLIO)})")
+    parser.add_argument("--engines-file", metavar="FILE", default=ENGINES_FILE,
+                        help="where to keep the engines that won (default formal_engines.json)")
+    parser.add_argument("--make", action="store_true",
+                        help="run the tasks for make: don't generate the RTLIL or reuse "
+                        "results, and only add the tasks to the timing database")
+    args = parser.parse_args(argv)
+    if args.make and args.portfolio:
+        parser.error("--make runs the .sby files as they are, so can't race engines")
+    engines = [engine.strip() for engine in args.engines.split(",")
+               if engine.strip()] if args.portfolio else []
+
+    try:
+        jobs = make_jobs(args.targets)
+    except ValueError as e:
+        parser.error(str(e))
+    workers = args.jobs or max((os.cpu_count() or 1) // max(len(engines), 1), 1)
+    history = RuntimeHistory(args.history)
+    results = ProofResults(args.results)
+    db = None if args.no_db else TimingDB(args.db)
+    try:
+        wall = run_jobs(jobs, history, workers, args.timeout, args.sby.split(),
+                        None if args.force or args.make else results, engines=engines, db=db,
+                        gen=not args.make)
+    finally:
+        if db is not None:
+            db.close()
+    if args.make:
+        _report_failures(jobs)
+        return
+    history.save()
+    if engines:
+        save_engines(jobs, args.engines_file)
+    if not args.force:
+        results.save()
+    write_summary(jobs, wall, workers, args.summary)
+
+    passed = sum(job.status == "PASS" for job in jobs)
+    reused = sum(job.reused for job in jobs)
+    task_secs = sum(job.seconds for job in jobs)
+    print(f"{passed} of {len(jobs)} passed ({reused} from earlier runs) in {wall:.1f}s, "
+          f"{task_secs:.1f}s of tasks on {workers} workers")
+    _report_failures(jobs)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,722 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module fuzzes the CPU's microcode with constrained-random RV32I programs.
+
+The generator knows the decode rules of SequencerCard.encode_opcode_select
+and the SequencerROM inputs that come from the instruction: it picks every
+funct3 and bit 30 variant, makes zero immediates, x0 destinations and x0
+sources likely, uses the CSR numbers in CSRAddr (and some that aren't),
+misaligns loads, stores, jump targets and mepc, and mixes in illegal
+encodings: unimplemented opcodes, unknown privileged instructions and the
+all-zeros and all-ones words. Programs also raise the interrupt lines
+through two IrqSource devices, and pick the mtvec mode.
+
+Every program starts the same way, so they can be mutated and spliced:
+
+* A prologue loads the reserved registers, points mtvec at the trap vector
+  table, and loads x1-x23 with random values.
+* A trap vector table jumps to a handler that skips the faulting
+  instruction on exceptions, and lowers both interrupt lines on interrupts.
+* The body is the random part. It only jumps forwards, and only stores
+  relative to the data pointer, so it runs to the end unless it loops
+  through mret.
+* An epilogue writes 1 to TOHOST.
+
+Programs run on MicrocodeSim, collecting its microcode coverage (see
+rom_coverage.py). The coverage of a program is the set of SequencerROM,
+TrapROM and IrqLoadInstrROM addresses it exercised, and the trap causes it
+took. A program that covers something new is added to the corpus, and run
+in lockstep with the reference ISS (see difftest.py). A divergence, or an
+exception in either simulator, is saved with its report in crashes/ under
+the corpus directory.
+
+Workers run in parallel processes, each generating new programs and
+mutating those in the corpus. The corpus is a directory of flat images
+named by their hash, shared by the workers: each one picks up what the
+others found every so often.
+
+    python fuzz.py [--corpus DIR] [-j N] [--iterations N] [--seconds S]
+        [--seed N] [--length N] [--max-cycles N] [--no-difftest]
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+import sys
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from consts import CSRAddr, Instr, Opcode, SystemFunc
+from cpu_state import Halt
+from difftest import DiffTest
+from iss import ISS
+from microcode_sim import MicrocodeSim, rom_tables
+from rom_coverage import ROM_NAMES, RomCoverage, address_bits
+from sim_devices import DeviceBus, IrqSource
+from sim_memory import MainMemory
+from sim_trace import TRAP
+
+# The memory map of the programs.
+DATA = 0x1000
+TOHOST = DATA + 0x7F0
+EXT_IRQ = 0x10000
+TIME_IRQ = 0x11000
+
+# Reserved registers: the data pointer, the interrupt sources, the link
+# register of jalr, a scratch register for the body, the trap vector table
+# address, and the trap handler's scratch register.
+_DATA_REG = 27
+_EXT_REG = 25
+_TIME_REG = 24
+_JUMP_REG = 26
+_TMP_REG = 28
+_MTVEC_REG = 29
+_TRAP_REG = 30
+# The registers the body may write. x0 is picked as often as the rest together.
+_DEST_REGS = [0] * 23 + list(range(1, 24))
+
+# Opcodes the CPU doesn't implement, with the low bits of a 32-bit instruction.
+_IMPLEMENTED = {Opcode.LOAD, Opcode.OP_IMM, Opcode.STORE, Opcode.OP, Opcode.BRANCH,
+                Opcode.SYSTEM, Opcode.LUI, Opcode.JALR, Opcode.AUIPC, Opcode.JAL}
+_ILLEGAL_OPCODES = [op for op in range(3, 128, 4) if op not in _IMPLEMENTED]
+# CSRs that aren't implemented, or are read-only in real machines.
+_OTHER_CSRS = [0x000, 0x301, 0x340, 0xB00, 0xF11, 0xF14]
+# Unimplemented privileged instructions: uret, sret, wfi, sfence.vma.
+_OTHER_PRIV = [0x00200073, 0x10200073, 0x10500073, 0x12000073]
+
+
+def _r(opcode: int, rd: int, funct3: int, rs1: int, rs2: int, funct7: int = 0) -> int:
+    return opcode | rd << 7 | funct3 << 12 | rs1 << 15 | rs2 << 20 | funct7 << 25
+
+
+def _i(opcode: int, rd: int, funct3: int, rs1: int, imm: int) -> int:
+    return opcode | rd << 7 | funct3 << 12 | rs1 << 15 | (imm & 0xFFF) << 20
+
+
+def _s(funct3: int, rs1: int, rs2: int, imm: int) -> int:
+    return (Opcode.STORE | (imm & 0x1F) << 7 | funct3 << 12 | rs1 << 15 | rs2 << 20 |
+            (imm >> 5 & 0x7F) << 25)
+
+
+def _b(funct3: int, rs1: int, rs2: int, offset: int) -> int:
+    return (Opcode.BRANCH | (offset >> 11 & 1) << 7 | (offset >> 1 & 0xF) << 8 |
+            funct3 << 12 | rs1 << 15 | rs2 << 20 | (offset >> 5 & 0x3F) << 25 |
+            (offset >> 12 & 1) << 31)
+
+
+def _jal(rd: int, offset: int) -> int:
+    return (Opcode.JAL | rd << 7 | (offset >> 12 & 0xFF) << 12 | (offset >> 11 & 1) << 20 |
+            (offset >> 1 & 0x3FF) << 21 | (offset >> 20 & 1) << 31)
+
+
+def _u(opcode: int, rd: int, imm: int) -> int:
+    return opcode | rd << 7 | (imm & 0xFFFFF) << 12
+
+
+def _li(rd: int, value: int) -> List[int]:
+    """Returns lui rd, %hi(value); addi rd, rd, %lo(value)."""
+    hi = (value + 0x800) >> 12
+    return [_u(Opcode.LUI, rd, hi), _i(Opcode.OP_IMM, rd, 0, rd, value - (hi << 12))]
+
+
+def _jump_offset(word: int) -> Optional[int]:
+    """Returns the offset of a jal or branch, the immediate of a jalr, or None."""
+    opcode = word & 0x7F
+    if opcode == Opcode.JAL:
+        offset = ((word >> 31) << 20 | ((word >> 12) & 0xFF) << 12 | ((word >> 20) & 1) << 11 |
+                  ((word >> 21) & 0x3FF) << 1)
+        return offset - (1 << 21 if offset >> 20 else 0)
+    if opcode == Opcode.BRANCH:
+        offset = ((word >> 31) << 12 | ((word >> 7) & 1) << 11 | ((word >> 25) & 0x3F) << 5 |
+                  ((word >> 8) & 0xF) << 1)
+        return offset - (1 << 13 if offset >> 12 else 0)
+    if opcode == Opcode.JALR:
+        return (word >> 20) - (1 << 12 if word >> 31 else 0)
+    return None
+
+
+def _uses_tmp(word: int) -> bool:
+    """Returns whether an instruction may read the scratch register, or is mret."""
+    return word == Instr.MRET or _TMP_REG in ((word >> 15) & 0x1F, (word >> 20) & 0x1F)
+
+
+# The trap vector table has an entry for each cause up to the external
+# interrupt, for vectored mode. They all jump to the handler.
+_VECTORS = 12
+_HANDLER = [
+    # csrrs t5, mcause, zero; blt t5, zero, irq; mret
+    _i(Opcode.SYSTEM, _TRAP_REG, SystemFunc.CSRRS, 0, CSRAddr.MCAUSE),
+    _b(4, _TRAP_REG, 0, 8),
+    Instr.MRET,
+    # irq: lower both lines; mret
+    _s(2, _EXT_REG, 0, 0),
+    _s(2, _TIME_REG, 0, 0),
+    Instr.MRET,
+]
+# The number of words before the vector table, and before the body.
+_PROLOGUE = 7 + 2 * 23 + 1
+_BODY = _PROLOGUE + _VECTORS + len(_HANDLER)
+_EPILOGUE = 3
+
+# The tags of coverage points, above their 32-bit address or cause.
+COVER_SEQ, COVER_TRAP, COVER_IRQ_LOAD, COVER_CAUSE = range(4)
+COVER_NAMES = ("SequencerROM addresses", "TrapROM addresses", "IrqLoadInstrROM addresses",
+               "trap causes")
+
+
+class ProgramGenerator:
+    """Generates and mutates constrained-random programs.
+
+    Attributes:
+        rng: The random number generator.
+        length: The number of words in the body of a new program.
+        fault_rate: The share of new programs that take a fatal exception.
+        irqs: Whether the program being made raises interrupts, rather than
+            taking ecall and ebreak. Once the CPU has taken an exception,
+            interrupts don't save mepc, so a program doing both would loop.
+    """
+
+    def __init__(self, rng: random.Random, length: int = 64, fault_rate: float = 0.5):
+        self.rng = rng
+        self.length = length
+        self.fault_rate = fault_rate
+        self.irqs = False
+
+    def _value(self) -> int:
+        """Returns a register value, often an interesting one."""
+        rng = self.rng
+        return rng.choice([0, 1, 2, 3, 4, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF,
+                           rng.randrange(-64, 64) & 0xFFFFFFFF, rng.getrandbits(32)])
+
+    def _reg(self) -> int:
+        """Returns a source register: x0 often, then the rest."""
+        return self.rng.choice([0, 0, 0, self.rng.randrange(32)])
+
+    def _imm(self, bits: int = 12) -> int:
+        """Returns an immediate, zero often since the ROM decodes that."""
+        rng = self.rng
+        return rng.choice([0, 0, 1, -1, rng.randrange(-1 << (bits - 1), 1 << (bits - 1))])
+
+    def _csr(self) -> int:
+        """Returns a CSR number, usually one of CSRAddr."""
+        return self.rng.choice(list(CSRAddr) * 3 + _OTHER_CSRS + [self.rng.randrange(4096)])
+
+    def prologue(self) -> List[int]:
+        """Returns the prologue, with random register values and mtvec mode."""
+        rng = self.rng
+        mode = rng.choice([0, 0, 1, 1, 2, 3])
+        words = [_u(Opcode.LUI, _DATA_REG, DATA >> 12),
+                 _u(Opcode.LUI, _EXT_REG, EXT_IRQ >> 12),
+                 _u(Opcode.LUI, _TIME_REG, TIME_IRQ >> 12),
+                 _i(Opcode.OP_IMM, _JUMP_REG, 0, 0, 4 * _BODY),
+                 _u(Opcode.AUIPC, _MTVEC_REG, 0),
+                 _i(Opcode.OP_IMM, _MTVEC_REG, 0, _MTVEC_REG, 4 * (_PROLOGUE - 4) + mode),
+                 _i(Opcode.SYSTEM, 0, SystemFunc.CSRRW, _MTVEC_REG, CSRAddr.MTVEC)]
+        for rd in range(1, 24):
+            words += _li(rd, self._value())
+        words.append(_jal(0, 4 * (_BODY - len(words))))
+        return words
+
+    @staticmethod
+    def vectors() -> List[int]:
+        """Returns the trap vector table and the trap handler."""
+        return [_jal(0, 4 * (_VECTORS - i)) for i in range(_VECTORS)] + _HANDLER
+
+    @staticmethod
+    def epilogue() -> List[int]:
+        """Returns the words that write 1 to TOHOST, then loop."""
+        return [_i(Opcode.OP_IMM, _TMP_REG, 0, 0, 1),
+                _s(2, _DATA_REG, _TMP_REG, TOHOST - DATA),
+                _jal(0, 0)]
+
+    def program(self) -> List[int]:
+        """Returns a new program, which faults at a random point fault_rate of the time."""
+        rng = self.rng
+        self.irqs = rng.random() < 0.5
+        body: List[int] = []
+        fault_at = rng.randrange(self.length) if rng.random() < self.fault_rate else None
+        while len(body) < self.length:
+            fault = fault_at is not None and len(body) >= fault_at
+            body += self.group(fault)
+            if fault:
+                fault_at = None
+        self.resolve(body)
+        return self.prologue() + self.vectors() + body + self.epilogue()
+
+    def group(self, fault: bool = False) -> List[int]:
+        """Returns a few instructions for the body.
+
+        Jumps and branches are left with only the low bits of their offset
+        or target, for resolve to fill in.
+
+        Args:
+            fault: Return instructions that take a fatal exception, instead
+                of ones that don't.
+        """
+        if fault:
+            return self._fault_group()
+        rng = self.rng
+        rd = rng.choice(_DEST_REGS)
+        rs1, rs2 = self._reg(), self._reg()
+        funct3 = rng.randrange(8)
+        kind = rng.randrange(15)
+        if kind < 3:
+            # Bit 30 selects sub and sra; the other funct7 bits are ignored.
+            funct7 = rng.choice([0, 0, rng.randrange(128) & ~0x20])
+            if funct3 in (0, 5) and rng.random() < 0.5:
+                funct7 |= 0x20
+            return [_r(Opcode.OP, rd, funct3, rs1, rs2, funct7)]
+        if kind < 6:
+            imm = self._imm()
+            if funct3 in (1, 5):
+                imm = rng.randrange(32) | rng.choice([0, rng.randrange(128) << 5]) & ~0x400
+                if funct3 == 5 and rng.random() < 0.5:
+                    imm |= 0x400
+            return [_i(Opcode.OP_IMM, rd, funct3, rs1, imm)]
+        if kind == 6:
+            return [_u(rng.choice([Opcode.LUI, Opcode.AUIPC]), rd,
+                       rng.choice([0, rng.getrandbits(20)]))]
+        if kind == 7:
+            # Aligned loads from the data, or byte loads from anywhere.
+            funct3 = rng.choice([0, 1, 2, 4, 5])
+            if rng.random() < 0.25:
+                return [_i(Opcode.LOAD, rd, funct3 & 4, rs1, self._imm())]
+            size = 1 << (funct3 & 3)
+            return [_i(Opcode.LOAD, rd, funct3, _DATA_REG, rng.randrange(-64, 64) * size)]
+        if kind == 8:
+            funct3 = rng.randrange(3)
+            return [_s(funct3, _DATA_REG, rs2, rng.randrange(-64, 64) << funct3)]
+        if kind == 9:
+            return [_b(rng.choice([0, 1, 4, 5, 6, 7]), rs1, rs2, 0)]
+        if kind == 10:
+            rd = rng.choice([0, 1, 5, rd])
+            if rng.random() < 0.5:
+                return [_jal(rd, 0)]
+            # jalr clears bit 0 of the target, and ignores funct3. The target
+            # is absolute, from x0 or from the body pointer, so that it
+            # doesn't depend on the instructions before it running.
+            return [_i(Opcode.JALR, rd, rng.choice([0, 0, funct3]), rng.choice([0, _JUMP_REG]),
+                       rng.choice([0, 0, 1]))]
+        if kind < 13:
+            return self._csr_group(rd, rs1)
+        if kind == 13:
+            return self._mret_group()
+        if self.irqs:
+            return self._irq_group()
+        return [rng.choice([Instr.ECALL, Instr.EBREAK])]
+
+    def resolve(self, body: List[int]):
+        """Points the unresolved jumps and branches of a body forwards.
+
+        A jump is unresolved if its offset, or its target for jalr, is less
+        than 4. It goes up to 8 words forwards, keeping those low bits, to an
+        instruction that doesn't use the scratch register and isn't mret,
+        since those depend on the instructions before them, or to the end of
+        the body.
+        """
+        rng = self.rng
+        landing = [not _uses_tmp(word) for word in body] + [True]
+        for pos, word in enumerate(body):
+            low_bits = _jump_offset(word)
+            if low_bits is None or not 0 <= low_bits < 4:
+                continue
+            targets = [t for t in range(pos + 1, min(pos + 9, len(body) + 1)) if landing[t]]
+            target = rng.choice(targets or [len(body)])
+            rd, funct3, rs1 = (word >> 7) & 0x1F, (word >> 12) & 7, (word >> 15) & 0x1F
+            if word & 0x7F == Opcode.JAL:
+                body[pos] = _jal(rd, 4 * (target - pos) + low_bits)
+            elif word & 0x7F == Opcode.BRANCH:
+                body[pos] = _b(funct3, rs1, (word >> 20) & 0x1F, 4 * (target - pos) + low_bits)
+            elif rs1 == 0 and 4 * (_BODY + target) < 2048:
+                body[pos] = _i(Opcode.JALR, rd, funct3, 0, 4 * (_BODY + target) + low_bits)
+            else:
+                body[pos] = _i(Opcode.JALR, rd, funct3, _JUMP_REG, 4 * target + low_bits)
+
+    def _csr_group(self, rd: int, rs1: int) -> List[int]:
+        """Returns a CSR instruction that doesn't break the trap vector."""
+        rng = self.rng
+        csr = self._csr()
+        funct3 = rng.choice(list(SystemFunc)[1:])
+        if csr == CSRAddr.MTVEC:
+            # Keep mtvec pointing at the vector table, but maybe change its mode.
+            if funct3 in (SystemFunc.CSRRW, SystemFunc.CSRRWI):
+                return [_i(Opcode.SYSTEM, rd, SystemFunc.CSRRW, _MTVEC_REG, csr)]
+            rs1 = rng.randrange(4) if funct3 & 4 else 0
+        return [_i(Opcode.SYSTEM, rd, funct3, rs1, csr)]
+
+    @staticmethod
+    def _mret_group(misalign: int = 0) -> List[int]:
+        """Returns an mret to the instruction after it, plus misalign bytes."""
+        return [_u(Opcode.AUIPC, _TMP_REG, 0),
+                _i(Opcode.OP_IMM, _TMP_REG, 0, _TMP_REG, 16 + misalign),
+                _i(Opcode.SYSTEM, 0, SystemFunc.CSRRW, _TMP_REG, CSRAddr.MEPC),
+                Instr.MRET]
+
+    def _irq_group(self) -> List[int]:
+        """Returns instructions that enable interrupts or raise an interrupt line."""
+        rng = self.rng
+        if rng.random() < 0.5:
+            # Set MEIE and MTIE in mie, and MIE in mstatus.
+            return _li(_TMP_REG, rng.choice([0x880, 0x800, 0x80])) + [
+                _i(Opcode.SYSTEM, 0, SystemFunc.CSRRS, _TMP_REG, CSRAddr.MIE),
+                _i(Opcode.SYSTEM, 0, SystemFunc.CSRRSI, 8, CSRAddr.MSTATUS)]
+        # Raise a line. The ISS samples the lines at the end of each
+        # instruction, so IrqSource's delayed raise, which can come in the
+        # middle of one, would make false divergences.
+        return [_i(Opcode.OP_IMM, _TMP_REG, 0, 0, 1),
+                _s(2, rng.choice([_EXT_REG, _TIME_REG]), _TMP_REG, 0)]
+
+    def _fault_group(self) -> List[int]:
+        """Returns instructions that take a fatal exception: illegal or misaligned."""
+        rng = self.rng
+        rd = rng.choice(_DEST_REGS)
+        choice = rng.randrange(11)
+        if choice == 0:
+            # Low 16 bits of zero, or all ones, are bad instructions.
+            return [rng.choice([0, 0xFFFFFFFF, rng.getrandbits(16) << 16])]
+        if choice == 1:
+            return [rng.choice(_OTHER_PRIV + [_i(Opcode.SYSTEM, rd, SystemFunc.PRIV,
+                                                 rng.randrange(32), rng.getrandbits(12))])]
+        if choice == 2:
+            # Low bits other than 0b11 mean a compressed instruction.
+            return [rng.getrandbits(32) & ~3 | rng.randrange(3)]
+        if choice == 3:
+            return [rng.getrandbits(25) << 7 | rng.choice(_ILLEGAL_OPCODES)]
+        if choice == 4:
+            # The unused funct3 of loads, stores, branches and SYSTEM.
+            return [rng.choice([_i(Opcode.LOAD, rd, rng.choice([3, 6, 7]), _DATA_REG, 0),
+                                _s(rng.randrange(3, 8), _DATA_REG, 0, 0),
+                                _b(rng.choice([2, 3]), 0, 0, 4),
+                                _i(Opcode.SYSTEM, rd, 4, 0, self._csr())])]
+        if choice == 5:
+            # Bit 30 with an ALU function that has no alternate.
+            funct3 = rng.choice([1, 2, 3, 4, 6, 7])
+            if rng.random() < 0.5 or funct3 != 1:
+                return [_r(Opcode.OP, rd, funct3, self._reg(), self._reg(), 0x20)]
+            return [_i(Opcode.OP_IMM, rd, 1, self._reg(), 0x400 | rng.randrange(32))]
+        if choice == 6:
+            funct3 = rng.choice([1, 2, 5])
+            offset = rng.randrange(-64, 64) * 4 + rng.choice([1, 2, 3] if funct3 == 2 else [1, 3])
+            return [_i(Opcode.LOAD, rd, funct3, _DATA_REG, offset)]
+        if choice == 7:
+            funct3 = rng.choice([1, 2])
+            offset = rng.randrange(-64, 64) * 4 + rng.choice([1, 2, 3] if funct3 == 2 else [1, 3])
+            return [_s(funct3, _DATA_REG, self._reg(), offset)]
+        if choice == 8:
+            # A taken branch or jal to a target that is 2 mod 4.
+            if rng.random() < 0.5:
+                return [_jal(rd, 2)]
+            return [_b(rng.choice([0, 5, 7]), 0, 0, 2)]
+        if choice == 9:
+            return [_i(Opcode.JALR, rd, 0, rng.choice([0, _JUMP_REG]), rng.choice([2, 3]))]
+        return self._mret_group(misalign=rng.choice([1, 2, 3]))
+
+    def mutate(self, program: List[int], other: Optional[List[int]] = None) -> List[int]:
+        """Returns a mutated copy of a program, maybe spliced with another."""
+        rng = self.rng
+        prologue, body = program[:_BODY], program[_BODY:-_EPILOGUE]
+        choice = rng.randrange(4)
+        if choice == 0 and other is not None:
+            # The bodies start at the same address.
+            other_body = other[_BODY:-_EPILOGUE]
+            cut = rng.randrange(min(len(body), len(other_body)) + 1)
+            # Keep the longer length, so jumps stay in range.
+            body = body[:cut] + other_body[cut:] + body[len(other_body):]
+        elif choice == 1:
+            prologue = prologue[:]
+            if rng.random() < 0.5:
+                rd = rng.randrange(1, 24)
+                prologue[5 + 2 * rd:7 + 2 * rd] = _li(rd, self._value())
+            else:
+                prologue[:_PROLOGUE] = self.prologue()
+        else:
+            body = body[:]
+            # Overwrite, so that the instructions keep their addresses.
+            for _ in range(rng.randint(1, 4)):
+                pos = rng.randrange(len(body))
+                fault = rng.random() < self.fault_rate / 8
+                words = self.group(fault)[:len(body) - pos]
+                body[pos:pos + len(words)] = words
+            self.resolve(body)
+        return prologue + body + self.epilogue()
+
+
+def image(program: List[int]) -> bytes:
+    """Returns the flat image of a program."""
+    return b"".join(word.to_bytes(4, "little") for word in program)
+
+
+def from_image(data: bytes) -> List[int]:
+    """Returns the words of a flat image."""
+    return [int.from_bytes(data[i:i + 4], "little") for i in range(0, len(data) - 3, 4)]
+
+
+class _TrapCauses:
+    """A trace sink that records the causes of trap entries."""
+
+    def __init__(self, hits: Set[int]):
+        self.records: List[int] = []
+        self.block_records = 1 << 62
+        self.hits = hits
+
+    def add(self, record: Tuple[int, ...]):
+        # The flags are bits 8-15 of info, and addr holds mcause.
+        if record[3] >> 8 & TRAP:
+            self.hits.add(COVER_CAUSE << 32 | record[5])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _make_sim(engine, program: List[int]):
+    memory = MainMemory()
+    memory.load_image(image(program), 0)
+    sim = engine(memory, tohost=TOHOST)
+    DeviceBus(memory, [IrqSource(EXT_IRQ, "ext"), IrqSource(TIME_IRQ, "time")]).attach(sim)
+    return sim
+
+
+def coverage(program: List[int], max_cycles: int = 20000) -> Tuple[Set[int], Halt]:
+    """Runs a program on MicrocodeSim and returns what it covered, and how it halted.
+
+    Coverage points are tagged with COVER_SEQ, COVER_TRAP, COVER_IRQ_LOAD or
+    COVER_CAUSE in bits 32 and up.
+    """
+    hits: Set[int] = set()
+    sim = _make_sim(MicrocodeSim, program)
+    sim.coverage = RomCoverage()
+    sim.trace = _TrapCauses(hits)
+    stats = sim.run(max_cycles=max_cycles)
+    for tag, name in ((COVER_SEQ, "sequencer_rom"), (COVER_TRAP, "trap_rom"),
+                      (COVER_IRQ_LOAD, "irq_load_rom")):
+        hits.update((tag << 32 | sim.coverage.hit(name)).tolist())
+    # The CPU hangs on a fatal exception, before the trap entry completes.
+    if stats.halt == Halt.FATAL:
+        hits.add(COVER_CAUSE << 32 | sim.state.mcause)
+    return hits, stats.halt
+
+
+def difftest(program: List[int], max_cycles: int = 20000) -> Optional[str]:
+    """Runs a program on MicrocodeSim and the ISS in lockstep.
+
+    Returns:
+        The divergence report, or None if they agree.
+    """
+    dut = _make_sim(MicrocodeSim, program)
+    ref = _make_sim(ISS, program)
+    # Instructions, not machine cycles, keep the simulators in step. Each
+    # takes at least one machine cycle.
+    divergence = DiffTest(dut, ref, chunk=256).run(max_instrs=max_cycles)
+    return divergence.report() if divergence is not None else None
+
+
+class Fuzzer:
+    """A fuzzing worker sharing a corpus directory with the others.
+
+    Attributes:
+        corpus_dir: The corpus directory.
+        crash_dir: The directory to save crashes in.
+        generator: The program generator.
+        max_cycles: The machine cycles after which a program is stopped.
+        check: Whether to difftest programs that cover something new.
+        covered: What the corpus covers.
+        corpus: The programs in the corpus that this worker knows.
+        stats: The number of programs run, added to the corpus, and that crashed.
+    """
+
+    def __init__(self, corpus_dir: str, seed: int, length: int = 64,
+                 max_cycles: int = 20000, check: bool = True):
+        self.corpus_dir = corpus_dir
+        self.crash_dir = os.path.join(corpus_dir, "crashes")
+        self.generator = ProgramGenerator(random.Random(seed), length)
+        self.max_cycles = max_cycles
+        self.check = check
+        self.covered: Set[int] = set()
+        self.corpus: List[List[int]] = []
+        self.stats = {"runs": 0, "added": 0, "crashes": 0, "timeouts": 0}
+        self._known: Set[str] = set()
+        os.makedirs(self.crash_dir, exist_ok=True)
+
+    def sync(self):
+        """Picks up the programs other workers added to the corpus."""
+        for name in sorted(os.listdir(self.corpus_dir)):
+            if not name.endswith(".bin") or name in self._known:
+                continue
+            self._known.add(name)
+            with open(os.path.join(self.corpus_dir, name), "rb") as f:
+                program = from_image(f.read())
+            if len(program) <= _BODY + _EPILOGUE:
+                continue
+            try:
+                hits, _ = coverage(program, self.max_cycles)
+            except Exception:  # pylint: disable=W0703
+                continue
+            self.covered |= hits
+            self.corpus.append(program)
+
+    def _save(self, directory: str, program: List[int], report: Optional[str] = None) -> str:
+        data = image(program)
+        name = hashlib.sha1(data).hexdigest()[:16]
+        path = os.path.join(directory, name + ".bin")
+        # Written under a temporary name first, so that no worker reads half a file.
+        tmp = os.path.join(directory, f".{name}.{os.getpid()}")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        if report is not None:
+            with open(os.path.join(directory, name + ".txt"), "w", encoding="utf-8") as f:
+                f.write(report + "\n")
+        self._known.add(name + ".bin")
+        return path
+
+    def step(self):
+        """Runs one program, new or mutated, and keeps it if it covers something new."""
+        gen = self.generator
+        if self.corpus and gen.rng.random() < 0.75:
+            program = gen.mutate(gen.rng.choice(self.corpus), gen.rng.choice(self.corpus))
+        else:
+            program = gen.program()
+        self.stats["runs"] += 1
+        try:
+            hits, halt = coverage(program, self.max_cycles)
+        except Exception:  # pylint: disable=W0703
+            self._crash(program, "MicrocodeSim raised:\n" + traceback.format_exc())
+            return
+        if halt == Halt.MAX_CYCLES:
+            self.stats["timeouts"] += 1
+        if hits <= self.covered:
+            return
+        self.covered |= hits
+        self.corpus.append(program)
+        self.stats["added"] += 1
+        self._save(self.corpus_dir, program)
+        # Runs stopped at a limit aren't checked: the simulators would stop
+        # at different points.
+        if self.check and halt != Halt.MAX_CYCLES:
+            try:
+                report = difftest(program, self.max_cycles)
+            except Exception:  # pylint: disable=W0703
+                report = "difftest raised:\n" + traceback.format_exc()
+            if report is not None:
+                self._crash(program, report)
+
+    def _crash(self, program: List[int], report: str):
+        self.stats["crashes"] += 1
+        path = self._save(self.crash_dir, program, report)
+        print(f"crash: {path}\n{report}", flush=True)
+
+
+def _fuzz(job) -> Dict[str, Any]:
+    """Runs a worker for a number of programs or seconds, and returns its stats."""
+    index, corpus_dir, seed, iterations, seconds, length, max_cycles, check, sync_every = job
+    fuzzer = Fuzzer(corpus_dir, seed + index, length, max_cycles, check)
+    fuzzer.sync()
+    start = time.perf_counter()
+    n = 0
+    while ((iterations is None or n < iterations) and
+           (seconds is None or time.perf_counter() - start < seconds)):
+        fuzzer.step()
+        n += 1
+        if n % sync_every == 0:
+            fuzzer.sync()
+            print(f"worker {index}: {n} runs, {len(fuzzer.covered)} points covered, "
+                  f"corpus {len(fuzzer.corpus)}", flush=True)
+    return dict(fuzzer.stats, covered=sorted(fuzzer.covered))
+
+
+def run_fuzzers(corpus_dir: str, jobs: int = 1, seed: int = 0,
+                iterations: Optional[int] = None, seconds: Optional[float] = None,
+                length: int = 64, max_cycles: int = 20000, check: bool = True,
+                sync_every: int = 100) -> Dict[str, Any]:
+    """Runs fuzzing workers in parallel.
+
+    Args:
+        corpus_dir: The corpus directory, made if it doesn't exist.
+        jobs: The number of worker processes.
+        seed: The random seed of the first worker; the others count up from it.
+        iterations: The number of programs each worker runs, if limited.
+        seconds: How long each worker runs, if limited.
+        length: The number of body words in new programs.
+        max_cycles: The machine cycles after which a program is stopped.
+        check: Whether to difftest the programs that cover something new.
+        sync_every: The number of programs a worker runs between looks at the
+            corpus directory.
+
+    Returns:
+        The totals of the workers' stats, and covered, the union of what they covered.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    # Load the ROM tables before forking, so that the workers share them.
+    rom_tables()
+    for name in ROM_NAMES:
+        address_bits(name)
+    work = [(i, corpus_dir, seed, iterations, seconds, length, max_cycles, check, sync_every)
+            for i in range(jobs)]
+    if jobs == 1:
+        results = [_fuzz(work[0])]
+    else:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        with context.Pool(jobs) as pool:
+            results = pool.map(_fuzz, work)
+    totals: Dict[str, Any] = {key: sum(r[key] for r in results)
+                              for key in ("runs", "added", "crashes", "timeouts")}
+    covered: Set[int] = set()
+    for result in results:
+        covered.update(result["covered"])
+    totals["covered"] = covered
+    return totals
+
+
+def main(argv: List[str]):
+    """Fuzzes the microcode, and reports the coverage reached."""
+    parser = argparse.ArgumentParser(
+        prog="fuzz.py", description="Fuzzes the CPU's microcode with random RV32I programs.")
+    parser.add_argument("--corpus", metavar="DIR", default="fuzz-corpus",
+                        help="corpus directory shared by the workers (default fuzz-corpus)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default the number of CPUs)")
+    parser.add_argument("--iterations", type=int, default=None,
+                        help="programs each worker runs")
+    parser.add_argument("--seconds", type=float, default=None,
+                        help="seconds each worker runs")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed of the first worker (default random)")
+    parser.add_argument("--length", type=int, default=64,
+                        help="instructions in the body of new programs (default 64)")
+    parser.add_argument("--max-cycles", type=int, default=20000,
+                        help="machine cycles after which a program is stopped (default 20000)")
+    parser.add_argument("--no-difftest", action="store_true",
+                        help="don't check new corpus programs against the ISS")
+    args = parser.parse_args(argv)
+    if args.iterations is None and args.seconds is None:
+        parser.error("give --iterations or --seconds")
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    jobs = args.jobs or os.cpu_count() or 1
+    print(f"fuzzing with {jobs} workers, seed {seed}")
+
+    start = time.perf_counter()
+    totals = run_fuzzers(args.corpus, jobs, seed, args.iterations, args.seconds, args.length,
+                         args.max_cycles, not args.no_difftest)
+    elapsed = time.perf_counter() - start
+    print(f"{totals['runs']} programs in {elapsed:.1f} s "
+          f"({totals['runs'] / max(elapsed, 1e-9):.1f}/s), {totals['added']} added to the "
+          f"corpus, {totals['timeouts']} timed out, {totals['crashes']} crashes")
+    for tag, name in enumerate(COVER_NAMES):
+        points = [point & 0xFFFFFFFF for point in totals["covered"] if point >> 32 == tag]
+        line = f"  {name}: {len(points)}"
+        if tag == COVER_CAUSE:
+            line += " (" + ", ".join(f"{cause:#x}" for cause in sorted(points)) + ")"
+        print(line)
+    if totals["crashes"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,676 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+# Disable "too many branches/statements/locals": the interpreter loop is
+# deliberately flat for speed.
+# pylint: disable=R0912,R0914,R0915
+"""
+This module provides a fast functional instruction-set simulator (ISS).
+
+The ISS is the golden model for the CPU. It implements the RV32I + Zicsr
+subset exactly as the SequencerROM, TrapROM and IrqCard do, including the
+choices that differ from a generic RISC-V core:
+
+* Misaligned loads, stores and jump/branch targets are fatal exceptions.
+  The CPU stores mcause, mepc and mtval, and then hangs.
+* FENCE, and any opcode the sequencer doesn't recognize, is an illegal
+  instruction, which is also fatal. So are instructions whose low 16 bits
+  are all zero, and 0xFFFFFFFF.
+* ECALL and EBREAK are non-fatal. mepc is set to PC + 4 and mtval to PC.
+* Once any exception has been raised, the exception flag stays set. From
+  then on, interrupts enter the trap handler without saving mcause/mepc/mtval
+  and without using the vector table, just as TrapROM does.
+* Unknown CSRs read as csr_rd_data (zero), and writes to them are ignored.
+  The MTI, MEI and MSI bits of mip are not writable.
+
+Interrupt lines are sampled at the end of each instruction. The ISS also
+counts machine cycles, using the number of machine cycles each instruction
+takes in the microcode.
+"""
+import time
+from typing import Dict, Optional, Tuple
+
+from checkpoint import Checkpoint
+from consts import AluFunc, BranchCond, CSRAddr, Instr, MemAccessWidth, Opcode
+from consts import MInterrupt, MStatus, SystemFunc, TrapCause
+from cpu_state import CPUState, Halt, SimStats, irq_can_wake
+from sim_devices import DeviceBus
+from sim_memory import MainMemory
+from sim_trace import CSR, MEM_READ, MEM_WRITE, RECORD_FIELDS, TraceWriter, rd_info, trap_record
+
+MASK32 = 0xFFFFFFFF
+
+# Decoded instruction kinds.
+K_OP_IMM = 0
+K_OP = 1
+K_LOAD = 2
+K_STORE = 3
+K_BRANCH = 4
+K_JAL = 5
+K_JALR = 6
+K_LUI = 7
+K_AUIPC = 8
+K_CSR = 9
+K_MRET = 10
+K_ECALL = 11
+K_EBREAK = 12
+# An illegal instruction. The func field holds the number of machine cycles
+# before the exception is raised.
+K_ILLEGAL = 13
+
+# (kind, rd, rs1, rs2, imm, func)
+Decoded = Tuple[int, int, int, int, int, int]
+
+_VALID_ALU_FUNCS = frozenset(f.value for f in AluFunc)
+_VALID_BRANCH_CONDS = frozenset(c.value for c in BranchCond)
+_VALID_LOADS = frozenset(w.value for w in MemAccessWidth)
+_VALID_STORES = frozenset((MemAccessWidth.B, MemAccessWidth.H, MemAccessWidth.W))
+_VALID_CSR_FUNCS = frozenset((SystemFunc.CSRRW, SystemFunc.CSRRS, SystemFunc.CSRRC,
+                              SystemFunc.CSRRWI, SystemFunc.CSRRSI, SystemFunc.CSRRCI))
+
+_MIE = 1 << MStatus.MIE
+_MPIE = 1 << MStatus.MPIE
+_MTI = 1 << MInterrupt.MTI
+_MEI = 1 << MInterrupt.MEI
+_MSI = 1 << MInterrupt.MSI
+_MIP_RO = _MTI | _MEI | _MSI
+
+# Plain ints compare faster than IntEnum members in the interpreter loop.
+_ADD, _SUB, _SLL, _SLT = int(AluFunc.ADD), int(AluFunc.SUB), int(AluFunc.SLL), int(AluFunc.SLT)
+_XOR, _SRL, _SRA = int(AluFunc.XOR), int(AluFunc.SRL), int(AluFunc.SRA)
+_OR, _AND = int(AluFunc.OR), int(AluFunc.AND)
+_EQ, _NE, _LT, _GE = int(BranchCond.EQ), int(BranchCond.NE), int(BranchCond.LT), int(BranchCond.GE)
+_LTU = int(BranchCond.LTU)
+_B, _H, _W, _BU = int(MemAccessWidth.B), int(MemAccessWidth.H), int(MemAccessWidth.W), \
+    int(MemAccessWidth.BU)
+_HU = int(MemAccessWidth.HU)
+
+
+def _sext(value: int, bits: int) -> int:
+    """Sign-extends a value to 32 bits, returning it as unsigned."""
+    sign = 1 << (bits - 1)
+    return ((value & (2 * sign - 1)) ^ sign) - sign & MASK32
+
+
+def decode(word: int) -> Decoded:
+    """Decodes an instruction word the way the sequencer does."""
+    opcode = word & 0x7F
+    rd = (word >> 7) & 0x1F
+    funct3 = (word >> 12) & 0x7
+    rs1 = (word >> 15) & 0x1F
+    rs2 = (word >> 20) & 0x1F
+    imm_i = _sext(word >> 20, 12)
+
+    if (word & 0xFFFF) == 0 or word == MASK32:
+        return (K_ILLEGAL, 0, 0, 0, 0, 1)
+
+    if opcode == Opcode.OP_IMM or opcode == Opcode.OP:
+        alu_func = funct3
+        # In OP_IMM, bit 30 is part of the immediate, except for the shifts.
+        if opcode == Opcode.OP or funct3 & 0b11 == 0b01:
+            alu_func |= ((word >> 30) & 1) << 3
+        if alu_func not in _VALID_ALU_FUNCS:
+            return (K_ILLEGAL, 0, 0, 0, 0, 1)
+        if opcode == Opcode.OP:
+            return (K_OP, rd, rs1, rs2, 0, alu_func)
+        return (K_OP_IMM, rd, rs1, 0, imm_i, alu_func)
+
+    if opcode == Opcode.LOAD:
+        if funct3 not in _VALID_LOADS:
+            return (K_ILLEGAL, 0, 0, 0, 0, 2)
+        return (K_LOAD, rd, rs1, 0, imm_i, funct3)
+
+    if opcode == Opcode.STORE:
+        if funct3 not in _VALID_STORES:
+            return (K_ILLEGAL, 0, 0, 0, 0, 2)
+        imm_s = _sext(((word >> 25) << 5) | rd, 12)
+        return (K_STORE, 0, rs1, rs2, imm_s, funct3)
+
+    if opcode == Opcode.BRANCH:
+        if funct3 not in _VALID_BRANCH_CONDS:
+            return (K_ILLEGAL, 0, 0, 0, 0, 2)
+        imm_b = _sext(((word >> 31) << 12) | (((word >> 7) & 1) << 11) |
+                      (((word >> 25) & 0x3F) << 5) | (((word >> 8) & 0xF) << 1), 13)
+        return (K_BRANCH, 0, rs1, rs2, imm_b, funct3)
+
+    if opcode == Opcode.JAL:
+        imm_j = _sext(((word >> 31) << 20) | (((word >> 12) & 0xFF) << 12) |
+                      (((word >> 20) & 1) << 11) | (((word >> 21) & 0x3FF) << 1), 21)
+        return (K_JAL, rd, 0, 0, imm_j, 0)
+
+    if opcode == Opcode.JALR:
+        return (K_JALR, rd, rs1, 0, imm_i, 0)
+
+    if opcode == Opcode.LUI:
+        return (K_LUI, rd, 0, 0, word & 0xFFFFF000, 0)
+
+    if opcode == Opcode.AUIPC:
+        return (K_AUIPC, rd, 0, 0, word & 0xFFFFF000, 0)
+
+    if opcode == Opcode.SYSTEM:
+        if funct3 == SystemFunc.PRIV:
+            if word == Instr.MRET:
+                return (K_MRET, 0, 0, 0, 0, 0)
+            if word == Instr.ECALL:
+                return (K_ECALL, 0, 0, 0, 0, 0)
+            if word == Instr.EBREAK:
+                return (K_EBREAK, 0, 0, 0, 0, 0)
+            return (K_ILLEGAL, 0, 0, 0, 0, 1)
+        if funct3 not in _VALID_CSR_FUNCS:
+            return (K_ILLEGAL, 0, 0, 0, 0, 1)
+        # The CSR number goes in imm, and rs1 doubles as the zimm value.
+        return (K_CSR, rd, rs1, 0, word >> 20, funct3)
+
+    return (K_ILLEGAL, 0, 0, 0, 0, 1)
+
+
+class ISS:
+    """A functional simulator that runs one instruction per step.
+
+    Attributes:
+        memory: The main memory.
+        state: The CPU state. Between instructions, instr_phase is always 0 and
+            memaddr points at the next instruction. The purely internal
+            registers (the stored ALU flags, and tmp and memdata_wr outside
+            of the instructions that use them) are not modeled.
+        stats: Statistics for the runs so far.
+        tohost: If not None, a write to this address halts the simulation.
+        halt_on_self_loop: Halt when an instruction jumps to itself while no
+            interrupt can be taken.
+        time_irq: The level of the timer interrupt line.
+        ext_irq: The level of the external interrupt line.
+        csr_rd_data: The value read from CSRs that the CPU doesn't implement.
+        devices: The DeviceBus driving the interrupt lines, if one is attached.
+            The lines are sampled when an instruction completes.
+        trace: The TraceWriter to add a record to for each retired instruction
+            and trap entry, if any.
+    """
+
+    def __init__(self, memory: MainMemory, tohost: Optional[int] = None,
+                 halt_on_self_loop: bool = True):
+        self.memory = memory
+        self.state = CPUState()
+        self.stats = SimStats()
+        self.tohost = tohost
+        self.halt_on_self_loop = halt_on_self_loop
+        self.time_irq = 0
+        self.ext_irq = 0
+        self.csr_rd_data = 0
+        self.devices: Optional[DeviceBus] = None
+        self.trace: Optional[TraceWriter] = None
+        # Decoded instructions, their words and their rd_info, by PC.
+        self._decoded: Dict[int, Tuple[int, ...]] = {}
+
+    def read_csr(self, num: int) -> int:
+        """Reads a CSR the way the CSR read path in the CPU does."""
+        st = self.state
+        if num == CSRAddr.MSTATUS:
+            return st.mstatus
+        if num == CSRAddr.MIE:
+            return st.mie
+        if num == CSRAddr.MIP:
+            return st.mip
+        if num == CSRAddr.MTVEC:
+            return st.mtvec
+        if num == CSRAddr.MEPC:
+            return st.mepc
+        if num == CSRAddr.MCAUSE:
+            return st.mcause
+        if num == CSRAddr.MTVAL:
+            return st.mtval
+        return self.csr_rd_data
+
+    def write_csr(self, num: int, value: int):
+        """Writes a CSR the way the CPU does."""
+        st = self.state
+        if num == CSRAddr.MSTATUS:
+            st.mstatus = value
+        elif num == CSRAddr.MIE:
+            st.mie = value
+        elif num == CSRAddr.MIP:
+            st.mip = (value & ~_MIP_RO) | (st.mip & _MIP_RO)
+        elif num == CSRAddr.MTVEC:
+            st.mtvec = value
+        elif num == CSRAddr.MEPC:
+            st.mepc = value
+        elif num == CSRAddr.MCAUSE:
+            st.mcause = value
+        elif num == CSRAddr.MTVAL:
+            st.mtval = value
+
+    def update_mip(self, mstatus: int, mie: int):
+        """Does what IrqCard does to mip on a machine cycle outside a trap.
+
+        Args:
+            mstatus: The value of mstatus during the machine cycle.
+            mie: The value of mie during the machine cycle.
+        """
+        st = self.state
+        mip = st.mip
+        if mstatus & _MIE:
+            if mie & _MTI:
+                if self.time_irq:
+                    mip |= _MTI
+            else:
+                mip &= ~_MTI
+            if mie & _MEI:
+                if self.ext_irq:
+                    mip |= _MEI
+            else:
+                mip &= ~_MEI
+        else:
+            mip &= ~(_MTI | _MEI)
+        st.mip = mip
+
+    def _irq_live(self) -> bool:
+        """Returns whether mip can change or an interrupt can be taken."""
+        st = self.state
+        return bool(st.mstatus & _MIE or st.mip & (_MTI | _MEI))
+
+    def _raise(self, cause: int, mtval: int, fatal: bool):
+        """Does what set_exception followed by the trap sequence does.
+
+        The state's pc must be the PC of the instruction raising the exception.
+        """
+        st = self.state
+        st.mcause = cause
+        st.mepc = st.pc if fatal else (st.pc + 4) & MASK32
+        st.mtval = mtval & MASK32
+        st.exception = 1
+        st.fatal = 1 if fatal else 0
+        st.instr_phase = 0
+        if fatal:
+            # IrqCard still sees the machine cycles up to the exception.
+            if self._irq_live():
+                self.update_mip(st.mstatus, st.mie)
+            # The trap sequence hangs in phase 0.
+            st.trap = 1
+        else:
+            self._enter_trap(interrupt=False)
+
+    def _enter_trap(self, interrupt: bool):
+        """Does what the two machine cycles of TrapROM.handle_trap do.
+
+        The state's pc must be the PC of the next instruction.
+        """
+        st = self.state
+        vectored = False
+        if interrupt and not st.exception:
+            if st.mip & _MEI:
+                st.mcause = TrapCause.INT_MACH_EXTERNAL
+                st.mip &= ~_MEI
+            else:
+                st.mcause = TrapCause.INT_MACH_TIMER
+                st.mip &= ~_MTI
+            st.mepc = st.pc
+            st.mtval = 0
+            vectored = (st.mtvec & 3) == 1
+        target = (st.mtvec >> 2) + (st.mcause if vectored else 0)
+        st.pc = st.memaddr = (target << 2) & MASK32
+        mstatus = st.mstatus & ~(_MIE | _MPIE)
+        if st.mstatus & _MIE:
+            mstatus |= _MPIE
+        st.mstatus = mstatus
+        st.trap = 0
+        self.stats.traps += 1
+
+    def _csr(self, func: int, num: int, rd: int, rs1: int, src: int) -> int:
+        """Does what the CSR instructions do to the CSRs, and returns the value for rd."""
+        op = func & 0b11
+        if op == SystemFunc.CSRRW:
+            old = self.read_csr(num) if rd != 0 else 0
+            self.write_csr(num, src)
+        else:
+            old = self.read_csr(num)
+            if rs1 != 0:
+                self.write_csr(num, old | src if op == SystemFunc.CSRRS else old & ~src)
+        self.state.tmp = old
+        return old
+
+    def flush_decode_cache(self):
+        """Forgets all decoded instructions.
+
+        Stores done by the ISS keep the cache coherent by themselves. Call this
+        after changing memory from outside the ISS.
+        """
+        self._decoded.clear()
+
+    def checkpoint(self) -> Checkpoint:
+        """Returns a checkpoint of the machine. The memory is shared, not copied."""
+        ckpt = Checkpoint.take(self, self.state.copy())
+        ckpt.instr_pc = self.state.pc
+        return ckpt
+
+    def restore(self, ckpt: Checkpoint):
+        """Carries on from a checkpoint, sharing its memory.
+
+        The ISS runs whole instructions, so the checkpoint must have been taken
+        between instructions.
+        """
+        if ckpt.state.instr_phase != 0 or ckpt.state.trap:
+            raise ValueError("The ISS can only restore checkpoints taken between instructions")
+        self.state = ckpt.state.copy()
+        ckpt.restore_run(self)
+        self.flush_decode_cache()
+
+    def run(self, max_instrs: Optional[int] = None,
+            max_cycles: Optional[int] = None) -> SimStats:
+        """Runs until the program halts or a limit is reached.
+
+        Args:
+            max_instrs: Stop after this many instructions have been retired in total.
+            max_cycles: Stop after this many machine cycles have been run in total.
+        """
+        stats = self.stats
+        if stats.halt == Halt.FATAL:
+            return stats
+
+        st = self.state
+        regs = st.regs
+        base = st.reg_page * 32
+        decoded = self._decoded
+        read_word = self.memory.read_word
+        write_word = self.memory.write_word
+        devices = self.devices
+        trace = self.trace
+        records = trace.records if trace is not None else None
+        record = records.extend if records is not None else None
+        tohost = self.tohost & ~3 if self.tohost is not None else -1
+        self_loop = self.halt_on_self_loop
+        instr_limit = max_instrs if max_instrs is not None else 1 << 62
+        cycle_limit = max_cycles if max_cycles is not None else 1 << 62
+
+        # The hot state lives in locals, and is written back on the way out
+        # and around the slow paths.
+        pc = st.pc
+        memaddr = st.memaddr
+        instrs = stats.instrs
+        cycles = stats.cycles
+        irq_live = self._irq_live()
+        halt = Halt.NONE
+        word = st.instr
+        # The memory or CSR access of the instruction, for the trace.
+        t_flags = t_addr = t_data = 0
+        # A full block of trace records stops the loop like the instruction limit does.
+        stop_instrs = instr_limit
+        if trace is not None:
+            stop_instrs = min(instr_limit, instrs + trace.block_records - len(records) // len(RECORD_FIELDS))
+
+        start = time.perf_counter()
+        while True:
+            if instrs >= stop_instrs:
+                if instrs >= instr_limit:
+                    halt = Halt.MAX_INSTRS
+                    break
+                trace.flush()
+                records = trace.records
+                record = records.extend
+                stop_instrs = min(instr_limit, instrs + trace.block_records)
+            if cycles >= cycle_limit:
+                halt = Halt.MAX_CYCLES
+                break
+            if devices is not None and cycles >= devices.next_event:
+                stats.cycles = cycles
+                devices.update(cycles)
+            memaddr = 0
+
+            d = decoded.get(pc)
+            if d is None:
+                if pc & 3:
+                    cycles += 1
+                    st.pc = pc
+                    self._raise(TrapCause.EXC_INSTR_ADDR_MISALIGN, pc, fatal=True)
+                    halt = Halt.FATAL
+                    break
+                word = read_word(pc)
+                d = decoded[pc] = decode(word) + (word, rd_info(word))
+            kind, rd, rs1, rs2, imm, func, word, t_rd = d
+            rd += base
+            next_pc = pc + 4
+
+            if kind <= K_OP:
+                a = regs[base + rs1]
+                b = imm if kind == K_OP_IMM else regs[base + rs2]
+                if func == _ADD:
+                    v = a + b
+                elif func == _SUB:
+                    v = a - b
+                elif func == _AND:
+                    v = a & b
+                elif func == _OR:
+                    v = a | b
+                elif func == _XOR:
+                    v = a ^ b
+                elif func == _SLL:
+                    v = a << (b & 31)
+                elif func == _SRL:
+                    v = a >> (b & 31)
+                elif func == _SRA:
+                    v = (a - ((a & 0x80000000) << 1)) >> (b & 31)
+                elif func == _SLT:
+                    v = 1 if (a ^ 0x80000000) < (b ^ 0x80000000) else 0
+                else:
+                    v = 1 if a < b else 0
+                if rd != base:
+                    regs[rd] = v & MASK32
+                cycles += 1
+
+            elif kind == K_LOAD:
+                addr = (regs[base + rs1] + imm) & MASK32
+                cycles += 2
+                if ((func == _H or func == _HU) and addr & 1) or (func == _W and addr & 3):
+                    st.pc = pc
+                    st.memaddr = addr
+                    self._raise(TrapCause.EXC_LOAD_ADDR_MISALIGN, addr, fatal=True)
+                    halt = Halt.FATAL
+                    break
+                # Devices take the time of the access from stats.cycles.
+                stats.cycles = cycles
+                t_data = read_word(addr)
+                t_flags = MEM_READ
+                t_addr = addr
+                v = t_data >> (8 * (addr & 3))
+                if func == _W:
+                    pass
+                elif func == _B:
+                    v = ((v & 0xFF) ^ 0x80) - 0x80
+                elif func == _BU:
+                    v &= 0xFF
+                elif func == _H:
+                    v = ((v & 0xFFFF) ^ 0x8000) - 0x8000
+                else:
+                    v &= 0xFFFF
+                if rd != base:
+                    regs[rd] = v & MASK32
+                cycles += 1
+
+            elif kind == K_STORE:
+                addr = (regs[base + rs1] + imm) & MASK32
+                cycles += 2
+                offset = addr & 3
+                if func == _B:
+                    mask = 1 << offset
+                elif offset & (1 if func == _H else 3):
+                    st.pc = pc
+                    st.memaddr = addr
+                    self._raise(TrapCause.EXC_STORE_AMO_ADDR_MISALIGN, addr, fatal=True)
+                    halt = Halt.FATAL
+                    break
+                else:
+                    mask = 0b0011 << offset if func == _H else 0b1111
+                data = (regs[base + rs2] << (8 * offset)) & MASK32
+                st.memdata_wr = data
+                stats.cycles = cycles
+                write_word(addr, data, mask)
+                t_flags = MEM_WRITE | mask << 8
+                t_addr = addr
+                t_data = data
+                cycles += 1
+                addr &= ~3
+                if addr in decoded:
+                    del decoded[addr]
+                if addr == tohost:
+                    stats.exit_code = data >> 1
+                    halt = Halt.TOHOST
+
+            elif kind == K_BRANCH:
+                a = regs[base + rs1]
+                b = regs[base + rs2]
+                if func == _EQ:
+                    taken = a == b
+                elif func == _NE:
+                    taken = a != b
+                elif func == _LT:
+                    taken = (a ^ 0x80000000) < (b ^ 0x80000000)
+                elif func == _GE:
+                    taken = (a ^ 0x80000000) >= (b ^ 0x80000000)
+                elif func == _LTU:
+                    taken = a < b
+                else:
+                    taken = a >= b
+                cycles += 2
+                if taken:
+                    next_pc = (pc + imm) & MASK32
+                    if next_pc & 3:
+                        cycles += 1
+                        st.pc = pc
+                        st.tmp = next_pc
+                        self._raise(TrapCause.EXC_INSTR_ADDR_MISALIGN, next_pc, fatal=True)
+                        halt = Halt.FATAL
+                        break
+
+            elif kind == K_JAL or kind == K_JALR:
+                target = pc if kind == K_JAL else regs[base + rs1]
+                target = (target + imm) & MASK32
+                cycles += 2
+                if target & 2:
+                    st.pc = pc
+                    st.memaddr = target
+                    self._raise(TrapCause.EXC_INSTR_ADDR_MISALIGN,
+                                target if kind == K_JAL else target & ~1, fatal=True)
+                    halt = Halt.FATAL
+                    break
+                if rd != base:
+                    regs[rd] = next_pc & MASK32
+                next_pc = target & ~1
+                # memaddr keeps bit 0, since memory ignores the two low bits.
+                memaddr = target - next_pc
+
+            elif kind == K_LUI:
+                if rd != base:
+                    regs[rd] = imm
+                cycles += 1
+
+            elif kind == K_AUIPC:
+                if rd != base:
+                    regs[rd] = (pc + imm) & MASK32
+                cycles += 1
+
+            elif kind == K_CSR:
+                # The CSR is read and written in the first machine cycle, so
+                # it reads mip from before IrqCard updates it, and IrqCard
+                # sees the old CSRs in that cycle, and the new ones in the second.
+                mstatus, mie = st.mstatus, st.mie
+                src = rs1 if func >= SystemFunc.CSRRWI else regs[base + rs1]
+                v = self._csr(func, imm, rd - base, rs1, src)
+                self.update_mip(mstatus, mie)
+                if rd != base:
+                    regs[rd] = v
+                t_flags = CSR
+                t_addr = imm
+                cycles += 2
+                irq_live = True
+
+            elif kind == K_MRET:
+                # IrqCard sees the old mstatus in MRET's only machine cycle.
+                mstatus = st.mstatus
+                if irq_live:
+                    self.update_mip(mstatus, st.mie)
+                exit_mstatus = mstatus & ~_MIE | _MPIE
+                if mstatus & _MPIE:
+                    exit_mstatus |= _MIE
+                st.mstatus = exit_mstatus
+                next_pc = st.mepc
+                cycles += 1
+                instrs += 1
+                if records is not None:
+                    record((cycles, pc, word, 0, 0, 0, 0))
+                mret_pc, pc = pc, next_pc
+                memaddr = 0
+                if st.mip & (_MTI | _MEI):
+                    st.pc = pc
+                    self._enter_trap(interrupt=True)
+                    cycles += 2
+                    if records is not None:
+                        record(trap_record(cycles, st.mepc, st.mcause, st.mtval))
+                    pc = st.pc
+                elif pc == mret_pc and self_loop and not irq_can_wake(st.mstatus, st.mie):
+                    halt = Halt.SELF_LOOP
+                    break
+                irq_live = self._irq_live()
+                continue
+
+            elif kind == K_ECALL or kind == K_EBREAK:
+                cycles += 1
+                if irq_live:
+                    self.update_mip(st.mstatus, st.mie)
+                st.pc = pc
+                self._raise(TrapCause.EXC_ECALL_FROM_MACH_MODE if kind == K_ECALL
+                            else TrapCause.EXC_BREAKPOINT, pc, fatal=False)
+                cycles += 2
+                if records is not None:
+                    record(trap_record(cycles, st.mepc, st.mcause, st.mtval))
+                pc = st.pc
+                memaddr = 0
+                irq_live = self._irq_live()
+                continue
+
+            else:
+                cycles += func
+                st.pc = pc
+                self._raise(TrapCause.EXC_ILLEGAL_INSTR, word, fatal=True)
+                halt = Halt.FATAL
+                break
+
+            # The instruction completed.
+            instrs += 1
+            if irq_live:
+                self.update_mip(st.mstatus, st.mie)
+            if records is not None:
+                if t_flags:
+                    if t_flags == CSR:
+                        t_data = self.read_csr(t_addr)
+                    elif t_flags == MEM_READ:
+                        # The byte lanes of the load.
+                        t_flags |= ((1 << (1 << (func & 3))) - 1) << (t_addr & 3) << 8
+                    record((cycles, pc, word, t_rd | t_flags << 8, regs[rd], t_addr, t_data))
+                    t_flags = 0
+                else:
+                    record((cycles, pc, word, t_rd, regs[rd], t_addr, t_data))
+            if irq_live:
+                if st.mip & (_MTI | _MEI):
+                    st.pc = next_pc & MASK32
+                    self._enter_trap(interrupt=True)
+                    cycles += 2
+                    if records is not None:
+                        record(trap_record(cycles, st.mepc, st.mcause, st.mtval))
+                    pc = st.pc
+                    memaddr = 0
+                    irq_live = self._irq_live()
+                    if halt != Halt.NONE:
+                        break
+                    continue
+                irq_live = self._irq_live()
+            if next_pc == pc and self_loop and not irq_can_wake(st.mstatus, st.mie):
+                halt = Halt.SELF_LOOP
+            pc = next_pc & MASK32
+            if halt != Halt.NONE:
+                break
+
+        stats.seconds += time.perf_counter() - start
+        st.pc = pc
+        st.memaddr = pc + memaddr if halt != Halt.FATAL else st.memaddr
+        st.instr = word
+        stats.instrs = instrs
+        stats.cycles = cycles
+        stats.halt = halt
+        return stats
@@ -0,0 +1,549 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+# Disable "too many branches/statements/locals": the machine cycle is
+# deliberately one flat function for speed.
+# pylint: disable=R0912,R0914,R0915
+"""
+This module provides a microcode-level simulator for the CPU.
+
+Instead of simulating the gateware, MicrocodeSim looks up the control
+signals for each machine cycle in the precomputed SequencerROM, TrapROM and
+IrqLoadInstrROM tables (see rom_table.py), and drives a Python model of the
+rest of the sequencer card and of the X/Y/Z bus datapath: the register card,
+ALU, shifter, exception card and interrupt card. Since the ROMs are the real
+ones, cycle counts are exact to the microcode.
+
+A machine cycle is modeled in the order the clocks fire:
+
+* The memory read is served from memaddr, and on instruction phase 0 the
+  instruction latch opens (ph2r).
+* The ROM outputs and the buses settle. data_z_in_2_lsb0 is registered on
+  ph2 from this cycle's Z bus, so the ROMs are looked up again if it changed.
+* The register file, tmp, mtvec and the CSRs are written (ph2w), along with
+  the exception and fatal flags (ph2) and any memory write.
+* The ph1 registers (PC, memaddr, memdata_wr, instruction phase, trap, stored
+  ALU flags) are loaded, with is_interrupted looking at the updated mip.
+"""
+import functools
+import time
+from typing import Dict, Optional, Tuple
+
+from checkpoint import Checkpoint
+from consts import AluOp, BranchCond, CSRAddr, ConstSelect, Instr
+from consts import MInterrupt, MStatus, Opcode, OpcodeSelect, SeqMuxSelect
+from consts import SystemFunc, TrapCause
+from cpu_state import CPUState, Halt, SimStats, irq_can_wake
+from rom_coverage import RomCoverage
+from rom_table import RomTable, load_rom_table
+from sim_devices import DeviceBus
+from sim_memory import MainMemory
+from sim_trace import CSR_FIELDS, TraceWriter, instr_record, trap_record
+
+MASK32 = 0xFFFFFFFF
+
+_MIE = 1 << MStatus.MIE
+_MPIE = 1 << MStatus.MPIE
+_MTI = 1 << MInterrupt.MTI
+_MEI = 1 << MInterrupt.MEI
+_MSI = 1 << MInterrupt.MSI
+
+# The values behind ConstSelect, as SequencerCard.decode_const produces them.
+_CONSTS = [0] * 16
+for _sel, _value in [(ConstSelect.EXC_INSTR_ADDR_MISALIGN, TrapCause.EXC_INSTR_ADDR_MISALIGN),
+                     (ConstSelect.EXC_ILLEGAL_INSTR, TrapCause.EXC_ILLEGAL_INSTR),
+                     (ConstSelect.EXC_BREAKPOINT, TrapCause.EXC_BREAKPOINT),
+                     (ConstSelect.EXC_LOAD_ADDR_MISALIGN, TrapCause.EXC_LOAD_ADDR_MISALIGN),
+                     (ConstSelect.EXC_STORE_AMO_ADDR_MISALIGN,
+                      TrapCause.EXC_STORE_AMO_ADDR_MISALIGN),
+                     (ConstSelect.EXC_ECALL_FROM_MACH_MODE, TrapCause.EXC_ECALL_FROM_MACH_MODE),
+                     (ConstSelect.INT_MACH_EXTERNAL, TrapCause.INT_MACH_EXTERNAL),
+                     (ConstSelect.INT_MACH_TIMER, TrapCause.INT_MACH_TIMER),
+                     (ConstSelect.SHAMT_0, 0),
+                     (ConstSelect.SHAMT_4, 4),
+                     (ConstSelect.SHAMT_8, 8),
+                     (ConstSelect.SHAMT_16, 16),
+                     (ConstSelect.SHAMT_24, 24)]:
+    _CONSTS[_sel] = int(_value)
+
+# Plain ints compare faster than IntEnum members in the machine cycle.
+_SEL_X, _SEL_Y, _SEL_Z = int(SeqMuxSelect.X), int(SeqMuxSelect.Y), int(SeqMuxSelect.Z)
+_SEL_MTVEC = int(SeqMuxSelect.MTVEC)
+_MSTATUS, _MIE_CSR, _MIP = int(CSRAddr.MSTATUS), int(CSRAddr.MIE), int(CSRAddr.MIP)
+_MTVEC, _MEPC, _MCAUSE, _MTVAL = (int(CSRAddr.MTVEC), int(CSRAddr.MEPC),
+                                  int(CSRAddr.MCAUSE), int(CSRAddr.MTVAL))
+_KNOWN_CSRS = frozenset((_MSTATUS, _MIE_CSR, _MIP, _MTVEC, _MEPC, _MCAUSE, _MTVAL))
+_ALU_OPS = frozenset(int(op) for op in (AluOp.ADD, AluOp.SUB, AluOp.SLT, AluOp.SLTU, AluOp.AND,
+                                        AluOp.AND_NOT, AluOp.OR, AluOp.XOR, AluOp.X, AluOp.Y))
+
+# (opcode_select, imm format) by opcode. Formats: 0 SYS, 1 I, 2 U, 3 S, 4 B, 5 J. The formats
+# are the ones SequencerCard.decode_imm_chips picks, since FormalCPU has the chips: every
+# opcode not listed, including OP, gets the SYS format, so imm0 comes from the rs1 field.
+_OPCODES = {
+    Opcode.LUI: (OpcodeSelect.LUI, 2),
+    Opcode.AUIPC: (OpcodeSelect.AUIPC, 2),
+    Opcode.OP_IMM: (OpcodeSelect.OP_IMM, 1),
+    Opcode.OP: (OpcodeSelect.OP, 0),
+    Opcode.MISC_MEM: (OpcodeSelect.NONE, 1),
+    Opcode.JAL: (OpcodeSelect.JAL, 5),
+    Opcode.JALR: (OpcodeSelect.JALR, 1),
+    Opcode.BRANCH: (OpcodeSelect.BRANCH, 4),
+    Opcode.LOAD: (OpcodeSelect.LOAD, 1),
+    Opcode.STORE: (OpcodeSelect.STORE, 3),
+    Opcode.SYSTEM: (OpcodeSelect.NONE, 0),
+}
+
+# (instr, rs1, rs2, rd, funct12, imm, bad_instr, the SequencerROM address bits
+# that only depend on the instruction)
+DecodedInstr = Tuple[int, int, int, int, int, int, int, int]
+
+
+def _sext(value: int, bits: int) -> int:
+    """Sign-extends a value to 32 bits, returning it as unsigned."""
+    sign = 1 << (bits - 1)
+    return ((value & (2 * sign - 1)) ^ sign) - sign & MASK32
+
+
+def decode_instr(instr: int) -> DecodedInstr:
+    """Decodes an instruction the way SequencerCard.process does with the chips."""
+    opcode = instr & 0x7F
+    rd = (instr >> 7) & 0x1F
+    funct3 = (instr >> 12) & 0x7
+    rs1 = (instr >> 15) & 0x1F
+    rs2 = (instr >> 20) & 0x1F
+    funct12 = instr >> 20
+    alu_func = funct3
+    if (instr >> 30) & 1 and (opcode == Opcode.OP or funct3 & 0b11 == 0b01):
+        alu_func |= 0b1000
+
+    opcode_select, fmt = _OPCODES.get(opcode, (OpcodeSelect.NONE, 0))
+    if opcode == Opcode.SYSTEM:
+        if funct3 != SystemFunc.PRIV:
+            opcode_select = OpcodeSelect.CSRS
+        elif instr == Instr.MRET:
+            opcode_select = OpcodeSelect.MRET
+        elif instr == Instr.ECALL:
+            opcode_select = OpcodeSelect.ECALL
+        elif instr == Instr.EBREAK:
+            opcode_select = OpcodeSelect.EBREAK
+
+    if fmt == 1:
+        imm = _sext(instr >> 20, 12)
+    elif fmt == 2:
+        imm = instr & 0xFFFFF000
+    elif fmt == 3:
+        imm = _sext(((instr >> 25) << 5) | rd, 12)
+    elif fmt == 4:
+        imm = _sext(((instr >> 31) << 12) | (((instr >> 7) & 1) << 11) |
+                    (((instr >> 25) & 0x3F) << 5) | (((instr >> 8) & 0xF) << 1), 13)
+    elif fmt == 5:
+        imm = _sext(((instr >> 31) << 20) | (((instr >> 12) & 0xFF) << 12) |
+                    (((instr >> 20) & 1) << 11) | (((instr >> 21) & 0x3FF) << 1), 21)
+    else:
+        imm = rs1
+
+    bad_instr = 1 if (instr & 0xFFFF) == 0 or instr == MASK32 else 0
+    # SEQUENCER_ROM_INPUTS: opcode_select, _funct3, _alu_func, _instr_phase (2),
+    # branch_cond, memaddr_2_lsb (14), imm0 (16), rd0 (17), rs1_0 (18),
+    # data_z_in_2_lsb0 (19), enable_sequencer_rom (20).
+    addr = (int(opcode_select) | funct3 << 4 | alu_func << 7 |
+            (imm == 0) << 16 | (rd == 0) << 17 | (rs1 == 0) << 18 | 1 << 20)
+    return (instr, rs1, rs2, rd, funct12, imm, bad_instr, addr)
+
+
+@functools.lru_cache(maxsize=None)
+def rom_tables() -> Tuple[RomTable, RomTable, RomTable]:
+    """Returns the tables for SequencerROM, TrapROM and IrqLoadInstrROM.
+
+    The tables are loaded once per process, from the ROM table cache.
+    """
+    return (load_rom_table("sequencer_rom"), load_rom_table("trap_rom"),
+            load_rom_table("irq_load_rom"))
+
+
+class MicrocodeSim:
+    """Runs programs by stepping the sequencer ROMs one machine cycle at a time.
+
+    Attributes:
+        memory: The main memory.
+        state: The CPU state, updated every machine cycle.
+        stats: Statistics for the runs so far.
+        tohost: If not None, a write to this address halts the simulation.
+        halt_on_self_loop: Halt when an instruction jumps to itself while no
+            interrupt can be taken.
+        time_irq: The level of the timer interrupt line.
+        ext_irq: The level of the external interrupt line.
+        csr_rd_data: The value read from CSRs that the CPU doesn't implement.
+        devices: The DeviceBus driving the interrupt lines, if one is attached.
+        trace: The TraceWriter to add a record to for each retired instruction
+            and trap entry, if any.
+        coverage: The RomCoverage to count the ROM addresses of each machine
+            cycle in, if any.
+    """
+
+    def __init__(self, memory: MainMemory, tohost: Optional[int] = None,
+                 halt_on_self_loop: bool = True):
+        self.memory = memory
+        self.state = CPUState()
+        self.stats = SimStats()
+        self.tohost = tohost
+        self.halt_on_self_loop = halt_on_self_loop
+        self.time_irq = 0
+        self.ext_irq = 0
+        self.csr_rd_data = 0
+        self.devices: Optional[DeviceBus] = None
+        self.trace: Optional[TraceWriter] = None
+        self.coverage: Optional[RomCoverage] = None
+
+        self._seq_rom, self._trap_rom, self._irq_load_rom = rom_tables()
+        # The data_z_in_2_lsb0 register.
+        self._z_2_lsb0 = 0
+        self._decoded: Dict[int, DecodedInstr] = {}
+        self._instr_pc: Optional[int] = None
+        # The values of rs1 and rs2 when the instruction started, for the trace.
+        self._trace_srcs = (0, 0)
+
+    def run(self, max_instrs: Optional[int] = None,
+            max_cycles: Optional[int] = None) -> SimStats:
+        """Runs until the program halts or a limit is reached.
+
+        Args:
+            max_instrs: Stop after this many instructions have been retired in total.
+            max_cycles: Stop after this many machine cycles have been run in total.
+        """
+        stats = self.stats
+        if stats.halt == Halt.FATAL:
+            return stats
+        stats.halt = Halt.NONE
+        if self._instr_pc is None:
+            self._instr_pc = self.state.pc
+
+        start = time.perf_counter()
+        while True:
+            if max_instrs is not None and stats.instrs >= max_instrs:
+                stats.halt = Halt.MAX_INSTRS
+                break
+            if max_cycles is not None and stats.cycles >= max_cycles:
+                stats.halt = Halt.MAX_CYCLES
+                break
+            devices = self.devices
+            if devices is not None and stats.cycles >= devices.next_event:
+                devices.update(stats.cycles)
+            self.step()
+            if stats.halt != Halt.NONE:
+                break
+        stats.seconds += time.perf_counter() - start
+        return stats
+
+    def checkpoint(self) -> Checkpoint:
+        """Returns a checkpoint of the machine. The memory is shared, not copied."""
+        ckpt = Checkpoint.take(self, self.state.copy())
+        ckpt.z_2_lsb0 = self._z_2_lsb0
+        ckpt.instr_pc = self._instr_pc
+        return ckpt
+
+    def restore(self, ckpt: Checkpoint):
+        """Carries on from a checkpoint, sharing its memory."""
+        self.state = ckpt.state.copy()
+        ckpt.restore_run(self)
+        self._z_2_lsb0 = ckpt.z_2_lsb0
+        self._instr_pc = ckpt.instr_pc
+
+    def _read_csr(self, num: int) -> int:
+        """Returns the value of a CSR."""
+        field = CSR_FIELDS.get(num)
+        return getattr(self.state, field) if field is not None else self.csr_rd_data
+
+    def _trace_instr(self, trap: int):
+        """Adds the trace record of the instruction or trap entry that just completed."""
+        st = self.state
+        if trap:
+            record = trap_record(self.stats.cycles, st.mepc, st.mcause, st.mtval)
+        else:
+            rs1_data, rs2_data = self._trace_srcs
+            rd_data = st.regs[st.reg_page * 32 + ((st.instr >> 7) & 0x1F)]
+            record = instr_record(self.stats.cycles, self._instr_pc, st.instr, rs1_data, rs2_data,
+                                  rd_data, self._read_csr, self.memory.read_word)
+        self.trace.add(record)
+
+    def step(self):
+        """Runs one machine cycle."""
+        st = self.state
+        stats = self.stats
+        regs = st.regs
+        base = st.reg_page * 32
+        pc = st.pc
+        memaddr = st.memaddr
+        trap = st.trap
+        instr_phase = st.instr_phase
+
+        memdata_rd = self.memory.read_word(memaddr)
+        instr_misalign = 1 if pc & 3 and not trap else 0
+        if instr_phase == 0 and not trap and not instr_misalign:
+            st.instr = memdata_rd
+
+        d = self._decoded.get(st.instr)
+        if d is None:
+            d = self._decoded[st.instr] = decode_instr(st.instr)
+        instr, rs1, rs2, rd, funct12, imm, bad_instr, seq_addr = d
+        if self.trace is not None and instr_phase == 0 and not trap:
+            self._trace_srcs = (regs[base + rs1], regs[base + rs2])
+
+        mip = st.mip
+        mei_pend = 1 if mip & _MEI else 0
+        mti_pend = 1 if mip & _MTI else 0
+        enable = not (trap or instr_misalign or bad_instr)
+        if enable:
+            funct3 = (instr >> 12) & 0x7
+            if funct3 == BranchCond.EQ:
+                branch_cond = st.stored_alu_eq
+            elif funct3 == BranchCond.NE:
+                branch_cond = 1 - st.stored_alu_eq
+            elif funct3 == BranchCond.LT:
+                branch_cond = st.stored_alu_lt
+            elif funct3 == BranchCond.GE:
+                branch_cond = 1 - st.stored_alu_lt
+            elif funct3 == BranchCond.LTU:
+                branch_cond = st.stored_alu_ltu
+            elif funct3 == BranchCond.GEU:
+                branch_cond = 1 - st.stored_alu_ltu
+            else:
+                branch_cond = 0
+            seq_addr |= instr_phase << 11 | branch_cond << 13 | (memaddr & 3) << 14
+            c = self._seq_rom.row(seq_addr | self._z_2_lsb0 << 19)
+            t = None
+        else:
+            c = self._seq_rom.row(0)
+            trap_addr = (st.exception << 1 | st.fatal << 2 | instr_misalign << 3 |
+                         bad_instr << 4 | trap << 5 | mei_pend << 6 | mti_pend << 7 |
+                         (st.mtvec & 3) << 8 | instr_phase << 10)
+            t = self._trap_rom.row(trap_addr)
+
+        pc_plus_4 = (pc + 4) & MASK32
+        mtvec = st.mtvec
+
+        # The buses settle. The loop runs a second time only if this cycle's Z
+        # changes the data_z_in_2_lsb0 register, and so the ROM address.
+        while True:
+            if t is None:
+                csr_to_x = c.csr_to_x
+                save_trap_csrs = c.save_trap_csrs
+                const = _CONSTS[c.const]
+                x_mux_select = c.x_mux_select
+                y_mux_select = c.y_mux_select
+                z_mux_select = c.z_mux_select
+                alu_op = c.alu_op_to_z
+                mcause_to_csr_num = c.mcause_to_csr_num
+            else:
+                csr_to_x = t.csr_to_x
+                save_trap_csrs = t.save_trap_csrs
+                const = _CONSTS[t.const]
+                x_mux_select = t.x_mux_select
+                y_mux_select = t.y_mux_select
+                z_mux_select = t.z_mux_select
+                alu_op = t.alu_op_to_z
+                mcause_to_csr_num = t.mcause_to_csr_num
+
+            if c.funct12_to_csr_num:
+                csr_num = funct12
+            elif c.mepc_num_to_csr_num:
+                csr_num = _MEPC
+            elif mcause_to_csr_num:
+                csr_num = _MCAUSE
+            else:
+                csr_num = 0
+            if csr_to_x and csr_num == _MTVEC:
+                x_mux_select = _SEL_MTVEC
+
+            # The sequencer card's multiplexer inputs, by SeqMuxSelect. The buses
+            # are filled in as they settle.
+            src = [st.memdata_wr, memdata_rd, memaddr, memaddr & 0xFFFFFFFE, pc, pc_plus_4,
+                   mtvec, mtvec >> 2, st.tmp, imm, instr, 0, 0, 0, 0, const]
+
+            x = src[x_mux_select] if x_mux_select != _SEL_X else 0
+            if c.reg_to_x:
+                x |= regs[base + (0, rs1, rs2, rd)[c.x_reg_select]]
+            if csr_to_x:
+                if csr_num == _MCAUSE and not save_trap_csrs:
+                    x |= st.mcause
+                elif csr_num == _MEPC and not save_trap_csrs:
+                    x |= st.mepc
+                elif csr_num == _MTVAL and not save_trap_csrs:
+                    x |= st.mtval
+                elif csr_num == _MSTATUS:
+                    x |= st.mstatus
+                elif csr_num == _MIE_CSR:
+                    x |= st.mie
+                elif csr_num == _MIP:
+                    x |= mip
+                elif csr_num not in _KNOWN_CSRS:
+                    x |= self.csr_rd_data
+            src[_SEL_X] = x
+
+            y = src[y_mux_select] if y_mux_select != _SEL_Y else 0
+            if c.reg_to_y:
+                y |= regs[base + (0, rs1, rs2, rd)[c.y_reg_select]]
+            src[_SEL_Y] = y
+
+            alu_lt = 1 if (x ^ 0x80000000) < (y ^ 0x80000000) else 0
+            alu_ltu = 1 if x < y else 0
+            z = 0
+            if alu_op in _ALU_OPS:
+                if alu_op == AluOp.ADD:
+                    z = (x + y) & MASK32
+                elif alu_op == AluOp.SUB:
+                    z = (x - y) & MASK32
+                elif alu_op == AluOp.SLT:
+                    z = alu_lt
+                elif alu_op == AluOp.SLTU:
+                    z = alu_ltu
+                elif alu_op == AluOp.AND:
+                    z = x & y
+                elif alu_op == AluOp.AND_NOT:
+                    z = x & ~y & MASK32
+                elif alu_op == AluOp.OR:
+                    z = x | y
+                elif alu_op == AluOp.XOR:
+                    z = x ^ y
+                elif alu_op == AluOp.X:
+                    z = x
+                else:
+                    z = y
+            # The ALU's result is zero when it isn't driving Z.
+            alu_eq = 1 if z == 0 else 0
+            if alu_op == AluOp.SLL:
+                z = (x << (y & 31)) & MASK32
+            elif alu_op == AluOp.SRL:
+                z = x >> (y & 31)
+            elif alu_op == AluOp.SRA:
+                z = ((x ^ 0x80000000) - 0x80000000 >> (y & 31)) & MASK32
+            if z_mux_select != _SEL_Z:
+                z |= src[z_mux_select]
+            src[_SEL_Z] = z
+            src[SeqMuxSelect.Z_LSL2] = (z << 2) & MASK32
+
+            z_2_lsb0 = 0 if z & 3 else 1
+            if z_2_lsb0 == self._z_2_lsb0:
+                break
+            self._z_2_lsb0 = z_2_lsb0
+            if t is not None:
+                break
+            c = self._seq_rom.row(seq_addr | z_2_lsb0 << 19)
+
+        # ph2w: the register file, tmp, mtvec and the CSRs.
+        if c.z_reg_select:
+            rd_num = (0, rs1, rs2, rd)[c.z_reg_select]
+            if rd_num:
+                regs[base + rd_num] = z
+        tmp_mux_select = c.tmp_mux_select
+        if tmp_mux_select != SeqMuxSelect.TMP:
+            st.tmp = src[tmp_mux_select]
+
+        z_to_csr = c.z_to_csr
+        if t is None:
+            enter_trap = c.enter_trap
+            exit_trap = c.exit_trap
+            clear_pend_mti = clear_pend_mei = 0
+        else:
+            enter_trap = t.enter_trap
+            exit_trap = t.exit_trap
+            clear_pend_mti = t.clear_pend_mti
+            clear_pend_mei = t.clear_pend_mei
+        mstatus = st.mstatus
+        mie = st.mie
+        if z_to_csr and csr_num == _MTVEC:
+            st.mtvec = z
+        if z_to_csr and csr_num == _MCAUSE:
+            st.mcause = z
+        elif save_trap_csrs:
+            st.mcause = x
+        if z_to_csr and csr_num == _MEPC:
+            st.mepc = z
+        elif save_trap_csrs:
+            st.mepc = y
+        if (z_to_csr and csr_num == _MTVAL) or save_trap_csrs:
+            st.mtval = z
+        if z_to_csr and csr_num == _MSTATUS:
+            st.mstatus = z
+        elif enter_trap:
+            st.mstatus = (mstatus & ~(_MIE | _MPIE)) | (_MPIE if mstatus & _MIE else 0)
+        elif exit_trap:
+            st.mstatus = (mstatus & ~_MIE) | _MPIE | (_MIE if mstatus & _MPIE else 0)
+        if z_to_csr and csr_num == _MIE_CSR:
+            st.mie = z
+
+        # IrqCard's pending logic, with the CSRs from before the write.
+        pend_mti = pend_mei = 0
+        if not trap:
+            if mstatus & _MIE:
+                if mie & _MTI:
+                    pend_mti = self.time_irq and not mti_pend
+                else:
+                    clear_pend_mti = 1
+                if mie & _MEI:
+                    pend_mei = self.ext_irq and not mei_pend
+                else:
+                    clear_pend_mei = 1
+            else:
+                clear_pend_mti = clear_pend_mei = 1
+        mtip = 1 if pend_mti else 0 if clear_pend_mti else mti_pend
+        meip = 1 if pend_mei else 0 if clear_pend_mei else mei_pend
+        if z_to_csr and csr_num == _MIP:
+            mip = (z & ~(_MTI | _MEI | _MSI)) | (mip & _MSI)
+        else:
+            mip &= ~(_MTI | _MEI)
+        st.mip = mip | (_MTI if mtip else 0) | (_MEI if meip else 0)
+
+        # ph2: the exception flags. The ROM outputs for these only come from
+        # the ROM in control.
+        r = c if t is None else t
+        if r.load_exception:
+            st.exception = r.next_exception
+            st.fatal = r.next_fatal
+
+        # End of the machine cycle.
+        stats.cycles += 1
+        if c.mem_wr:
+            self.memory.write_word(memaddr, st.memdata_wr, c.mem_wr_mask)
+            if self.tohost is not None and (memaddr & ~3) == (self.tohost & ~3):
+                stats.exit_code = st.memdata_wr >> 1
+                stats.halt = Halt.TOHOST
+        instr_complete = r.set_instr_complete
+
+        # ph1: is_interrupted sees the mip that was just written.
+        load_trap = r.load_trap
+        next_trap = r.next_trap
+        is_interrupted = 1 if instr_complete and st.mip & (_MTI | _MEI) else 0
+        coverage = self.coverage
+        if enable:
+            irq_load_addr = is_interrupted | instr_phase << 1 | 1 << 3
+            i = self._irq_load_rom.row(irq_load_addr)
+            load_trap |= i.load_trap
+            next_trap |= i.next_trap
+            if coverage is not None:
+                coverage.sequencer_rom[seq_addr | self._z_2_lsb0 << 19] += 1
+                coverage.irq_load_rom[irq_load_addr] += 1
+        elif coverage is not None:
+            coverage.trap_rom[trap_addr | is_interrupted] += 1
+        st.instr_phase = r.next_instr_phase
+        st.stored_alu_eq = alu_eq
+        st.stored_alu_lt = alu_lt
+        st.stored_alu_ltu = alu_ltu
+        if load_trap:
+            st.trap = next_trap
+        st.pc = src[r.pc_mux_select]
+        st.memaddr = src[r.memaddr_mux_select]
+        st.memdata_wr = src[c.memdata_wr_mux_select]
+
+        if st.fatal:
+            stats.halt = Halt.FATAL
+        if instr_complete:
+            if self.trace is not None:
+                self._trace_instr(trap)
+            if trap:
+                stats.traps += 1
+            else:
+                stats.instrs += 1
+                if (self.halt_on_self_loop and stats.halt == Halt.NONE and
+                        st.pc == self._instr_pc and not irq_can_wake(st.mstatus, st.mie)):
+                    stats.halt = Halt.SELF_LOOP
+            self._instr_pc = st.pc
@@ -0,0 +1,383 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module collects microcode coverage: which addresses of SequencerROM,
+TrapROM and IrqLoadInstrROM a run exercised.
+
+An address is one combination of a ROM's inputs, like opcode_select,
+instruction phase, funct3 and flags for SequencerROM. Each machine cycle,
+the ROMs in control of the CPU count their address: SequencerROM and
+IrqLoadInstrROM when enable_sequencer_rom is high, TrapROM otherwise. The
+address is the one the inputs settle to by the end of the machine cycle.
+The counts are kept in a dense NumPy array per ROM, indexed by address, so
+counting costs one memoryview increment per ROM per machine cycle.
+
+Set a RomCoverage as the coverage attribute of CPUSim, MicrocodeSim,
+CXXRTLSim or BatchMicrocodeSim to collect it. The ISS doesn't run the
+microcode, so it has none. MicrocodeSim and BatchMicrocodeSim decode the
+immediate like decode_imm_chips, so they count the same addresses as the
+gateware with the chips, the default of FormalCPU and CXXRTLSim. Without
+the chips, the gateware's imm0 differs for OP and the other SYS format
+opcodes, but the ROM ignores it there, so the entries are the same (see
+below).
+
+Most addresses can't happen: funct3 is part of alu_func, ECALL has fixed
+register fields, phases only follow other phases, and so on. report only
+counts the reachable ones, and groups them into entries: the addresses of
+one handler and phase (like handle_load in phase 1 with funct3 LH) that have
+the same ROM outputs. An entry is exercised if any of its addresses is.
+
+Coverage files from separate runs merge, like the results of parallel runs:
+
+    python rom_coverage.py <coverage.npz>... [--out FILE] [--examples N]
+"""
+import argparse
+import functools
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from nmigen import Cat, Value
+
+from consts import OpcodeSelect
+from rom_table import ROMS, RomTable, load_rom_table, rom_sources_hash
+
+# The ROMs, in the order they're reported.
+ROM_NAMES = ("sequencer_rom", "trap_rom", "irq_load_rom")
+
+# The address fields that group the addresses of each ROM into handlers and
+# phases for the report.
+_GROUP_FIELDS = {
+    "sequencer_rom": ("opcode_select", "_instr_phase", "_funct3"),
+    "trap_rom": ("trap", "_instr_phase"),
+    "irq_load_rom": ("_instr_phase",),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def address_bits(name: str) -> int:
+    """Returns the number of address lines of one of the ROMs."""
+    return load_rom_table(name).address_bits
+
+
+def rom_addresses(seq) -> Dict[str, Value]:
+    """Returns the address of each of the ROMs of a SequencerCard, as nMigen values.
+
+    The address lines are in the order of the ROM's table in rom_table.py.
+    """
+    roms = {"sequencer_rom": seq.rom, "trap_rom": seq.trap_rom,
+            "irq_load_rom": seq.irq_load_rom}
+    return {name: Cat(*(getattr(rom, field) for field in ROMS[name][1]))
+            for name, rom in roms.items()}
+
+
+class RomCoverage:
+    """Counts the machine cycles each ROM address was in control.
+
+    Attributes:
+        counts: The count of each address, by ROM name, as a uint32 array
+            indexed by address.
+        sequencer_rom: A memoryview of the SequencerROM counts, for the
+            simulators to count through.
+        trap_rom: A memoryview of the TrapROM counts.
+        irq_load_rom: A memoryview of the IrqLoadInstrROM counts.
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, np.ndarray] = {
+            name: np.zeros(1 << address_bits(name), dtype=np.uint32) for name in ROM_NAMES}
+        self.sequencer_rom = memoryview(self.counts["sequencer_rom"])
+        self.trap_rom = memoryview(self.counts["trap_rom"])
+        self.irq_load_rom = memoryview(self.counts["irq_load_rom"])
+
+    def clear(self):
+        """Sets every count to zero."""
+        for counts in self.counts.values():
+            counts[:] = 0
+
+    def add(self, name: str, addrs: np.ndarray):
+        """Counts the addresses of one of the ROMs, repeats and all."""
+        np.add.at(self.counts[name], np.asarray(addrs, dtype=np.intp), 1)
+
+    def hit(self, name: str) -> np.ndarray:
+        """Returns the addresses of one of the ROMs that were counted, in increasing order."""
+        return np.flatnonzero(self.counts[name])
+
+    def sparse(self) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Returns the counted addresses and their counts, by ROM name.
+
+        This is much smaller than the counts, for passing between processes.
+        """
+        out = {}
+        for name, counts in self.counts.items():
+            addrs = np.flatnonzero(counts)
+            out[name] = (addrs, counts[addrs])
+        return out
+
+    def merge(self, other: "RomCoverage"):
+        """Adds the counts of another coverage to these."""
+        for name, counts in self.counts.items():
+            counts += other.counts[name]
+
+    def merge_sparse(self, sparse: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        """Adds counts returned by sparse to these."""
+        for name, (addrs, counts) in sparse.items():
+            self.counts[name][addrs] += counts
+
+    def save(self, path: str):
+        """Saves the counts to a .npz file, with the hash of the ROM sources."""
+        np.savez_compressed(path, rom_sources=np.array(rom_sources_hash()), **self.counts)
+
+    @classmethod
+    def load(cls, path: str) -> "RomCoverage":
+        """Loads counts saved with save.
+
+        Raises:
+            ValueError: The counts were collected with different ROMs.
+        """
+        coverage = cls()
+        with np.load(path) as f:
+            if str(f["rom_sources"]) != rom_sources_hash():
+                raise ValueError(f"{path} was collected with different ROM sources")
+            for name, counts in coverage.counts.items():
+                counts += f[name]
+        return coverage
+
+    def report(self, examples: int = 3) -> str:
+        """Returns the coverage of each ROM, and the entries never exercised.
+
+        Args:
+            examples: The number of never-exercised entries to show for each
+                handler and phase, with the address fields of one of their
+                addresses.
+        """
+        lines = []
+        for name in ROM_NAMES:
+            entries = RomEntries.of(name)
+            counts = self.counts[name]
+            hit = entries.hit(counts)
+            unexpected = np.count_nonzero(counts[~entries.reachable])
+            total = len(entries.groups)
+            lines.append(f"{name}: {np.count_nonzero(counts)} addresses, "
+                         f"{np.count_nonzero(hit)} of {total} entries exercised "
+                         f"({100 * np.count_nonzero(hit) / max(total, 1):.1f}%)")
+            if unexpected:
+                lines.append(f"  {unexpected} addresses exercised that should be unreachable")
+            for group in np.unique(entries.groups[~hit]).tolist():
+                missed = np.flatnonzero((entries.groups == group) & ~hit)
+                in_group = np.count_nonzero(entries.groups == group)
+                lines.append(f"  {entries.describe_group(group)}: {len(missed)} of "
+                             f"{in_group} entries never exercised")
+                for entry in missed[:examples].tolist():
+                    lines.append(f"    {entries.describe_entry(entry)}")
+        return "\n".join(lines)
+
+
+class RomEntries:
+    """The reachable addresses of a ROM, grouped into entries.
+
+    Attributes:
+        name: The name of the ROM.
+        table: The ROM's table.
+        reachable: Whether each address can happen while the ROM is in control.
+        entry: The entry of each reachable address, or -1.
+        groups: The group of each entry, as the address with only the group
+            fields kept.
+        first: The lowest address of each entry.
+    """
+
+    def __init__(self, name: str, table: RomTable):
+        self.name = name
+        self.table = table
+        self._offsets: Dict[str, Tuple[int, int]] = {}
+        offset = 0
+        for field, width in table.inputs:
+            self._offsets[field] = (offset, width)
+            offset += width
+        self._addrs = np.arange(1 << table.address_bits, dtype=np.uint32)
+        self.reachable = _REACHABLE[name](self)
+
+        group_mask = 0
+        for field in _GROUP_FIELDS[name]:
+            start, width = self._offsets[field]
+            group_mask |= ((1 << width) - 1) << start
+        addrs = np.flatnonzero(self.reachable)
+        keys = np.concatenate([(addrs & group_mask).astype("<u4").view(np.uint8).reshape(-1, 4),
+                               table.data[addrs]], axis=1)
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        # Number the entries by their lowest address.
+        order = np.argsort(first, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.entry = np.full(len(self._addrs), -1, dtype=np.int64)
+        self.entry[addrs] = rank[inverse.reshape(-1)]
+        self.first = addrs[first[order]]
+        self.groups = self.first & group_mask
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def of(cls, name: str) -> "RomEntries":
+        """Returns the entries of one of the ROMs, from the ROM table cache."""
+        return cls(name, load_rom_table(name))
+
+    def field(self, name: str, addrs: Optional[np.ndarray] = None) -> np.ndarray:
+        """Returns an address field of every address, or of the given ones."""
+        start, width = self._offsets[name]
+        addrs = self._addrs if addrs is None else addrs
+        return (addrs >> start) & ((1 << width) - 1)
+
+    def output(self, name: str, addrs: Optional[np.ndarray] = None) -> np.ndarray:
+        """Returns an output of the ROM at every address, or at the given ones."""
+        offset = 0
+        for output, width in self.table.outputs:
+            if output == name:
+                break
+            offset += width
+        else:
+            raise KeyError(f"{self.name} has no output {name}")
+        data = self.table.data if addrs is None else self.table.data[addrs]
+        value = np.zeros(len(data), dtype=np.uint64)
+        first, last = offset // 8, (offset + width - 1) // 8
+        for i in range(first, last + 1):
+            value |= data[:, i].astype(np.uint64) << np.uint64(8 * (i - first))
+        return (value >> np.uint64(offset % 8)) & np.uint64((1 << width) - 1)
+
+    def reachable_phases(self, start: np.ndarray, key: np.ndarray) -> np.ndarray:
+        """Returns which addresses are in a phase their instruction can reach.
+
+        Phase 0 is reachable wherever start is true. Another phase is reachable
+        for the addresses with some key if an address with that key in a
+        reachable earlier phase goes on to it without completing.
+
+        Args:
+            start: The addresses that can happen, not looking at the phase.
+            key: What an address's instruction or trap is, like its opcode
+                and funct3, as a small integer.
+        """
+        phase = self.field("_instr_phase")
+        next_phase = self.output("_next_instr_phase").astype(np.uint32)
+        going_on = self.output("set_instr_complete") == 0
+        keys = int(key.max()) + 1
+        # reached[phase, key]
+        reached = np.zeros((4, keys), dtype=bool)
+        reached[0] = True
+        while True:
+            live = start & reached[phase, key] & going_on
+            now = reached.copy()
+            now[next_phase[live], key[live]] = True
+            if (now == reached).all():
+                return start & reached[phase, key]
+            reached = now
+
+    def hit(self, counts: np.ndarray) -> np.ndarray:
+        """Returns whether each entry was exercised, given the counts of the addresses."""
+        hit = np.zeros(len(self.first), dtype=bool)
+        entries = self.entry[np.flatnonzero(counts)]
+        hit[entries[entries >= 0]] = True
+        return hit
+
+    def _describe_fields(self, addr: int, fields: Sequence[str]) -> List[str]:
+        return [f"{field.lstrip('_')}={int(self.field(field, np.array([addr]))[0])}"
+                for field in fields]
+
+    def describe_group(self, group: int) -> str:
+        """Returns the handler and group fields of a group."""
+        if self.name == "sequencer_rom":
+            select = OpcodeSelect(int(self.field("opcode_select", np.array([group]))[0]))
+            handler = ("handle_illegal_instr" if select == OpcodeSelect.NONE
+                       else f"handle_{select.name.lower()}")
+            fields = _GROUP_FIELDS[self.name][1:]
+        elif self.name == "trap_rom":
+            trap = int(self.field("trap", np.array([group]))[0])
+            handler = "handle_trap" if trap else "set_exception"
+            fields = _GROUP_FIELDS[self.name][1:]
+        else:
+            handler = "irq_load"
+            fields = _GROUP_FIELDS[self.name]
+        return " ".join([handler] + self._describe_fields(group, fields))
+
+    def describe_entry(self, entry: int) -> str:
+        """Returns the nonzero address fields outside the group of an entry's lowest address."""
+        addr = int(self.first[entry])
+        fields = [field for field, _ in self.table.inputs
+                  if field not in _GROUP_FIELDS[self.name] and field != "enable_sequencer_rom"
+                  and self.field(field, np.array([addr]))[0]]
+        return " ".join([f"{addr:#08x}"] + self._describe_fields(addr, fields))
+
+
+def _sequencer_reachable(entries: RomEntries) -> np.ndarray:
+    """The SequencerROM addresses that decode_instr and the phases can produce."""
+    f = entries.field
+    select = f("opcode_select")
+    funct3 = f("_funct3")
+    alu_func = f("_alu_func")
+    ok = (f("enable_sequencer_rom") == 1) & (select <= max(OpcodeSelect))
+    # alu_func is funct3, and bit 30 for OP and the shifts.
+    ok &= (alu_func & 7) == funct3
+    ok &= ((alu_func >> 3) == 0) | (select == OpcodeSelect.OP) | ((funct3 & 3) == 1)
+    # Branch conditions 2 and 3 are never true.
+    ok &= (f("branch_cond") == 0) | ((funct3 != 2) & (funct3 != 3))
+    # MRET, ECALL and EBREAK are single encodings, and the other SYSTEM
+    # instructions with funct3 0 aren't CSR instructions.
+    fixed = ((select == OpcodeSelect.MRET) | (select == OpcodeSelect.ECALL) |
+             (select == OpcodeSelect.EBREAK))
+    ok &= ~fixed | ((funct3 == 0) & (alu_func == 0) & (f("rd0") == 1) & (f("rs1_0") == 1))
+    ok &= (select != OpcodeSelect.CSRS) | (funct3 != 0)
+    return entries.reachable_phases(ok, (select << 3 | funct3).astype(np.intp))
+
+
+def _trap_reachable(entries: RomEntries) -> np.ndarray:
+    """The TrapROM addresses that can happen while TrapROM is in control."""
+    f = entries.field
+    trap = f("trap")
+    misalign = f("instr_misalign")
+    ok = (trap | misalign | f("bad_instr")) == 1
+    # A misaligned PC is only noticed outside of the trap sequence.
+    ok &= (trap == 0) | (misalign == 0)
+    ok &= (f("fatal") == 0) | (f("exception") == 1)
+    # Outside of the trap sequence, TrapROM takes over in the first phase.
+    ok &= (trap == 1) | (f("_instr_phase") == 0)
+    # A trap that isn't an exception starts with an interrupt pending.
+    ok &= ((trap == 0) | (f("exception") == 1) | (f("_instr_phase") != 0) |
+           ((f("mei_pend") | f("mti_pend")) == 1))
+    return entries.reachable_phases(ok, trap.astype(np.intp))
+
+
+def _irq_load_reachable(entries: RomEntries) -> np.ndarray:
+    """The IrqLoadInstrROM addresses that can happen while it is in control."""
+    return entries.field("enable_sequencer_rom") == 1
+
+
+_REACHABLE = {
+    "sequencer_rom": _sequencer_reachable,
+    "trap_rom": _trap_reachable,
+    "irq_load_rom": _irq_load_reachable,
+}
+
+
+def main(argv: List[str]):
+    """Merges coverage files, and prints the microcode coverage report."""
+    parser = argparse.ArgumentParser(
+        prog="rom_coverage.py",
+        description="Reports the microcode entries a set of runs exercised.")
+    parser.add_argument("files", nargs="+", help="coverage files to merge")
+    parser.add_argument("--out", metavar="FILE", default=None,
+                        help="write the merged coverage to this file")
+    parser.add_argument("--examples", metavar="N", type=int, default=3,
+                        help="never-exercised entries to show per handler and phase "
+                        "(default 3)")
+    args = parser.parse_args(argv)
+
+    coverage = RomCoverage()
+    for path in args.files:
+        try:
+            coverage.merge(RomCoverage.load(path))
+        except ValueError as e:
+            parser.error(str(e))
+    if args.out is not None:
+        coverage.save(args.out)
+    print(coverage.report(args.examples))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,161 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module writes EPROM images for the sequencer card ROMs.
+
+Each ROM's output word is split into byte-wide chips: chip 0 holds output
+bits 0-7, chip 1 bits 8-15, and so on. Every chip sees the ROM's full
+address, with the inputs packed least significant first as listed in the
+.map file written next to the images. Run it with:
+
+    python rom_image.py [--format bin|hex] [--out DIR] [ROM ...]
+
+The images are only rewritten when the ROM sources have changed since the
+last run (see rom_table.rom_sources_hash).
+"""
+import argparse
+import os
+import sys
+from typing import List, Optional
+
+import numpy as np
+
+from rom_table import ROMS, RomTable, load_rom_table, rom_sources_hash
+
+# The number of data bytes in each Intel HEX data record.
+IHEX_RECORD_BYTES = 16
+
+
+def chip_images(table: RomTable) -> List[bytes]:
+    """Returns the contents of each byte-wide chip holding a ROM table."""
+    return [np.ascontiguousarray(table.data[:, chip]).tobytes()
+            for chip in range(table.data.shape[1])]
+
+
+def _ihex_record(addr: int, rectype: int, data: bytes) -> str:
+    record = bytes([len(data), addr >> 8, addr & 0xFF, rectype]) + data
+    return ":" + (record + bytes([-sum(record) & 0xFF])).hex().upper()
+
+
+def to_intel_hex(data: bytes) -> str:
+    """Returns data, starting at address 0, in Intel HEX format.
+
+    Data records hold IHEX_RECORD_BYTES bytes each, and an extended linear
+    address record precedes each 64K block after the first.
+    """
+    lines = []
+    for base in range(0, len(data), 0x10000):
+        block = np.frombuffer(data[base:base + 0x10000], dtype=np.uint8)
+        if base:
+            lines.append(_ihex_record(0, 4, (base >> 16).to_bytes(2, "big")))
+
+        # The full data records are formatted all at once.
+        n = len(block) // IHEX_RECORD_BYTES
+        addrs = np.arange(n, dtype=np.uint32) * IHEX_RECORD_BYTES
+        records = np.empty((n, IHEX_RECORD_BYTES + 5), dtype=np.uint8)
+        records[:, 0] = IHEX_RECORD_BYTES
+        records[:, 1] = addrs >> 8
+        records[:, 2] = addrs & 0xFF
+        records[:, 3] = 0
+        records[:, 4:-1] = block[:n * IHEX_RECORD_BYTES].reshape(n, IHEX_RECORD_BYTES)
+        records[:, -1] = -records[:, :-1].sum(axis=1, dtype=np.uint32) & 0xFF
+        text = records.tobytes().hex().upper()
+        width = 2 * records.shape[1]
+        lines.extend(":" + text[i:i + width] for i in range(0, len(text), width))
+
+        tail = block[n * IHEX_RECORD_BYTES:].tobytes()
+        if tail:
+            lines.append(_ihex_record(n * IHEX_RECORD_BYTES, 0, tail))
+    lines.append(_ihex_record(0, 1, b""))
+    return "\n".join(lines) + "\n"
+
+
+def rom_map(name: str, table: RomTable) -> str:
+    """Returns a description of a ROM's address lines and chip outputs."""
+    lines = [f"{name}: {1 << table.address_bits} words of {table.output_bits} bits",
+             "", "address lines:"]
+    offset = 0
+    for input_name, width in table.inputs:
+        lines.append(f"  A{offset}-A{offset + width - 1}: {input_name}" if width > 1 else
+                     f"  A{offset}: {input_name}")
+        offset += width
+
+    lines.extend(["", "output bits:"])
+    offset = 0
+    for output_name, width in table.outputs:
+        for bit in range(width):
+            chip, d = divmod(offset + bit, 8)
+            suffix = f"[{bit}]" if width > 1 else ""
+            lines.append(f"  chip {chip} D{d}: {output_name}{suffix}")
+        offset += width
+    return "\n".join(lines) + "\n"
+
+
+def write_rom_images(name: str, out_dir: str, fmt: str = "bin",
+                     source_hash: Optional[str] = None) -> bool:
+    """Writes the chip images and map for a ROM, unless they are up to date.
+
+    Returns whether anything was written.
+
+    Args:
+        name: The name of the ROM in rom_table.ROMS.
+        out_dir: The directory to write to.
+        fmt: "bin" for raw binary images, or "hex" for Intel HEX.
+        source_hash: The hash of the ROM sources. Computed if not given.
+    """
+    if source_hash is None:
+        source_hash = rom_sources_hash()
+    stamp = f"{source_hash} {fmt}\n"
+    stamp_path = os.path.join(out_dir, f"{name}.stamp")
+    if os.path.exists(stamp_path):
+        with open(stamp_path, encoding="utf-8") as f:
+            if f.read() == stamp:
+                return False
+
+    table = load_rom_table(name)
+    os.makedirs(out_dir, exist_ok=True)
+    for chip, image in enumerate(chip_images(table)):
+        path = os.path.join(out_dir, f"{name}_{chip}.{fmt}")
+        if fmt == "hex":
+            with open(path, "w", encoding="ascii") as f:
+                f.write(to_intel_hex(image))
+        else:
+            with open(path, "wb") as f:
+                f.write(image)
+    with open(os.path.join(out_dir, f"{name}.map"), "w", encoding="utf-8") as f:
+        f.write(rom_map(name, table))
+    # The stamp goes last, so an interrupted run is redone.
+    with open(stamp_path, "w", encoding="utf-8") as f:
+        f.write(stamp)
+    return True
+
+
+def rom_image_main(argv: List[str]):
+    """Writes the EPROM images for the ROMs named on the command line.
+
+    Args:
+        argv: The command line arguments.
+    """
+    parser = argparse.ArgumentParser(prog="rom_image.py",
+                                     description="Writes EPROM images for the sequencer ROMs.")
+    parser.add_argument("roms", nargs="*", metavar="ROM",
+                        help=f"ROMs to write (default all of {', '.join(ROMS)})")
+    parser.add_argument("--format", choices=["bin", "hex"], default="bin",
+                        help="image format: raw binary or Intel HEX (default bin)")
+    parser.add_argument("--out", default="roms",
+                        help="directory to write the images to (default roms)")
+    args = parser.parse_args(argv)
+    for name in args.roms:
+        if name not in ROMS:
+            parser.error(f"unknown ROM {name!r}")
+
+    source_hash = rom_sources_hash()
+    for name in args.roms or ROMS:
+        if write_rom_images(name, args.out, args.format, source_hash):
+            print(f"{name}: wrote {args.out}/{name}_*.{args.format}")
+        else:
+            print(f"{name}: up to date")
+
+
+if __name__ == "__main__":
+    rom_image_main(sys.argv[1:])
@@ -0,0 +1,384 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module turns the ROM classes into lookup tables.
+
+SequencerROM, TrapROM and IrqLoadInstrROM are described behaviorally in
+nMigen, but they are purely combinational functions of a few registered
+address lines. RomTable enumerates every address at once: the elaborated
+statements are evaluated with NumPy, one array lane per address, and the
+outputs are packed into one little-endian word per address.
+
+Building the SequencerROM table takes a few seconds, so load_rom_table keeps
+the tables in a cache directory, keyed by a hash of the ROM sources.
+"""
+import hashlib
+import os
+from collections import namedtuple
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from nmigen import Elaboratable, Signal
+from nmigen.hdl.ast import Assign, Cat, Const, Operator, Repl, Slice, Switch, Value
+from nmigen.hdl.ast import SignalDict, Statement
+from nmigen.hdl.ir import Fragment
+
+from irq_load_rom import IrqLoadInstrROM
+from sequencer_rom import SequencerROM
+from trap_rom import TrapROM
+
+# The address lines of each ROM, least significant first.
+SEQUENCER_ROM_INPUTS = ("opcode_select", "_funct3", "_alu_func", "_instr_phase",
+                        "branch_cond", "memaddr_2_lsb", "imm0", "rd0", "rs1_0",
+                        "data_z_in_2_lsb0", "enable_sequencer_rom")
+TRAP_ROM_INPUTS = ("is_interrupted", "exception", "fatal", "instr_misalign", "bad_instr",
+                   "trap", "mei_pend", "mti_pend", "vec_mode", "_instr_phase")
+IRQ_LOAD_ROM_INPUTS = ("is_interrupted", "_instr_phase", "enable_sequencer_rom")
+
+# The ROMs by name, with their address lines.
+ROMS = {
+    "sequencer_rom": (SequencerROM, SEQUENCER_ROM_INPUTS),
+    "trap_rom": (TrapROM, TRAP_ROM_INPUTS),
+    "irq_load_rom": (IrqLoadInstrROM, IRQ_LOAD_ROM_INPUTS),
+}
+
+# The files whose contents determine the ROM tables.
+ROM_SOURCES = ("sequencer_rom.py", "trap_rom.py", "irq_load_rom.py", "consts.py", "util.py",
+               "rom_table.py")
+
+# RomTable.build evaluates 2**_CHUNK_BITS addresses at a time.
+_CHUNK_BITS = 16
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".rom_cache")
+
+
+class _Evaluator:
+    """Evaluates combinational nMigen statements on NumPy arrays of lanes."""
+
+    def __init__(self, lanes: int, env: SignalDict):
+        self.lanes = lanes
+        self.env = env
+
+    def value(self, v: Value) -> np.ndarray:
+        """Returns the value of an expression in every lane, as uint64."""
+        width = len(v)
+        if width > 64:
+            raise NotImplementedError(f"{v!r} is wider than 64 bits")
+        mask = np.uint64((1 << width) - 1)
+
+        if isinstance(v, Const):
+            return np.full(self.lanes, v.value & int(mask), dtype=np.uint64)
+        if isinstance(v, Signal):
+            if v in self.env:
+                return self.env[v]
+            return np.full(self.lanes, v.reset, dtype=np.uint64)
+        if isinstance(v, Slice):
+            return (self.value(v.value) >> np.uint64(v.start)) & mask
+        if isinstance(v, Cat):
+            out = np.zeros(self.lanes, dtype=np.uint64)
+            offset = 0
+            for part in v.parts:
+                out |= self.value(part) << np.uint64(offset)
+                offset += len(part)
+            return out
+        if isinstance(v, Repl):
+            part = self.value(v.value)
+            out = np.zeros(self.lanes, dtype=np.uint64)
+            for i in range(v.count):
+                out |= part << np.uint64(i * len(v.value))
+            return out
+        if isinstance(v, Operator):
+            return self._operator(v) & mask
+        raise NotImplementedError(f"Can't evaluate {v!r}")
+
+    def _operator(self, v: Operator) -> np.ndarray:
+        if any(op.shape().signed for op in v.operands):
+            raise NotImplementedError(f"Signed operands aren't supported in {v!r}")
+        ops = [self.value(op) for op in v.operands]
+
+        if len(ops) == 1:
+            a, = ops
+            a_mask = np.uint64((1 << len(v.operands[0])) - 1)
+            if v.operator == "~":
+                return ~a
+            if v.operator == "-":
+                return np.uint64(0) - a
+            if v.operator in ("b", "r|"):
+                return (a != 0).astype(np.uint64)
+            if v.operator == "r&":
+                return (a == a_mask).astype(np.uint64)
+            if v.operator == "r^":
+                parity = np.zeros(self.lanes, dtype=np.uint64)
+                for i in range(len(v.operands[0])):
+                    parity ^= a >> np.uint64(i)
+                return parity & np.uint64(1)
+            if v.operator in ("+", "u"):
+                return a
+        elif len(ops) == 2:
+            a, b = ops
+            if v.operator == "+":
+                return a + b
+            if v.operator == "-":
+                return a - b
+            if v.operator == "&":
+                return a & b
+            if v.operator == "|":
+                return a | b
+            if v.operator == "^":
+                return a ^ b
+            if v.operator == "<<":
+                return a << b
+            if v.operator == ">>":
+                return a >> b
+            if v.operator == "==":
+                return (a == b).astype(np.uint64)
+            if v.operator == "!=":
+                return (a != b).astype(np.uint64)
+            if v.operator == "<":
+                return (a < b).astype(np.uint64)
+            if v.operator == "<=":
+                return (a <= b).astype(np.uint64)
+            if v.operator == ">":
+                return (a > b).astype(np.uint64)
+            if v.operator == ">=":
+                return (a >= b).astype(np.uint64)
+        elif len(ops) == 3 and v.operator == "m":
+            sel, a, b = ops
+            return np.where(sel != 0, a, b)
+        raise NotImplementedError(f"Operator {v.operator} isn't supported")
+
+    def run(self, stmts: Sequence, enable: np.ndarray):
+        """Executes statements in the lanes where enable is true."""
+        for stmt in stmts:
+            if isinstance(stmt, Assign):
+                self._assign(stmt.lhs, self.value(stmt.rhs), enable)
+            elif isinstance(stmt, Switch):
+                # Signals are assigned in place, so the cases mustn't see the test change.
+                test = self.value(stmt.test).copy()
+                remaining = enable.copy()
+                for patterns, body in stmt.cases.items():
+                    if not remaining.any():
+                        break
+                    if patterns == ():
+                        match = remaining.copy()
+                    else:
+                        match = np.zeros(self.lanes, dtype=bool)
+                        for pattern in patterns:
+                            care = np.uint64(int(pattern.replace("0", "1").replace("-", "0"), 2))
+                            bits = np.uint64(int(pattern.replace("-", "0"), 2))
+                            match |= (test & care) == bits
+                        match &= remaining
+                    remaining &= ~match
+                    if match.any():
+                        self.run(body, match)
+            else:
+                raise NotImplementedError(f"Can't evaluate {stmt!r}")
+
+    def _assign(self, lhs: Value, rhs: np.ndarray, enable: np.ndarray):
+        if isinstance(lhs, Signal):
+            if lhs not in self.env:
+                self.env[lhs] = np.full(self.lanes, lhs.reset, dtype=np.uint64)
+            rhs = rhs & np.uint64((1 << len(lhs)) - 1)
+            np.copyto(self.env[lhs], rhs, where=enable)
+        elif isinstance(lhs, Slice):
+            width = lhs.stop - lhs.start
+            field = np.uint64(((1 << width) - 1) << lhs.start)
+            old = self.value(lhs.value)
+            new = (old & ~field) | ((rhs << np.uint64(lhs.start)) & field)
+            self._assign(lhs.value, new, enable)
+        elif isinstance(lhs, Cat):
+            offset = 0
+            for part in lhs.parts:
+                self._assign(part, rhs >> np.uint64(offset), enable)
+                offset += len(part)
+        else:
+            raise NotImplementedError(f"Can't assign to {lhs!r}")
+
+
+class RomTable:
+    """The outputs of a ROM for every address.
+
+    Attributes:
+        inputs: The name and width of each address field, least significant first.
+        outputs: The name and width of each output, least significant first in
+            the packed output word.
+        data: The packed output words, one row of little-endian bytes per address.
+        Row: The namedtuple type returned by row. Its fields are the output names
+            with any leading underscore dropped.
+    """
+
+    def __init__(self, inputs: List[Tuple[str, int]], outputs: List[Tuple[str, int]],
+                 data: np.ndarray):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.data = data
+        self.Row = namedtuple("Row", [name.lstrip("_") for name, _ in outputs])
+        self._rows: Dict[int, Tuple[int, ...]] = {}
+
+    @property
+    def address_bits(self) -> int:
+        """The number of address lines."""
+        return sum(width for _, width in self.inputs)
+
+    @property
+    def output_bits(self) -> int:
+        """The number of output bits in each word."""
+        return sum(width for _, width in self.outputs)
+
+    @classmethod
+    def build(cls, rom: Elaboratable, inputs: Sequence[str],
+              outputs: Optional[Sequence[str]] = None,
+              fixed: Optional[Dict[str, int]] = None) -> "RomTable":
+        """Evaluates a ROM at every address.
+
+        Args:
+            rom: The ROM. It must elaborate to a single fragment of combinational
+                statements.
+            inputs: The names of the ROM's input signals making up the address,
+                least significant first.
+            outputs: The names of the output signals to keep. Defaults to every
+                signal the ROM drives, in the order the ROM declares them.
+            fixed: Values for input signals that are not part of the address.
+                Signals that are neither inputs nor fixed are held at their reset
+                values.
+        """
+        fragment = Fragment.get(rom, None)
+        if fragment.subfragments or set(fragment.drivers) - {None}:
+            raise ValueError(f"{type(rom).__name__} is not purely combinational")
+
+        driven = fragment.drivers.get(None, [])
+        if outputs is None:
+            outputs = [name for name, sig in vars(rom).items()
+                       if isinstance(sig, Signal) and sig in driven]
+        in_sigs = [(name, getattr(rom, name)) for name in inputs]
+        out_sigs = [(name, getattr(rom, name)) for name in outputs]
+
+        address_bits = sum(len(sig) for _, sig in in_sigs)
+        output_bits = sum(len(sig) for _, sig in out_sigs)
+        # Evaluate the address space in chunks, which keeps the arrays small
+        # enough to stay in cache.
+        chunk = 1 << min(address_bits, _CHUNK_BITS)
+        data = np.concatenate([
+            cls._build_chunk(fragment.statements, in_sigs, out_sigs, fixed,
+                             np.arange(start, start + chunk, dtype=np.uint64), rom)
+            for start in range(0, 1 << address_bits, chunk)])
+        data = np.ascontiguousarray(data[:, :(output_bits + 7) // 8])
+
+        return cls([(name, len(sig)) for name, sig in in_sigs],
+                   [(name, len(sig)) for name, sig in out_sigs], data)
+
+    @staticmethod
+    def _build_chunk(statements: List[Statement], in_sigs: List[Tuple[str, Signal]],
+                     out_sigs: List[Tuple[str, Signal]], fixed: Optional[Dict[str, int]],
+                     address: np.ndarray, rom: Elaboratable) -> np.ndarray:
+        """Evaluates the ROM at the given addresses, returning the packed words as bytes."""
+        lanes = len(address)
+        env = SignalDict()
+        offset = 0
+        for _, sig in in_sigs:
+            env[sig] = (address >> np.uint64(offset)) & np.uint64((1 << len(sig)) - 1)
+            offset += len(sig)
+        for name, value in (fixed or {}).items():
+            env[getattr(rom, name)] = np.full(lanes, value, dtype=np.uint64)
+
+        evaluator = _Evaluator(lanes, env)
+        evaluator.run(statements, np.ones(lanes, dtype=bool))
+
+        # Pack the outputs into 64-bit words.
+        output_bits = sum(len(sig) for _, sig in out_sigs)
+        words = np.zeros(((output_bits + 63) // 64, lanes), dtype=np.uint64)
+        offset = 0
+        for _, sig in out_sigs:
+            value = evaluator.value(sig)
+            word, shift = divmod(offset, 64)
+            words[word] |= value << np.uint64(shift)
+            if shift + len(sig) > 64:
+                words[word + 1] |= value >> np.uint64(64 - shift)
+            offset += len(sig)
+        return np.ascontiguousarray(words.T, dtype="<u8").view(np.uint8).reshape(lanes, -1)
+
+    def save(self, path: str):
+        """Saves the table to a .npz file."""
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, data=self.data,
+                 inputs=np.array([name for name, _ in self.inputs]),
+                 input_widths=np.array([width for _, width in self.inputs]),
+                 outputs=np.array([name for name, _ in self.outputs]),
+                 output_widths=np.array([width for _, width in self.outputs]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "RomTable":
+        """Loads a table saved with save."""
+        with np.load(path) as f:
+            return cls(list(zip(f["inputs"].tolist(), f["input_widths"].tolist())),
+                       list(zip(f["outputs"].tolist(), f["output_widths"].tolist())),
+                       f["data"])
+
+    def address(self, **values: int) -> int:
+        """Returns the address for the given input values. Missing inputs are 0."""
+        addr = 0
+        offset = 0
+        for name, width in self.inputs:
+            addr |= (values.get(name, 0) & ((1 << width) - 1)) << offset
+            offset += width
+        return addr
+
+    def word(self, addr: int) -> int:
+        """Returns the packed output word at an address."""
+        return int.from_bytes(self.data[addr].tobytes(), "little")
+
+    def row(self, addr: int) -> Tuple[int, ...]:
+        """Returns the outputs at an address, as a Row namedtuple.
+
+        Rows are cached, so looking up the same address again is cheap.
+        """
+        row = self._rows.get(addr)
+        if row is None:
+            word = self.word(addr)
+            fields = []
+            for _, width in self.outputs:
+                fields.append(word & ((1 << width) - 1))
+                word >>= width
+            row = self._rows[addr] = self.Row(*fields)
+        return row
+
+
+def rom_sources_hash() -> str:
+    """Returns a hash of the files the ROM tables are built from."""
+    h = hashlib.sha256()
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in ROM_SOURCES:
+        with open(os.path.join(src_dir, name), "rb") as f:
+            h.update(name.encode() + b"\0" + f.read() + b"\0")
+    return h.hexdigest()
+
+
+def build_rom_table(name: str) -> RomTable:
+    """Builds the table for one of the ROMS, without using the cache."""
+    cls, inputs = ROMS[name]
+    return RomTable.build(cls(), inputs)
+
+
+def load_rom_table(name: str, cache_dir: Optional[str] = DEFAULT_CACHE_DIR) -> RomTable:
+    """Returns the table for one of the ROMS, building it only if the cache is stale.
+
+    Args:
+        name: The name of the ROM in ROMS.
+        cache_dir: The directory holding cached tables, or None to always build.
+    """
+    if cache_dir is None:
+        return build_rom_table(name)
+
+    key = rom_sources_hash()[:16]
+    path = os.path.join(cache_dir, f"{name}-{key}.npz")
+    if os.path.exists(path):
+        return RomTable.load(path)
+
+    table = build_rom_table(name)
+    os.makedirs(cache_dir, exist_ok=True)
+    for old in os.listdir(cache_dir):
+        if old.startswith(name + "-") and old.endswith(".npz"):
+            os.remove(os.path.join(cache_dir, old))
+    table.save(path)
+    return table
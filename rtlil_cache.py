@@ -0,0 +1,134 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module caches the RTLIL that util.main generates, across invocations.
+
+Converting a design to RTLIL is most of the time a gen takes, about ten
+seconds for each mode of formal_cpu.py, and make regenerates every mode
+whenever any source changes. So the RTLIL is cached in .rtlil_cache, keyed
+by a hash of:
+
+* The source of the design's module, and of the modules in this directory
+  it imports, directly or not. Imports inside functions are left out, since
+  they don't run while generating (like the cpu_sim import for sim).
+* The arguments of the gen command, like the mode, and the output file name.
+* The nMigen version.
+* The directory of the sources. The src attributes of the RTLIL hold the
+  paths of the sources, which formal_deps.py maps to functions, so RTLIL
+  cached in another checkout, or before the checkout moved, isn't used.
+
+A gen whose key is cached writes the cached RTLIL instead of elaborating the
+design. Elaborated Fragments aren't cached: signals with enum decoders hold
+local functions, which can't be pickled, and the RTLIL is what the solvers
+read anyway.
+
+Set RTLIL_CACHE=0 in the environment to always generate.
+"""
+import ast
+import hashlib
+import os
+from typing import List, Optional, Sequence
+
+import nmigen
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".rtlil_cache")
+
+
+def _module_imports(tree: ast.AST) -> List[str]:
+    """Returns the names of the modules imported outside of functions."""
+    names = []
+    for node in ast.iter_child_nodes(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            continue
+        if isinstance(node, ast.Import):
+            names.extend(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.append(node.module.split(".")[0])
+        names.extend(_module_imports(node))
+    return names
+
+
+def source_files(path: str) -> List[str]:
+    """Returns a source file and the source files in its directory it imports, directly or not.
+
+    The files are sorted, as absolute paths.
+    """
+    path = os.path.abspath(path)
+    src_dir = os.path.dirname(path)
+    found = set()
+    todo = [path]
+    while todo:
+        path = todo.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(path, "rb") as f:
+            tree = ast.parse(f.read(), filename=path)
+        for name in _module_imports(tree):
+            imported = os.path.join(src_dir, name + ".py")
+            if os.path.exists(imported):
+                todo.append(imported)
+    return sorted(found)
+
+
+def cache_key(path: str, args: Sequence[str]) -> str:
+    """Returns the cache key for generating RTLIL from a source file with some arguments."""
+    h = hashlib.sha256()
+    h.update(os.path.dirname(os.path.abspath(path)).encode() + b"\0")
+    for source in source_files(path):
+        with open(source, "rb") as f:
+            h.update(os.path.basename(source).encode() + b"\0" + f.read() + b"\0")
+    h.update(repr((list(args), getattr(nmigen, "__version__", ""))).encode())
+    return h.hexdigest()[:16]
+
+
+def cache_name(path: str, filename: str) -> str:
+    """Returns the name the RTLIL a source file generates into an output file is cached under.
+
+    The cards all generate toplevel.il, so the name has the source file in it.
+    """
+    module = os.path.splitext(os.path.basename(path))[0]
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return stem if stem.startswith(module) else f"{module}-{stem}"
+
+
+def cached_path(name: str, key: str, cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+    """Returns where the RTLIL cached under a name and key is."""
+    return os.path.join(cache_dir, f"{name}-{key}.il")
+
+
+def enabled() -> bool:
+    """Returns whether the cache is used, which it is unless RTLIL_CACHE=0."""
+    return os.environ.get("RTLIL_CACHE", "1") != "0"
+
+
+def fetch(name: str, key: str, cache_dir: str = DEFAULT_CACHE_DIR) -> Optional[str]:
+    """Returns the RTLIL cached under a name and key, or None if there is none."""
+    try:
+        with open(cached_path(name, key, cache_dir)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def store(name: str, key: str, output: str, cache_dir: str = DEFAULT_CACHE_DIR,
+          ) -> Optional[str]:
+    """Caches RTLIL under a name and key, replacing what was cached under the name.
+
+    Returns:
+        The path of the cached RTLIL, or None if it couldn't be written.
+    """
+    path = cached_path(name, key, cache_dir)
+    prefix = f"{name}-"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for old in os.listdir(cache_dir):
+            if old.startswith(prefix) and old.endswith(".il"):
+                os.remove(os.path.join(cache_dir, old))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(output)
+        os.replace(tmp, path)
+    except OSError:
+        return None
+    return path
@@ -246,10 +246,12 @@ class SequencerCard(Elaboratable):
         m.d.comb += self.csr_num_is_mtvec.eq(self.csr_num == CSRAddr.MTVEC)
         m.d.comb += self.mtvec_mux_select.eq(Mux(self.z_to_csr & self.csr_num_is_mtvec,
                                                  SeqMuxSelect.Z, SeqMuxSelect.MTVEC))
-        # Only used on instruction phase 1 in BRANCH, which is why we can
-        # register this on phase 1. Also, because it's an input to a ROM,
-        # we have to ensure the signal is registered.
-        m.d.ph1 += self.data_z_in_2_lsb0.eq(self.data_z_in[0:2] == 0)
+        # Only used on instruction phase 1 in BRANCH, to check the branch target
+        # computed in that same machine cycle. Because it's an input to a ROM,
+        # we have to ensure the signal is registered. It is registered on ph2,
+        # which rises once the target has settled on Z. Registering on ph1 would
+        # capture the previous machine cycle's Z, which is rs1 - rs2.
+        m.d.ph2 += self.data_z_in_2_lsb0.eq(self.data_z_in[0:2] == 0)
 
         with m.If(self.set_instr_complete):
             m.d.comb += self.instr_complete.eq(self.mcycle_end)
@@ -434,7 +436,7 @@ class SequencerCard(Elaboratable):
 
             with m.Case(Opcode.JALR):
                 m.d.comb += self.opcode_select.eq(OpcodeSelect.JALR)
-                m.d.comb += self._imm_format.eq(OpcodeFormat.J)
+                m.d.comb += self._imm_format.eq(OpcodeFormat.I)
 
             with m.Case(Opcode.BRANCH):
                 m.d.comb += self.opcode_select.eq(OpcodeSelect.BRANCH)
@@ -554,7 +556,9 @@ class SequencerCard(Elaboratable):
             self._funct3.eq(self.state._instr[12:15]),
             self._funct7.eq(self.state._instr[25:]),
             self._alu_func[:3].eq(self._funct3),
-            self._alu_func[3].eq(self._funct7[5]),
+            # In OP_IMM, bit 30 is part of the immediate, except for the shifts.
+            self._alu_func[3].eq(self._funct7[5] & ((self._opcode == Opcode.OP) |
+                                                    (self._funct3[:2] == 0b01))),
             self._funct12.eq(self.state._instr[20:]),
         ]
         if (self.chips):
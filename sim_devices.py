@@ -0,0 +1,304 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module provides memory-mapped devices for the CPU simulators.
+
+A DeviceBus maps devices into a MainMemory and drives the CPU's time_irq and
+ext_irq lines from them. Devices are scheduled by the machine cycle of their
+next event: the simulators only call DeviceBus.update when the earliest event
+comes due, so devices that are idle cost nothing per machine cycle.
+
+The gateware simulators read memory on every machine cycle, not just on
+loads, so reading a device register never has side effects.
+
+Devices:
+
+    Timer     mtime and mtimecmp, driving time_irq.
+    UART      A byte-wide serial port backed by files or pipes.
+    IrqSource A programmable external interrupt line, driving ext_irq.
+
+Device state isn't saved in checkpoints.
+"""
+import os
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sim_memory import PAGE_SIZE, MainMemory
+
+# The next_event of a device with nothing scheduled.
+NEVER = 1 << 62
+
+
+class Device:
+    """A memory-mapped device.
+
+    Attributes:
+        base: The page-aligned address of the device's first register.
+        size: The size of the device's register space in bytes.
+        line: The interrupt line the device drives, "time" or "ext".
+        irq: The level the device drives onto its interrupt line.
+        next_event: The machine cycle at which the device next needs update
+            to be called, or NEVER.
+    """
+
+    def __init__(self, base: int, size: int = PAGE_SIZE, line: str = "ext"):
+        assert base % PAGE_SIZE == 0
+        assert line in ("time", "ext")
+        self.base = base
+        self.size = size
+        self.line = line
+        self.irq = 0
+        self.next_event = NEVER
+
+    def read(self, offset: int, now: int) -> int:
+        """Reads the 32-bit register at a word-aligned offset, without side effects."""
+        raise NotImplementedError
+
+    def write(self, offset: int, data: int, mask: int, now: int):
+        """Writes the byte lanes of the register at a word-aligned offset selected by mask.
+
+        A write that can change irq sets next_event to now, so that update is called.
+        """
+        raise NotImplementedError
+
+    def update(self, now: int):
+        """Runs the device's events due by machine cycle now, and updates irq and next_event."""
+
+
+def _merge(old: int, data: int, mask: int) -> int:
+    """Returns old with the byte lanes selected by mask replaced from data."""
+    for i in range(4):
+        if mask & (1 << i):
+            lane = 0xFF << (8 * i)
+            old = (old & ~lane) | (data & lane)
+    return old
+
+
+class Timer(Device):
+    """A machine timer, with the 64-bit mtime and mtimecmp registers.
+
+    mtime counts machine cycles divided by period. time_irq is high while
+    mtime >= mtimecmp.
+
+    Registers:
+        0x0: mtime, low word.
+        0x4: mtime, high word.
+        0x8: mtimecmp, low word.
+        0xC: mtimecmp, high word.
+    """
+
+    def __init__(self, base: int, period: int = 1):
+        super().__init__(base, line="time")
+        self.period = period
+        self.mtimecmp = (1 << 64) - 1
+        # mtime is (now // period + _mtime_offset) mod 2^64.
+        self._mtime_offset = 0
+
+    def mtime(self, now: int) -> int:
+        """Returns the value of mtime at machine cycle now."""
+        return (now // self.period + self._mtime_offset) & ((1 << 64) - 1)
+
+    def read(self, offset: int, now: int) -> int:
+        value = self.mtime(now) if offset < 0x8 else self.mtimecmp
+        return (value >> (32 if offset & 0x4 else 0)) & 0xFFFFFFFF
+
+    def write(self, offset: int, data: int, mask: int, now: int):
+        if offset >= 0x10:
+            return
+        shift = 32 if offset & 0x4 else 0
+        old = self.mtime(now) if offset < 0x8 else self.mtimecmp
+        word = _merge((old >> shift) & 0xFFFFFFFF, data, mask)
+        value = (old & ~(0xFFFFFFFF << shift)) | (word << shift)
+        if offset < 0x8:
+            self._mtime_offset = value - now // self.period
+        else:
+            self.mtimecmp = value
+        self.next_event = now
+
+    def update(self, now: int):
+        mtime = self.mtime(now)
+        self.irq = 1 if mtime >= self.mtimecmp else 0
+        if self.irq:
+            # The line stays high until mtimecmp or mtime is written.
+            self.next_event = NEVER
+        else:
+            self.next_event = (now // self.period + self.mtimecmp - mtime) * self.period
+
+
+class UART(Device):
+    """A byte-wide serial port.
+
+    Bytes written to TXDATA go to the tx file. Received bytes come from the
+    rx file, which can be a pipe. Because reads have no side effects,
+    a received byte is consumed by writing to RXDATA rather than by reading it.
+    While the receive interrupt is enabled, rx is polled every
+    poll_cycles machine cycles, and ext_irq is high while a byte is waiting.
+
+    Registers:
+        0x0: TXDATA. Writing sends the low byte. Reads as 0: the port is never busy.
+        0x4: RXDATA. Bit 31 is set if no byte has been received, otherwise the
+            low byte is the received byte. Writing consumes the byte.
+        0x8: IE. Bit 0 enables the receive interrupt.
+    """
+
+    def __init__(self, base: int, tx: Optional[BinaryIO] = None, rx: Optional[BinaryIO] = None,
+                 poll_cycles: int = 1000):
+        super().__init__(base, line="ext")
+        self.tx = tx
+        self.rx = rx
+        self.poll_cycles = poll_cycles
+        self.ie = 0
+        self._rx_byte: Optional[int] = None
+        if rx is not None and not rx.seekable():
+            os.set_blocking(rx.fileno(), False)
+
+    def _peek(self) -> Optional[int]:
+        """Returns the received byte, reading one from rx if needed."""
+        if self._rx_byte is None and self.rx is not None:
+            data = self.rx.read(1)
+            if data:
+                self._rx_byte = data[0]
+        return self._rx_byte
+
+    def read(self, offset: int, now: int) -> int:
+        if offset == 0x4:
+            rx = self._peek()
+            return 1 << 31 if rx is None else rx
+        if offset == 0x8:
+            return self.ie
+        return 0
+
+    def write(self, offset: int, data: int, mask: int, now: int):
+        if offset == 0x0 and mask & 1:
+            if self.tx is not None:
+                self.tx.write(bytes([data & 0xFF]))
+                self.tx.flush()
+        elif offset == 0x4:
+            self._rx_byte = None
+        elif offset == 0x8 and mask & 1:
+            self.ie = data & 1
+        self.next_event = now
+
+    def update(self, now: int):
+        waiting = self._peek() is not None
+        self.irq = 1 if self.ie and waiting else 0
+        if self.ie and not waiting and self.rx is not None:
+            self.next_event = now + self.poll_cycles
+        else:
+            self.next_event = NEVER
+
+
+class IrqSource(Device):
+    """A programmable interrupt line.
+
+    The line follows a script of (machine cycle, level) changes given when the
+    device is made, and can also be driven by the program.
+
+    Registers:
+        0x0: LEVEL. Bit 0 is the level of the line. Writing sets it at once.
+        0x4: DELAY. Writing N raises the line N machine cycles later.
+            Reads as the cycles left, or 0 if no raise is pending.
+    """
+
+    def __init__(self, base: int, line: str = "ext",
+                 script: Iterable[Tuple[int, int]] = ()):
+        super().__init__(base, line=line)
+        self._script: List[Tuple[int, int]] = sorted(script, reverse=True)
+        self._raise_at: Optional[int] = None
+        self._schedule()
+
+    def _schedule(self):
+        """Sets next_event to the earliest pending change."""
+        times = [NEVER]
+        if self._script:
+            times.append(self._script[-1][0])
+        if self._raise_at is not None:
+            times.append(self._raise_at)
+        self.next_event = min(times)
+
+    def read(self, offset: int, now: int) -> int:
+        if offset == 0x0:
+            return self.irq
+        if offset == 0x4 and self._raise_at is not None:
+            return max(self._raise_at - now, 0)
+        return 0
+
+    def write(self, offset: int, data: int, mask: int, now: int):
+        if offset == 0x0 and mask & 1:
+            self.irq = data & 1
+        elif offset == 0x4:
+            self._raise_at = now + _merge(0, data, mask)
+        self.next_event = now
+
+    def update(self, now: int):
+        while self._script and self._script[-1][0] <= now:
+            self.irq = 1 if self._script.pop()[1] else 0
+        if self._raise_at is not None and self._raise_at <= now:
+            self.irq = 1
+            self._raise_at = None
+        self._schedule()
+
+
+class DeviceBus:
+    """The devices on a simulator's memory bus.
+
+    Attributes:
+        devices: The devices.
+        next_event: The earliest next_event of the devices. Simulators call
+            update when the machine cycle reaches it.
+    """
+
+    def __init__(self, memory: MainMemory, devices: Sequence[Device]):
+        """Maps the devices into memory.
+
+        Args:
+            memory: The memory to map the devices into.
+            devices: The devices.
+        """
+        self.devices = list(devices)
+        self.next_event = 0
+        self._sim = None
+        self._pages: Dict[int, Device] = {}
+        for device in self.devices:
+            for addr in range(device.base, device.base + device.size, PAGE_SIZE):
+                self._pages[addr // PAGE_SIZE] = device
+            memory.map_io(device.base, device.size, self)
+
+    def attach(self, sim):
+        """Makes the devices drive a simulator's interrupt lines.
+
+        The simulator's stats.cycles gives the time of memory accesses.
+        """
+        sim.devices = self
+        self._sim = sim
+        self.next_event = 0
+
+    def _now(self) -> int:
+        return self._sim.stats.cycles if self._sim is not None else 0
+
+    def read_word(self, addr: int) -> int:
+        """Reads the device register containing the given byte address."""
+        device = self._pages[addr // PAGE_SIZE]
+        return device.read((addr - device.base) & ~3, self._now())
+
+    def write_word(self, addr: int, data: int, mask: int):
+        """Writes the byte lanes of a device register selected by mask."""
+        device = self._pages[addr // PAGE_SIZE]
+        device.write((addr - device.base) & ~3, data, mask, self._now())
+        self.next_event = min(self.next_event, device.next_event)
+
+    def update(self, now: int):
+        """Runs the events due by machine cycle now, and drives the simulator's interrupt lines."""
+        time_irq = ext_irq = 0
+        next_event = NEVER
+        for device in self.devices:
+            if device.next_event <= now:
+                device.update(now)
+            if device.line == "time":
+                time_irq |= device.irq
+            else:
+                ext_irq |= device.irq
+            next_event = min(next_event, device.next_event)
+        self.next_event = next_event
+        if self._sim is not None:
+            self._sim.time_irq = time_irq
+            self._sim.ext_irq = ext_irq
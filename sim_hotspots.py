@@ -0,0 +1,173 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module finds the hotspots of simulated firmware by sampling the PC.
+
+A PCSampler goes in a simulator's trace attribute in place of a TraceWriter,
+like sim_profile.Profiler, so it works with every engine that writes
+traces. With a period of N, it samples the PC of the instruction in flight
+every N machine cycles. With a period of 0, it samples every retired
+instruction instead. The time of a trap entry is counted against mepc.
+
+Samples are counted in a NumPy histogram by PC, and mapped to functions
+with an elf_symbols.SymbolTable. Without symbols, each PC is its own
+function.
+
+The sampler also keeps a shadow call stack, pushing the calling function on
+JAL and JALR with rd of ra or t0, and on trap entry. It pops on returns
+(JALR with rd of zero and rs1 of ra or t0) and on MRET. write_collapsed
+writes the samples with their stacks in the collapsed format that
+flamegraph.pl and speedscope read.
+"""
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from consts import Opcode
+from elf_symbols import SymbolTable
+from sim_trace import RECORD_FIELDS, TRAP, TraceSink, block_words
+
+_MRET = 0x30200073
+# The link registers of the standard calling convention: ra and t0.
+_LINK_REGS = (1, 5)
+
+
+class PCSampler(TraceSink):
+    """Samples the PC of a run from its trace records.
+
+    Attributes:
+        records: The fields of the records not yet sampled, as for TraceSink.
+        block_records: The number of records sampled at a time.
+        period: The machine cycles between samples, or 0 to sample every
+            retired instruction.
+        symbols: The symbols to map PCs to functions with, if any.
+        then: The TraceWriter or profiler to pass the records on to, if any.
+    """
+
+    def __init__(self, period: int = 0, symbols: Optional[SymbolTable] = None,
+                 start_cycle: int = 0, then: Optional[TraceSink] = None,
+                 block_records: int = 1 << 16):
+        """Sets up a sampler.
+
+        Args:
+            period: The machine cycles between samples, or 0 to sample every
+                retired instruction.
+            symbols: The symbols to map PCs to functions with, if any.
+            start_cycle: The machine cycle count of the simulator when the
+                sampler is attached.
+            then: The TraceWriter or profiler to pass the records on to, if any.
+            block_records: The number of records sampled at a time.
+        """
+        super().__init__(block_records, then)
+        self.period = period
+        self.symbols = symbols
+        # The next machine cycle to sample.
+        self._next_sample = start_cycle + period
+        # The number of samples by PC.
+        self._pcs: Dict[int, int] = Counter()
+        # The shadow call stack, as the PCs of the call sites, and the number
+        # of samples by stack and PC.
+        self._stack: List[int] = []
+        self._stacks: Dict[Tuple[Tuple[int, ...], int], int] = Counter()
+
+    def _process(self, block: List[int]):
+        """Samples a block of records."""
+        words = block_words(block)
+        pcs = words[:, RECORD_FIELDS.index("pc")]
+        if self.period:
+            cycles = words[:, RECORD_FIELDS.index("cycle")]
+            sample_cycles = np.arange(self._next_sample, cycles[-1] + 1, self.period)
+            self._next_sample = (int(sample_cycles[-1]) if len(sample_cycles)
+                                 else self._next_sample - self.period) + self.period
+            # The instruction in flight at a cycle is the first to complete at or after it.
+            samples = np.searchsorted(cycles, sample_cycles, side="left")
+        else:
+            samples = np.arange(len(words))
+
+        found, counts = np.unique(pcs[samples], return_counts=True)
+        for pc, count in zip(found.tolist(), counts.tolist()):
+            self._pcs[pc] += count
+        self._sample_stacks(words, samples)
+
+    def _sample_stacks(self, words: np.ndarray, samples: np.ndarray):
+        """Counts the samples by call stack, and carries the stack over the block."""
+        pcs = words[:, RECORD_FIELDS.index("pc")]
+        instrs = words[:, RECORD_FIELDS.index("instr")]
+        opcode = instrs & 0x7F
+        rd = (instrs >> 7) & 0x1F
+        rs1 = (instrs >> 15) & 0x1F
+        jump = (opcode == Opcode.JAL) | (opcode == Opcode.JALR)
+        trap = (words[:, RECORD_FIELDS.index("info")] >> 8) & TRAP != 0
+        calls = (jump & np.isin(rd, _LINK_REGS)) | trap
+        returns = ((opcode == Opcode.JALR) & (rd == 0) & np.isin(rs1, _LINK_REGS)) | \
+            (instrs == _MRET) & ~trap
+        events = np.flatnonzero(calls | returns)
+
+        # The stack before each event, and after the last one.
+        stacks = []
+        stack = self._stack
+        for i in events.tolist():
+            stacks.append(tuple(stack))
+            if calls[i]:
+                stack.append(int(pcs[i]))
+            elif stack:
+                stack.pop()
+        stacks.append(tuple(stack))
+        # A sampled instruction runs with the stack from before its own event.
+        which = np.searchsorted(events, samples, side="left")
+        found, counts = np.unique(np.stack([which, pcs[samples]], axis=1), axis=0,
+                                  return_counts=True)
+        for (n, pc), count in zip(found.tolist(), counts.tolist()):
+            self._stacks[stacks[n], pc] += count
+
+    def _function(self, pc: int) -> str:
+        return self.symbols.name(pc) if self.symbols is not None else f"{pc:#010x}"
+
+    def histogram(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the sampled PCs, in increasing order, and their sample counts."""
+        self.flush()
+        pcs = np.array(sorted(self._pcs), dtype=np.uint64)
+        return pcs, np.array([self._pcs[pc] for pc in pcs.tolist()], dtype=np.int64)
+
+    def functions(self) -> Dict[str, int]:
+        """Returns the number of samples by function."""
+        pcs, counts = self.histogram()
+        out: Dict[str, int] = Counter()
+        if self.symbols is None:
+            for pc, count in zip(pcs.tolist(), counts.tolist()):
+                out[self._function(pc)] += count
+            return out
+        indexes = self.symbols.lookup(pcs)
+        for pc, i, count in zip(pcs.tolist(), indexes.tolist(), counts.tolist()):
+            out[self.symbols.names[i] if i >= 0 else f"{pc:#010x}"] += count
+        return out
+
+    def report(self, top_pcs: int = 10) -> str:
+        """Returns the flat profile by function, busiest first, and the busiest PCs."""
+        functions = self.functions()
+        total = max(sum(functions.values()), 1)
+        unit = f"every {self.period} machine cycles" if self.period else "every retired instruction"
+        lines = [f"PC samples: {sum(functions.values())} ({unit})",
+                 f"{'function':<40} {'samples':>10} {'share':>7}"]
+        for name, count in sorted(functions.items(), key=lambda item: (-item[1], item[0])):
+            lines.append(f"{name:<40} {count:>10} {100 * count / total:>6.1f}%")
+        if top_pcs:
+            pcs, counts = self.histogram()
+            lines.append(f"{'pc':<12} {'function':<27} {'samples':>10} {'share':>7}")
+            for i in np.argsort(-counts, kind="stable")[:top_pcs].tolist():
+                pc = int(pcs[i])
+                lines.append(f"{pc:#010x}   {self._function(pc):<27} {int(counts[i]):>10} "
+                             f"{100 * int(counts[i]) / total:>6.1f}%")
+        return "\n".join(lines)
+
+    def write_collapsed(self, path: str):
+        """Writes the samples by call stack in the collapsed format for flame graphs."""
+        self.flush()
+        lines: Dict[str, int] = Counter()
+        for (stack, pc), count in self._stacks.items():
+            frames = [self._function(site) for site in stack] + [self._function(pc)]
+            lines[";".join(frames)] += count
+        with open(path, "w", encoding="utf-8") as f:
+            for line, count in sorted(lines.items()):
+                f.write(f"{line} {count}\n")
@@ -0,0 +1,182 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module provides the main memory model used by the CPU simulators.
+"""
+import mmap
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+PAGE_SIZE = 4096
+_PAGE_WORDS = PAGE_SIZE // 4
+_PAGE_SHIFT = 12
+
+# The bits of a word written for each 4-bit byte lane mask.
+_LANES = tuple(sum(0xFF << (8 * i) for i in range(4) if mask & (1 << i))
+               for mask in range(16))
+
+
+def _new_page(data: bytes = bytes(PAGE_SIZE)) -> memoryview:
+    """Returns a writable page of words holding a copy of data."""
+    return memoryview(bytearray(data)).cast("I")
+
+
+class MainMemory:
+    """A model of the CPU's 32-bit main memory.
+
+    The CPU's memory bus is a 32-bit word bus: reads ignore the two least
+    significant bits of the address (memaddr can have bit 0 set after a JALR),
+    and writes carry a 4-bit byte lane mask. Memory that has never been
+    written reads as zero.
+
+    The address space is made of PAGE_SIZE pages, which are only allocated
+    when first written. Pages of a file loaded with load_file or map_pages are
+    mapped from the file read-only, and copied the first time they are
+    written, so large images load at once and only the touched pages take up
+    memory. Words are held in the host's byte order, so the host must be
+    little-endian like the CPU.
+
+    Pages can also be mapped to memory-mapped I/O with map_io. Accesses to
+    them go to the I/O handler, and they aren't included in pages.
+    """
+
+    def __init__(self):
+        # Page number to words. Pages mapped from files are read-only.
+        self._pages: Dict[int, memoryview] = {}
+        # Page number to I/O handler.
+        self._io: Dict[int, Any] = {}
+
+    def map_io(self, base: int, size: int, handler: Any):
+        """Maps pages to memory-mapped I/O.
+
+        Args:
+            base: The page-aligned base address of the first page.
+            size: The size in bytes, rounded up to whole pages.
+            handler: An object with read_word(addr) and write_word(addr, data, mask)
+                methods like MainMemory's, which serves accesses to the pages.
+        """
+        assert base % PAGE_SIZE == 0
+        for n in range(base >> _PAGE_SHIFT, (base + size + PAGE_SIZE - 1) >> _PAGE_SHIFT):
+            if n in self._pages:
+                raise ValueError(f"memory at {n << _PAGE_SHIFT:#010x} can't be mapped to I/O")
+            self._io[n] = handler
+
+    def _writable_page(self, n: int) -> memoryview:
+        """Returns page n, allocating it or copying it from its file if needed."""
+        if n in self._io:
+            raise ValueError(f"memory at {n << _PAGE_SHIFT:#010x} is mapped to I/O")
+        page = self._pages.get(n)
+        if page is None:
+            page = self._pages[n] = _new_page()
+        elif page.readonly:
+            page = self._pages[n] = _new_page(page)
+        return page
+
+    def read_word(self, addr: int) -> int:
+        """Reads the 32-bit word containing the given byte address."""
+        try:
+            return self._pages[addr >> _PAGE_SHIFT][(addr >> 2) & (_PAGE_WORDS - 1)]
+        except KeyError:
+            io = self._io.get(addr >> _PAGE_SHIFT)
+            return io.read_word(addr) if io is not None else 0
+
+    def write_word(self, addr: int, data: int, mask: int = 0b1111):
+        """Writes the byte lanes of a 32-bit word selected by mask.
+
+        Args:
+            addr: A byte address inside the word to write.
+            data: The 32-bit data, already shifted into its byte lanes.
+            mask: The byte lanes to write, bit 0 being the least significant byte.
+        """
+        page = self._pages.get(addr >> _PAGE_SHIFT)
+        if page is None or page.readonly:
+            io = self._io.get(addr >> _PAGE_SHIFT)
+            if io is not None:
+                io.write_word(addr, data, mask)
+                return
+            page = self._writable_page(addr >> _PAGE_SHIFT)
+        i = (addr >> 2) & (_PAGE_WORDS - 1)
+        if mask == 0b1111:
+            page[i] = data & 0xFFFFFFFF
+            return
+        lanes = _LANES[mask]
+        page[i] = (page[i] & ~lanes) | (data & lanes)
+
+    def pages(self) -> Iterator[Tuple[int, memoryview]]:
+        """Yields the (base address, words) pairs of every allocated page, in address order.
+
+        The words are a read-only view of the page, so copy them if they must not
+        change with later writes.
+        """
+        for n in sorted(self._pages):
+            yield n << _PAGE_SHIFT, self._pages[n].toreadonly()
+
+    def map_pages(self, path: str, offset: int, bases: Iterable[int]):
+        """Maps consecutive pages of a file into memory, copy-on-write.
+
+        Args:
+            path: The file to map.
+            offset: The offset in the file of the first page.
+            bases: The page-aligned base address of each page, in file order.
+        """
+        with open(path, "rb") as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        for i, base in enumerate(bases):
+            assert base % PAGE_SIZE == 0
+            start = offset + i * PAGE_SIZE
+            self._pages[base >> _PAGE_SHIFT] = data[start:start + PAGE_SIZE].cast("I")
+
+    def read_bytes(self, addr: int, size: int) -> bytes:
+        """Reads size bytes starting at the given byte address."""
+        out = bytearray(size)
+        i = 0
+        while i < size:
+            a = addr + i
+            start = a % PAGE_SIZE
+            n = min(size - i, PAGE_SIZE - start)
+            page = self._pages.get(a >> _PAGE_SHIFT)
+            if page is not None:
+                out[i:i + n] = page.cast("B")[start:start + n]
+            i += n
+        return bytes(out)
+
+    def write_bytes(self, addr: int, data: bytes):
+        """Writes a block of bytes starting at the given byte address.
+
+        Pages that the block leaves unchanged are neither allocated nor copied.
+        """
+        data = memoryview(data).cast("B")
+        i = 0
+        while i < len(data):
+            a = addr + i
+            start = a % PAGE_SIZE
+            n = min(len(data) - i, PAGE_SIZE - start)
+            chunk = data[i:i + n]
+            page = self._pages.get(a >> _PAGE_SHIFT)
+            if page is None:
+                if any(chunk):
+                    self._writable_page(a >> _PAGE_SHIFT).cast("B")[start:start + n] = chunk
+            elif page.cast("B")[start:start + n] != chunk:
+                self._writable_page(a >> _PAGE_SHIFT).cast("B")[start:start + n] = chunk
+            i += n
+
+    def load_image(self, data: bytes, base: int = 0):
+        """Loads a flat binary image into memory at base."""
+        self.write_bytes(base, data)
+
+    def load_file(self, path: str, base: int = 0):
+        """Loads a flat binary image file into memory at base.
+
+        If base is page-aligned, the whole pages of the file are mapped rather
+        than read.
+        """
+        with open(path, "rb") as f:
+            if base % PAGE_SIZE:
+                self.load_image(f.read(), base)
+                return
+            f.seek(0, 2)
+            whole = f.tell() - f.tell() % PAGE_SIZE
+            f.seek(whole)
+            tail = f.read()
+        if whole:
+            self.map_pages(path, 0, range(base, base + whole, PAGE_SIZE))
+        self.load_image(tail, base + whole)
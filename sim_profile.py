@@ -0,0 +1,157 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module profiles where the machine cycles of a run go.
+
+The microcode takes a different number of machine cycles for each kind of
+instruction. A Profiler counts the machine cycles each instruction took to
+retire, grouped by opcode and funct3, and the machine cycles of each trap
+entry, grouped by cause, and reports the CPI and a histogram of each group.
+Trap entries run from the TrapROM, so their share of the machine cycles is
+the time spent there.
+
+A Profiler goes in a simulator's trace attribute in place of a TraceWriter,
+so it works with every engine that writes traces. The machine cycles of an
+instruction are those since the previous instruction or trap entry
+completed. A trap entry caused by an exception includes the cycles the
+faulting instruction ran before raising it. Give a TraceWriter as then to
+write the trace as well.
+"""
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from consts import Opcode, SystemFunc, TrapCause
+from sim_trace import RECORD_FIELDS, TRAP, TraceSink, TraceWriter, block_words
+
+# Names of instructions by opcode and funct3. Instructions that share both
+# are counted together.
+_FUNCT3_NAMES = {
+    Opcode.LOAD: ("lb", "lh", "lw", None, "lbu", "lhu"),
+    Opcode.STORE: ("sb", "sh", "sw"),
+    Opcode.BRANCH: ("beq", "bne", None, None, "blt", "bge", "bltu", "bgeu"),
+    Opcode.OP_IMM: ("addi", "slli", "slti", "sltiu", "xori", "srli/srai", "ori", "andi"),
+    Opcode.OP: ("add/sub", "sll", "slt", "sltu", "xor", "srl/sra", "or", "and"),
+    Opcode.MISC_MEM: ("fence", "fence.i"),
+    Opcode.SYSTEM: (None, "csrrw", "csrrs", "csrrc", None, "csrrwi", "csrrsi", "csrrci"),
+}
+# Opcodes without a funct3.
+_OPCODE_NAMES = {
+    Opcode.LUI: "lui",
+    Opcode.AUIPC: "auipc",
+    Opcode.JAL: "jal",
+    Opcode.JALR: "jalr",
+}
+# The bit set in the keys of trap entries, above the 32-bit mcause.
+_TRAP_KEY = 1 << 32
+
+
+def _instr_keys(instrs: np.ndarray) -> np.ndarray:
+    """Returns the group keys of instructions.
+
+    The key is the instruction's opcode and funct3 bits, or just its opcode if
+    it has no funct3, or the whole instruction for privileged SYSTEM ones
+    like mret.
+    """
+    opcode = instrs & 0x7F
+    keys = instrs & 0x707F
+    keys = np.where(np.isin(opcode, list(_OPCODE_NAMES)), opcode, keys)
+    return np.where(keys == Opcode.SYSTEM, instrs, keys)
+
+
+def _key_name(key: int) -> str:
+    """Returns the name of a group key."""
+    if key & _TRAP_KEY:
+        cause = key & 0xFFFFFFFF
+        try:
+            return "trap " + TrapCause(cause).name
+        except ValueError:
+            return f"trap {cause:#010x}"
+    opcode = key & 0x7F
+    if opcode in _OPCODE_NAMES:
+        return _OPCODE_NAMES[opcode]
+    funct3 = (key >> 12) & 0x7
+    if opcode == Opcode.SYSTEM and funct3 == SystemFunc.PRIV:
+        return {0x30200073: "mret", 0x10500073: "wfi"}.get(key, f"system {key:#010x}")
+    names = _FUNCT3_NAMES.get(opcode, ())
+    if funct3 < len(names) and names[funct3] is not None:
+        return names[funct3]
+    return f"opcode {opcode:#04x} funct3 {funct3}"
+
+
+class Profiler(TraceSink):
+    """Counts the machine cycles of retired instructions and trap entries.
+
+    Attributes:
+        records: The fields of the records not yet counted, as for TraceSink.
+        block_records: The number of records counted at a time.
+        then: The TraceWriter to pass the records on to, if any.
+    """
+
+    def __init__(self, start_cycle: int = 0, then: Optional[TraceWriter] = None,
+                 block_records: int = 1 << 16):
+        """Sets up a profiler.
+
+        Args:
+            start_cycle: The machine cycle count of the simulator when the
+                profiler is attached.
+            then: The TraceWriter to pass the records on to, if any.
+            block_records: The number of records counted at a time.
+        """
+        super().__init__(block_records, then)
+        self._last_cycle = start_cycle
+        # The number of records by group key and machine cycles.
+        self._counts: Dict[Tuple[int, int], int] = Counter()
+
+    def _process(self, block: List[int]):
+        """Counts a block of records."""
+        words = block_words(block)
+        cycles = words[:, RECORD_FIELDS.index("cycle")]
+        deltas = np.diff(cycles, prepend=self._last_cycle)
+        self._last_cycle = int(cycles[-1])
+        trap = (words[:, RECORD_FIELDS.index("info")] >> 8) & TRAP != 0
+        # The addr field of a trap entry holds mcause.
+        keys = np.where(trap, words[:, RECORD_FIELDS.index("addr")] | _TRAP_KEY,
+                        _instr_keys(words[:, RECORD_FIELDS.index("instr")]))
+        pairs, counts = np.unique(np.stack([keys, deltas], axis=1), axis=0, return_counts=True)
+        for (key, delta), count in zip(pairs.tolist(), counts.tolist()):
+            self._counts[key, delta] += count
+
+    def histograms(self) -> Dict[str, Dict[int, int]]:
+        """Returns the number of retirements or trap entries by machine cycles, by group name.
+
+        Trap entry groups are named "trap " and the cause.
+        """
+        self.flush()
+        out: Dict[str, Dict[int, int]] = {}
+        for (key, delta), count in sorted(self._counts.items()):
+            hist = out.setdefault(_key_name(key), {})
+            hist[delta] = hist.get(delta, 0) + count
+        return out
+
+    def report(self) -> str:
+        """Returns a table of the groups, busiest first, and the totals."""
+        rows = []
+        instrs = instr_cycles = trap_cycles = 0
+        for name, hist in self.histograms().items():
+            count = sum(hist.values())
+            cycles = sum(delta * n for delta, n in hist.items())
+            rows.append((cycles, count, name, hist))
+            if name.startswith("trap "):
+                trap_cycles += cycles
+            else:
+                instrs += count
+                instr_cycles += cycles
+        total = max(instr_cycles + trap_cycles, 1)
+        lines = [f"{'group':<36} {'count':>10} {'cycles':>12} {'CPI':>6} {'share':>7}  histogram"]
+        for cycles, count, name, hist in sorted(rows, key=lambda row: (-row[0], row[2])):
+            histogram = " ".join(f"{delta}:{n}" for delta, n in sorted(hist.items()))
+            lines.append(f"{name:<36} {count:>10} {cycles:>12} {cycles / count:>6.2f} "
+                         f"{100 * cycles / total:>6.1f}%  {histogram}")
+        lines.append(f"instructions: {instrs}, machine cycles: {instr_cycles + trap_cycles} "
+                     f"(CPI {(instr_cycles + trap_cycles) / max(instrs, 1):.2f}, "
+                     f"{instr_cycles / max(instrs, 1):.2f} without trap entries)")
+        lines.append(f"trap entries (TrapROM): {trap_cycles} machine cycles, "
+                     f"{100 * trap_cycles / total:.1f}%")
+        return "\n".join(lines)
@@ -0,0 +1,367 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module writes and reads compact binary instruction traces.
+
+A simulator with a TraceWriter in its trace attribute adds a fixed-width
+record every time instr_complete is set: one for each retired instruction,
+and one for each trap entry. Records are gathered into blocks, and a
+background thread converts, optionally compresses, and writes each block,
+taking them from a bounded queue so that a slow disk holds the simulator back
+rather than filling memory.
+
+A record (TRACE_DTYPE, 32 bytes, little-endian) has:
+
+    cycle    The machine cycle count when the instruction completed.
+    pc       The address of the instruction, or mepc for a trap entry.
+    instr    The instruction, or 0 for a trap entry.
+    rd       The destination register, if RD_WRITE is set.
+    flags    RD_WRITE, MEM_READ, MEM_WRITE, CSR and TRAP.
+    mask     The byte lanes of a memory access.
+    rd_data  The value written to rd.
+    addr     The byte address of a memory access, the CSR number of a CSR
+             access, or mcause for a trap entry.
+    data     The 32-bit bus word read or written by a memory access, the
+             CSR's value when the CSR access completed, or mtval for a
+             trap entry.
+
+The file is a header followed by blocks. Each block is a _BLOCK header
+and the block's records, compressed as given in the file header.
+"""
+import queue
+import struct
+import threading
+import zlib
+from array import array
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from consts import CSRAddr, Opcode
+
+MAGIC = b"RVTRACE\0"
+VERSION = 1
+
+# The flags.
+RD_WRITE = 1
+MEM_READ = 2
+MEM_WRITE = 4
+CSR = 8
+TRAP = 16
+
+TRACE_DTYPE = np.dtype([
+    ("cycle", "<u8"),
+    ("pc", "<u4"),
+    ("instr", "<u4"),
+    ("rd", "u1"),
+    ("flags", "u1"),
+    ("mask", "u1"),
+    ("reserved", "u1"),
+    ("rd_data", "<u4"),
+    ("addr", "<u4"),
+    ("data", "<u4"),
+])
+
+# The fields of the records the simulators make. rd, flags and mask are
+# packed into info, rd in bits 0-7, flags in 8-15 and mask in 16-23.
+RECORD_FIELDS = ("cycle", "pc", "instr", "info", "rd_data", "addr", "data")
+_RECORD_DTYPE = np.dtype([(name, "<u8" if name == "cycle" else "<u4")
+                          for name in RECORD_FIELDS])
+assert _RECORD_DTYPE.itemsize == TRACE_DTYPE.itemsize
+
+# magic, version, compression, record size.
+_HEADER = struct.Struct("<8sIII")
+# record count, stored size.
+_BLOCK = struct.Struct("<II")
+
+COMPRESSIONS = ("none", "zlib", "zstd", "lz4")
+
+# The opcodes of the instructions that write rd.
+_WRITES_RD = frozenset([Opcode.OP, Opcode.OP_IMM, Opcode.LOAD, Opcode.LUI, Opcode.AUIPC,
+                        Opcode.JAL, Opcode.JALR])
+
+# The CPUState fields holding the CSRs the CPU implements.
+CSR_FIELDS = {
+    CSRAddr.MSTATUS: "mstatus",
+    CSRAddr.MIE: "mie",
+    CSRAddr.MIP: "mip",
+    CSRAddr.MTVEC: "mtvec",
+    CSRAddr.MEPC: "mepc",
+    CSRAddr.MCAUSE: "mcause",
+    CSRAddr.MTVAL: "mtval",
+}
+
+
+def _codec(compression: str) -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    """Returns the compress and decompress functions for a compression.
+
+    zstd and lz4 need the zstandard and lz4 packages.
+    """
+    # pylint: disable=C0415
+    if compression == "none":
+        return bytes, bytes
+    if compression == "zlib":
+        return lambda data: zlib.compress(data, 1), zlib.decompress
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=1).compress, zstandard.ZstdDecompressor().decompress
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.compress, lz4.frame.decompress
+    raise ValueError(f"unknown trace compression {compression}")
+
+
+def _is_csr_instr(instr: int) -> bool:
+    return (instr & 0x7F) == Opcode.SYSTEM and (instr >> 12) & 0x7 != 0
+
+
+def rd_info(instr: int) -> int:
+    """Returns the rd and flags parts of a record's info for an instruction's rd writeback."""
+    rd = (instr >> 7) & 0x1F
+    if rd == 0:
+        return 0
+    if (instr & 0x7F) in _WRITES_RD or _is_csr_instr(instr):
+        return rd | RD_WRITE << 8
+    return 0
+
+
+def instr_record(cycle: int, pc: int, instr: int, rs1_data: int, rs2_data: int,
+                 rd_data: int, read_csr: Callable[[int], int],
+                 read_word: Callable[[int], int]) -> Tuple[int, ...]:
+    """Returns the record of a retired instruction.
+
+    This is for simulators that don't decode instructions themselves.
+
+    Args:
+        cycle: The machine cycle count when the instruction completed.
+        pc: The address of the instruction.
+        instr: The instruction.
+        rs1_data: The value of rs1 when the instruction started.
+        rs2_data: The value of rs2 when the instruction started.
+        rd_data: The value of rd when the instruction completed.
+        read_csr: Returns the value of a CSR when the instruction completed.
+        read_word: Reads a word of main memory.
+    """
+    info = rd_info(instr)
+    if not info:
+        rd_data = 0
+    addr = data = 0
+    opcode = instr & 0x7F
+    funct3 = (instr >> 12) & 0x7
+    if opcode == Opcode.LOAD:
+        addr = (rs1_data + ((instr >> 20) ^ 0x800) - 0x800) & 0xFFFFFFFF
+        data = read_word(addr)
+        width = funct3 & 0x3
+        info |= MEM_READ << 8 | ((1 << (1 << width)) - 1) << (addr & 3) << 16
+    elif opcode == Opcode.STORE:
+        imm = ((instr >> 25) << 5) | ((instr >> 7) & 0x1F)
+        addr = (rs1_data + (imm ^ 0x800) - 0x800) & 0xFFFFFFFF
+        offset = addr & 3
+        data = (rs2_data << (8 * offset)) & 0xFFFFFFFF
+        info |= MEM_WRITE << 8 | ((1 << (1 << funct3)) - 1) << offset << 16
+    elif _is_csr_instr(instr):
+        addr = instr >> 20
+        data = read_csr(addr)
+        info |= CSR << 8
+    return (cycle, pc, instr, info, rd_data, addr, data)
+
+
+def trap_record(cycle: int, mepc: int, mcause: int, mtval: int) -> Tuple[int, ...]:
+    """Returns the record of a trap entry.
+
+    Args:
+        cycle: The machine cycle count when the trap entry completed.
+        mepc: mepc after the trap entry.
+        mcause: mcause after the trap entry.
+        mtval: mtval after the trap entry.
+    """
+    return (cycle, mepc, 0, TRAP << 8, 0, mcause, mtval)
+
+
+def records_array(records: List[int]) -> np.ndarray:
+    """Returns an array of TRACE_DTYPE holding records in the flat form simulators make.
+
+    The fields the flags say are unused are zeroed, as in trace files.
+    """
+    words = np.frombuffer(array("Q", records), dtype=np.uint64)
+    words = words.reshape(-1, len(RECORD_FIELDS))
+    out = np.empty(len(words), dtype=_RECORD_DTYPE)
+    for i, name in enumerate(RECORD_FIELDS):
+        out[name] = words[:, i]
+    flags = out["info"] >> 8
+    out["rd_data"][flags & RD_WRITE == 0] = 0
+    access = flags & (MEM_READ | MEM_WRITE | CSR | TRAP) == 0
+    out["addr"][access] = 0
+    out["data"][access] = 0
+    # info is rd, flags, mask and reserved, little-endian.
+    return out.view(TRACE_DTYPE)
+
+
+def block_words(block: List[int]) -> np.ndarray:
+    """Returns a block of records in the flat form simulators make as a 2-D array of int64,
+    one row per record and one column per RECORD_FIELDS."""
+    words = np.frombuffer(array("Q", block), dtype=np.uint64)
+    return words.reshape(-1, len(RECORD_FIELDS)).astype(np.int64)
+
+
+class TraceSink:
+    """Takes the trace records of a simulator, and handles them a block at a time.
+
+    Simulators add records with add, or extend records with them and call
+    flush when block_records have been added. Call close when done, or use
+    the sink as a context manager. Subclasses handle each block in
+    _process, and each block is then passed on to then, if there is one.
+
+    Attributes:
+        records: The fields of the records not yet handled, one after the
+            other. Keeping them in a flat list of ints rather than a list of
+            tuples keeps the garbage collector out of the way. flush hands
+            the list itself on and starts a new one, so fetch records again
+            after calling it.
+        block_records: The number of records in a block.
+        then: The TraceSink to pass the records on to, if any.
+    """
+
+    def __init__(self, block_records: int = 1 << 16, then: Optional["TraceSink"] = None):
+        self.records: List[int] = []
+        self.block_records = then.block_records if then is not None else block_records
+        self.then = then
+
+    def add(self, record: Tuple[int, ...]):
+        """Adds a record, handling the block if it is full."""
+        self.records.extend(record)
+        if len(self.records) >= self.block_records * len(RECORD_FIELDS):
+            self.flush()
+
+    def flush(self):
+        """Handles the records added so far, and passes them on."""
+        block = self.records
+        if not block:
+            return
+        self.records = []
+        self._process(block)
+        if self.then is not None:
+            self.then.records.extend(block)
+            self.then.flush()
+
+    def _process(self, block: List[int]):
+        """Handles a block of records, in the flat form of records."""
+        raise NotImplementedError
+
+    def close(self):
+        """Handles the remaining records, and closes what they are passed on to."""
+        self.flush()
+        if self.then is not None:
+            self.then.close()
+
+    def __enter__(self) -> "TraceSink":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TraceWriter(TraceSink):
+    """Writes trace records to a file from a background thread.
+
+    This is the TraceSink that simulators write traces with.
+
+    A record is a tuple of the RECORD_FIELDS. rd_data is ignored unless the
+    flags have RD_WRITE, and addr and data are ignored unless they have
+    MEM_READ, MEM_WRITE, CSR or TRAP, so that the ISS can leave them stale.
+
+    Attributes:
+        records: The fields of the records not yet handed to the background
+            thread, as for TraceSink.
+        block_records: The number of records in a block.
+    """
+
+    def __init__(self, path: str, compression: str = "none",
+                 block_records: int = 1 << 16, queue_blocks: int = 8):
+        """Opens a trace file for writing.
+
+        Args:
+            path: The file to write.
+            compression: One of COMPRESSIONS.
+            block_records: The number of records in a block.
+            queue_blocks: The number of blocks that can wait for the background
+                thread before flush blocks.
+        """
+        super().__init__(block_records)
+        self._compress = _codec(compression)[0]
+        self._file: BinaryIO = open(path, "wb")  # pylint: disable=R1732
+        self._file.write(_HEADER.pack(MAGIC, VERSION, COMPRESSIONS.index(compression),
+                                      TRACE_DTYPE.itemsize))
+        self._queue: "queue.Queue[Optional[List[int]]]" = queue.Queue(queue_blocks)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="trace writer", daemon=True)
+        self._thread.start()
+
+    def _process(self, block: List[int]):
+        """Hands a block to the background thread."""
+        if self._error is not None:
+            raise RuntimeError("the trace writer failed") from self._error
+        self._queue.put(block)
+
+    def close(self):
+        """Writes the remaining records, and waits for the background thread to finish."""
+        if self._file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+        if self._error is not None:
+            raise RuntimeError("the trace writer failed") from self._error
+
+    def _run(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                out = records_array(block)
+                data = self._compress(out.tobytes())
+                self._file.write(_BLOCK.pack(len(out), len(data)))
+                self._file.write(data)
+            except BaseException as e:  # pylint: disable=W0703
+                self._error = e
+
+
+def iter_trace(path: str) -> Iterator[np.ndarray]:
+    """Yields the blocks of a trace file, as arrays of TRACE_DTYPE."""
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a trace")
+        _, version, compression, record_size = _HEADER.unpack(header)
+        if version != VERSION or record_size != TRACE_DTYPE.itemsize:
+            raise ValueError(f"{path} is a version {version} trace, "
+                             f"but only version {VERSION} is supported")
+        decompress = _codec(COMPRESSIONS[compression])[1]
+        while True:
+            block = f.read(_BLOCK.size)
+            if not block:
+                return
+            if len(block) < _BLOCK.size:
+                raise ValueError(f"{path} is truncated")
+            count, size = _BLOCK.unpack(block)
+            data = f.read(size)
+            if len(data) < size:
+                raise ValueError(f"{path} is truncated")
+            records = np.frombuffer(decompress(data), dtype=TRACE_DTYPE)
+            if len(records) != count:
+                raise ValueError(f"{path} has a corrupt block")
+            yield records
+
+
+def read_trace(path: str) -> np.ndarray:
+    """Reads a whole trace file into an array of TRACE_DTYPE."""
+    blocks = list(iter_trace(path))
+    if not blocks:
+        return np.zeros(0, dtype=TRACE_DTYPE)
+    return np.concatenate(blocks)
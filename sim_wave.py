@@ -0,0 +1,214 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""
+This module captures waveforms of a few signals around a trigger.
+
+Writing every signal of the CPU for a whole run makes VCD files gigabytes
+long, and the simulation spends its time writing them. A WaveCapture
+instead samples a chosen subset of signals into an in-memory ring buffer,
+and only writes a VCD file holding the window around a trigger: the depth
+samples leading up to it and post samples after it.
+
+A trigger is given as a string:
+
+    name        The signal rises: it was zero and is now nonzero.
+    name=value  The signal becomes equal to value, e.g. pc=0x100.
+
+Samples are taken by the simulation harness with sample, once per tick;
+CPUSim takes one at the end of each sync clock period. For a testbench
+without a harness, add process(period) to the simulator. GTKWave can
+convert the VCD files to FST with vcd2fst.
+"""
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+from nmigen import Signal
+from nmigen.sim import Delay, Passive
+from vcd import VCDWriter
+
+
+class Trigger:
+    """A condition on a captured signal.
+
+    Attributes:
+        name: The name of the signal.
+        value: The value that fires the trigger, or None to fire when the
+            signal rises.
+    """
+
+    def __init__(self, name: str, value: Optional[int] = None):
+        self.name = name
+        self.value = value
+
+    @classmethod
+    def parse(cls, spec: str) -> "Trigger":
+        """Parses a trigger given as name or name=value."""
+        name, sep, value = spec.partition("=")
+        if not name or (sep and not value):
+            raise ValueError(f"bad trigger {spec!r}, expected name or name=value")
+        return cls(name, int(value, 0) if sep else None)
+
+    def fired(self, prev: int, cur: int) -> bool:
+        """Returns whether the trigger fires when the signal goes from prev to cur."""
+        if self.value is None:
+            return prev == 0 and cur != 0
+        return cur == self.value and prev != self.value
+
+    def __str__(self):
+        return self.name if self.value is None else f"{self.name}={self.value:#x}"
+
+
+class WaveCapture:
+    """Samples signals into a ring buffer, and writes VCD windows around triggers.
+
+    A trigger fires at most once per window. After max_windows windows
+    have been written, sampling stops. If no trigger is given, close
+    writes the last depth samples, which shows how a run ended.
+
+    Attributes:
+        signals: The captured signals, by name.
+        triggers: The triggers.
+        depth: The number of samples kept before a trigger.
+        post: The number of samples taken after a trigger.
+        timescale: The duration of a tick, as a VCD timescale.
+        written: The paths of the VCD files written so far.
+    """
+
+    def __init__(self, signals: Dict[str, Signal], path: str,
+                 triggers: Sequence[Trigger] = (), depth: int = 1024,
+                 post: Optional[int] = None, max_windows: int = 1,
+                 timescale: str = "1 us"):
+        """Sets up a capture.
+
+        Args:
+            signals: The signals to capture, by name. Dots in the names make
+                VCD scopes.
+            path: The VCD file for the first window. Later windows go to the
+                same name with -1, -2 and so on before the extension.
+            triggers: The triggers. Their signals must be in signals.
+            depth: The number of samples kept before a trigger.
+            post: The number of samples taken after a trigger. Defaults to
+                depth // 4.
+            max_windows: The number of windows to write.
+            timescale: The duration of a tick, as a VCD timescale.
+        """
+        for trigger in triggers:
+            if trigger.name not in signals:
+                raise ValueError(f"trigger {trigger} is on {trigger.name}, "
+                                 "which isn't captured")
+        self.signals = dict(signals)
+        self.triggers = list(triggers)
+        self.depth = depth
+        self.post = depth // 4 if post is None else post
+        self.timescale = timescale
+        self.written: List[str] = []
+        self._path = path
+        self._max_windows = max_windows
+        self._sigs = list(self.signals.values())
+        names = list(self.signals)
+        self._trigger_indexes = [names.index(trigger.name) for trigger in self.triggers]
+        self._ring: Deque[Tuple[int, Tuple[int, ...]]] = deque(maxlen=depth + self.post)
+        # The samples after the trigger still to be taken, and the trigger,
+        # while a window is being finished.
+        self._post_left = 0
+        self._fired: Optional[Tuple[int, Trigger]] = None
+
+    @property
+    def done(self) -> bool:
+        """Whether every window has been written, so that sampling can stop."""
+        return len(self.written) >= self._max_windows
+
+    def sample(self, tick: int):
+        """Samples the signals. This is a generator for a simulator process.
+
+        Args:
+            tick: The time of the sample. Ticks must increase from sample to sample.
+        """
+        if self.done:
+            return
+        values = []
+        for sig in self._sigs:
+            values.append((yield sig))
+        self.add(tick, tuple(values))
+
+    def add(self, tick: int, values: Tuple[int, ...]):
+        """Adds a sample of the signals, in the order of signals."""
+        ring = self._ring
+        if self._fired is not None:
+            ring.append((tick, values))
+            self._post_left -= 1
+            if self._post_left <= 0:
+                self._write_window()
+            return
+        if ring:
+            prev = ring[-1][1]
+            for trigger, i in zip(self.triggers, self._trigger_indexes):
+                if trigger.fired(prev[i], values[i]):
+                    self._fired = (tick, trigger)
+                    self._post_left = self.post
+                    break
+        # Only depth samples are kept before a trigger.
+        if self._fired is None and len(ring) == self.depth:
+            ring.popleft()
+        ring.append((tick, values))
+        if self._fired is not None and self._post_left <= 0:
+            self._write_window()
+
+    def process(self, period: float):
+        """Returns a passive simulator process that samples every period seconds."""
+        def process():
+            yield Passive()
+            tick = 0
+            while not self.done:
+                yield from self.sample(tick)
+                yield Delay(period)
+                tick += 1
+        return process
+
+    def close(self):
+        """Writes the window being finished, or the last samples if there are no triggers."""
+        if self.done:
+            return
+        if self._fired is not None or (not self.triggers and self._ring):
+            self._write_window()
+
+    def __enter__(self) -> "WaveCapture":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _window_path(self) -> str:
+        n = len(self.written)
+        if n == 0:
+            return self._path
+        root, ext = os.path.splitext(self._path)
+        return f"{root}-{n}{ext}"
+
+    def _write_window(self):
+        path = self._window_path()
+        ring = self._ring
+        comment = "no trigger"
+        if self._fired is not None:
+            tick, trigger = self._fired
+            comment = f"trigger {trigger} at tick {tick}"
+        with open(path, "w", encoding="utf-8") as f:
+            vcd = VCDWriter(f, timescale=self.timescale, comment=comment,
+                            init_timestamp=ring[0][0])
+            variables = []
+            for name, sig in self.signals.items():
+                scope, _, var = name.rpartition(".")
+                variables.append(vcd.register_var(scope or "top", var, "wire", size=len(sig)))
+            prev: Optional[Tuple[int, ...]] = None
+            for tick, values in ring:
+                for i, value in enumerate(values):
+                    if prev is None or prev[i] != value:
+                        vcd.change(variables[i], tick, value)
+                prev = values
+            # The window ends one tick after its last sample.
+            vcd.close(ring[-1][0] + 1)
+        self.written.append(path)
+        ring.clear()
+        self._fired = None
+        self._post_left = 0
@@ -0,0 +1,43 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""Tests that compliance.py runs tests on the engines."""
+import pytest
+
+pytest.importorskip("nmigen")
+pytest.importorskip("numpy")
+
+# pylint: disable=C0413
+import compliance
+from rom_coverage import RomCoverage
+
+TOHOST = 0x100
+
+# Passes by writing 1 to tohost.
+PROGRAM = [
+    0x00100093,  # addi x1, x0, 1
+    0x10102023,  # sw   x1, 0x100(x0)
+    0x0000006F,  # jal  x0, 0
+]
+
+
+@pytest.fixture(name="image")
+def fixture_image(tmp_path):
+    path = tmp_path / "simple.bin"
+    path.write_bytes(b"".join(word.to_bytes(4, "little") for word in PROGRAM))
+    return str(path)
+
+
+@pytest.mark.parametrize("engine", ["iss", "microcode"])
+def test_flat_image_passes(image, engine, monkeypatch):
+    monkeypatch.setattr(compliance, "_worker", None)
+    [result] = compliance.run_tests([image], engine=engine, jobs=1, tohost=TOHOST)
+    assert result["status"] == "pass", result.get("message")
+
+
+def test_coverage_collected(image, monkeypatch):
+    monkeypatch.setattr(compliance, "_worker", None)
+    coverage = RomCoverage()
+    [result] = compliance.run_tests([image], engine="microcode", jobs=1, tohost=TOHOST,
+                                    coverage=coverage)
+    assert result["status"] == "pass", result.get("message")
+    assert len(coverage.hit("sequencer_rom")) > 0
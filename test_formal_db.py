@@ -0,0 +1,65 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""Tests that formal_db.py only flags runs against comparable ones."""
+import sqlite3
+
+import pytest
+
+from formal_db import TimedRun, TimingDB
+
+
+@pytest.fixture(name="db")
+def fixture_db(tmp_path):
+    db = TimingDB(str(tmp_path / "timing.db"))
+    yield db
+    db.close()
+
+
+def add(db: TimingDB, seconds: float, engine: str = "smtbmc z3", depth: int = 20,
+        portfolio: bool = False):
+    db.add(TimedRun("2026-01-01T00:00:00Z", "op-prove", "op", "prove", engine, depth, "PASS",
+                    seconds, None, None, None, portfolio))
+
+
+def test_slower_run_flagged(db):
+    for _ in range(3):
+        add(db, 10.0)
+    add(db, 20.0)
+    [result] = db.regressions(25.0, 5)
+    assert result.flagged
+    assert result.baseline == 10.0
+
+
+def test_portfolio_runs_not_baseline(db):
+    for _ in range(3):
+        add(db, 10.0)
+    for _ in range(3):
+        add(db, 30.0, portfolio=True)
+    add(db, 11.0)
+    [result] = db.regressions(25.0, 5)
+    assert result.runs == 3
+    assert result.baseline == 10.0
+    assert not result.flagged
+    assert not db.runs("op-prove", 1)[0].portfolio
+
+
+def test_other_depth_not_baseline(db):
+    for _ in range(3):
+        add(db, 10.0, depth=20)
+    add(db, 30.0, depth=30)
+    assert db.regressions(25.0, 5) == []
+
+
+def test_old_database_migrated(tmp_path):
+    path = str(tmp_path / "timing.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE runs (id INTEGER PRIMARY KEY, started TEXT NOT NULL, "
+                 "name TEXT NOT NULL, mode TEXT NOT NULL, task TEXT NOT NULL, engine TEXT, "
+                 "depth INTEGER, status TEXT NOT NULL, seconds REAL NOT NULL, peak_kb INTEGER, "
+                 "source TEXT, commit_id TEXT)")
+    conn.commit()
+    conn.close()
+    db = TimingDB(path)
+    add(db, 10.0, portfolio=True)
+    assert db.runs("op-prove")[0].portfolio
+    db.close()
@@ -0,0 +1,94 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""Tests that the cone fingerprint of formal_deps.py changes when what's proved does."""
+import os
+
+import pytest
+
+from formal_deps import Cone, Dependencies, parse_rtlil
+
+# A register driving an assert, like a memory cell of async_memory.py with ext_init.
+DESIGN = """\
+attribute \\top 1
+attribute \\src "async_memory.py:30"
+module \\top
+  attribute \\src "async_memory.py:55"
+  attribute \\uninitialized ""
+  attribute \\init 8'00000000
+  wire width 8 \\mem
+  attribute \\src "async_memory.py:60"
+  wire width 1 \\ok
+  attribute \\src "async_memory.py:61"
+  wire width 1 \\en
+  attribute \\src "async_memory.py:60"
+  cell $eq $eq$1
+    parameter \\A_SIGNED 0
+    parameter \\A_WIDTH 8
+    parameter \\B_SIGNED 0
+    parameter \\B_WIDTH 8
+    parameter \\Y_WIDTH 1
+    connect \\A \\mem
+    connect \\B 8'00000000
+    connect \\Y \\ok
+  end
+  attribute \\src "async_memory.py:61"
+  cell $assert $assert$2
+    connect \\A \\ok
+    connect \\EN \\en
+  end
+  connect \\en 1'1
+end
+"""
+
+
+def fingerprint(text: str) -> str:
+    return Cone(parse_rtlil(text)).fingerprint()
+
+
+def test_src_attributes_ignored():
+    moved = DESIGN.replace("async_memory.py:6", "async_memory.py:9")
+    assert fingerprint(moved) == fingerprint(DESIGN)
+
+
+@pytest.mark.parametrize("attribute", [
+    "  attribute \\uninitialized \"\"\n",
+    "  attribute \\init 8'00000000\n",
+])
+def test_removed_attribute_changes_fingerprint(attribute):
+    changed = DESIGN.replace(attribute, "")
+    assert fingerprint(changed) != fingerprint(DESIGN)
+
+
+def test_changed_init_changes_fingerprint():
+    changed = DESIGN.replace("\\init 8'00000000", "\\init 8'00000001")
+    assert fingerprint(changed) != fingerprint(DESIGN)
+
+
+@pytest.mark.parametrize("edit", [
+    ("async_memory.py:6", "async_memory.py:9"),
+    ("  attribute \\uninitialized \"\"\n", ""),
+    ("\\init 8'00000000", "\\init 8'00000001"),
+])
+def test_agrees_with_rtlil_digest(edit):
+    util = pytest.importorskip("util")
+    changed = DESIGN.replace(*edit)
+    assert (fingerprint(changed) == fingerprint(DESIGN)) == \
+        (util.rtlil_digest(changed) == util.rtlil_digest(DESIGN))
+
+
+def test_changed_attribute_not_reused(tmp_path):
+    formal_jobs = pytest.importorskip("formal_jobs")
+    (tmp_path / "top.sby").write_text("[tasks]\nprove\n")
+    rtlil = tmp_path / "top.il"
+    rtlil.write_text(DESIGN)
+    job = formal_jobs.Job("top-prove", "top.sby", "prove", str(tmp_path), str(rtlil),
+                          str(tmp_path / "top_prove"))
+    results = formal_jobs.ProofResults(os.path.join(tmp_path, "results.json"))
+    job.deps = results.dependencies(job)
+    job.status = "PASS"
+    results.record(job)
+    assert results.reusable(job)
+
+    rtlil.write_text(DESIGN.replace("  attribute \\uninitialized \"\"\n", ""))
+    job.deps = Dependencies.of_file(str(rtlil))
+    assert not results.reusable(job)
@@ -0,0 +1,49 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""Tests that the engines count the same microcode coverage addresses."""
+import pytest
+
+pytest.importorskip("nmigen")
+np = pytest.importorskip("numpy")
+
+# pylint: disable=C0413
+from batch_sim import decode_instrs
+from cpu_sim import CPUSim
+from microcode_sim import MicrocodeSim, decode_instr
+from rom_coverage import ROM_NAMES, RomCoverage
+from sim_memory import MainMemory
+
+# OP instructions, whose rs1 field is the imm0 address bit with the chips,
+# between the OP_IMMs setting up their operands, then a self loop.
+PROGRAM = [
+    0x00500093,  # addi x1, x0, 5
+    0x00300113,  # addi x2, x0, 3
+    0x002081B3,  # add  x3, x1, x2
+    0x40208233,  # sub  x4, x1, x2
+    0x001132B3,  # sltu x5, x2, x1
+    0x0020C333,  # xor  x6, x1, x2
+    0x001003B3,  # add  x7, x0, x1
+    0x0000006F,  # jal  x0, 0
+]
+
+
+def run_coverage(engine) -> RomCoverage:
+    memory = MainMemory()
+    memory.load_image(b"".join(word.to_bytes(4, "little") for word in PROGRAM), 0)
+    sim = engine(memory)
+    sim.coverage = RomCoverage()
+    sim.run(max_cycles=200)
+    return sim.coverage
+
+
+def test_pysim_and_microcode_bitmaps_identical():
+    pysim = run_coverage(CPUSim)
+    microcode = run_coverage(MicrocodeSim)
+    for name in ROM_NAMES:
+        assert pysim.hit(name).tolist() == microcode.hit(name).tolist(), name
+
+
+def test_batch_decode_matches_microcode():
+    instrs = PROGRAM + [0x0000000F, 0x0000100B]  # fence, and a custom opcode
+    seq_addrs = decode_instrs(np.array(instrs, dtype=np.uint64))[-1]
+    assert seq_addrs.tolist() == [decode_instr(instr)[-1] for instr in instrs]
@@ -0,0 +1,28 @@
+# Disable pylint's "your name is too short" warning.
+# pylint: disable=C0103
+"""Tests the keys RTLIL is cached under."""
+import pytest
+
+rtlil_cache = pytest.importorskip("rtlil_cache")
+
+
+def write_sources(directory):
+    directory.mkdir()
+    (directory / "design.py").write_text("import helper\n")
+    (directory / "helper.py").write_text("X = 1\n")
+    return str(directory / "design.py")
+
+
+def test_key_follows_sources(tmp_path):
+    path = write_sources(tmp_path / "a")
+    key = rtlil_cache.cache_key(path, ["gen"])
+    assert rtlil_cache.cache_key(path, ["gen"]) == key
+    assert rtlil_cache.cache_key(path, ["gen", "op"]) != key
+    (tmp_path / "a" / "helper.py").write_text("X = 2\n")
+    assert rtlil_cache.cache_key(path, ["gen"]) != key
+
+
+def test_moved_checkout_misses(tmp_path):
+    first = write_sources(tmp_path / "a")
+    second = write_sources(tmp_path / "b")
+    assert rtlil_cache.cache_key(first, ["gen"]) != rtlil_cache.cache_key(second, ["gen"])
@@ -39,13 +39,16 @@ class TransparentLatch(Elaboratable):
         self.le = Signal()
         self.n_oe = Signal()
 
+        # The latched value. Simulators read and write it to checkpoint the latch.
+        self._latched = Signal(size, reset=0, reset_less=True, name="internal_reg")
+
         self.size = size
 
     def elaborate(self, _: Platform) -> Module:
         """Implements the logic of a transparent latch."""
         m = Module()
 
-        internal_reg = Signal(self.size, reset=0, reset_less=True)
+        internal_reg = self._latched
 
         # Local clock domain so we can clock data into the
         # internal memory on the negative edge of le.
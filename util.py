@@ -3,11 +3,16 @@
 """
 This module provides various global utilities.
 """
+import hashlib
+import os
 import sys
+from typing import List, Sequence
 
 from nmigen.back import rtlil
 from nmigen.hdl import Fragment
 
+import rtlil_cache
+
 if sys.version_info < (3, 8):
     print("Python 3.8 or above is required")
     sys.exit(1)
@@ -36,7 +41,7 @@ def main(cls, filename="toplevel.il"):
         file you wrote to.
     python <file.py> gen will run YourClass.formal and output in RTLIL format
         to toplevel.il. You can then formally verify using
-        sby -f <file.sby>.
+        sby -f <file.sby>. The RTLIL is cached across runs, see rtlil_cache.py.
     """
 
     if len(sys.argv) < 2 or (sys.argv[1] != "sim" and sys.argv[1] != "gen"):
@@ -46,8 +51,92 @@ def main(cls, filename="toplevel.il"):
     if sys.argv[1] == "sim":
         cls.sim()
     else:
-        design, ports = cls.formal()
+        generate(cls, filename, sys.argv[1:])
+
+
+def generate(cls, filename: str, args: Sequence[str], **kwargs) -> bool:
+    """Writes YourClass.formal in RTLIL format to a file, unless it's cached.
+
+    Two files for make are written next to it: a depfile, see write_depfile,
+    and the file with a .sha256 extension, holding a hash of the RTLIL
+    without its src attributes. The hash file is only written when that
+    changed, so that what depends on it isn't redone when a source changed
+    but the design didn't, even if lines moved.
+
+    Args:
+        cls: The class whose formal method makes the design.
+        filename: The RTLIL file to write.
+        args: The command line arguments the design depends on, like a
+            mode, for the cache key.
+        kwargs: Passed on to cls.formal.
+
+    Returns:
+        Whether the RTLIL was generated, rather than taken from the cache.
+    """
+    path = sys.modules[cls.__module__].__file__
+    name = key = output = None
+    if rtlil_cache.enabled():
+        name = rtlil_cache.cache_name(path, filename)
+        key = rtlil_cache.cache_key(path, list(args) + [filename])
+        output = rtlil_cache.fetch(name, key)
+    generated = output is None
+    if generated:
+        design, ports = cls.formal(**kwargs)
         fragment = Fragment.get(design, None)
         output = rtlil.convert(fragment, ports=ports)
-        with open(filename, "w") as f:
-            f.write(output)
+        if key is not None:
+            rtlil_cache.store(name, key, output)
+    if not write_if_changed(filename, output):
+        os.utime(filename)
+    write_if_changed(f"{filename}.sha256", rtlil_digest(output) + "\n")
+    write_depfile(filename, path)
+    return generated
+
+
+def rtlil_digest(output: str) -> str:
+    """Returns a hash of RTLIL without its src attributes, which only say where things came from."""
+    h = hashlib.sha256()
+    for line in output.splitlines(keepends=True):
+        if not line.lstrip().startswith("attribute \\src "):
+            h.update(line.encode())
+    return h.hexdigest()
+
+
+def imported_sources(path: str) -> List[str]:
+    """Returns the sources of the imported modules in the directory of a source file."""
+    src_dir = os.path.dirname(os.path.abspath(path))
+    sources = set()
+    for module in list(sys.modules.values()):
+        source = getattr(module, "__file__", None)
+        if source and source.endswith(".py") and \
+                os.path.dirname(os.path.abspath(source)) == src_dir:
+            sources.add(os.path.abspath(source))
+    return sorted(sources)
+
+
+def write_depfile(filename: str, path: str):
+    """Writes a makefile saying an output file depends on the modules imported to make it.
+
+    The depfile is the output file with a .d extension, listing the sources
+    imported from the directory of the source file that made the output,
+    relative to the current directory like the output file.
+    Each source also gets a rule of its own, so make doesn't stop when one
+    is deleted.
+    """
+    sources = [os.path.relpath(source) for source in imported_sources(path)]
+    lines = [f"{filename}: {' '.join(sources)}", ""]
+    lines.extend(f"{source}:" for source in sources)
+    write_if_changed(os.path.splitext(filename)[0] + ".d", "\n".join(lines) + "\n")
+
+
+def write_if_changed(filename: str, text: str) -> bool:
+    """Writes a file unless it already holds the text, and returns whether it wrote it."""
+    try:
+        with open(filename) as f:
+            if f.read() == text:
+                return False
+    except OSError:
+        pass
+    with open(filename, "w") as f:
+        f.write(text)
+    return True